@@ -10,12 +10,144 @@ TEMPLATE_FOLDER = os.path.join(PROJECT_PATH, 'templates')
 # CSRF_ENABLED = True
 
 UPLOAD_FOLDER = os.path.join(PROJECT_PATH, '/tmp')  # PUT THIS SOMEWHERE SENSIBLE
+ISA_CONFIG_FOLDER = os.path.join(PROJECT_PATH, 'isaconfig-default')  # ISA-Tab configurations validation runs against
+CONFIG_RELOAD_INTERVAL = 10  # seconds between checks of ISA_CONFIG_FOLDER for changed configurations
 ALLOWED_EXTENSIONS = {'zip'}
+MAX_CONTENT_LENGTH = 2 * 1024 * 1024 * 1024  # bytes, larger request bodies are rejected with 413
+UPLOAD_CHUNK_SIZE = 64 * 1024  # bytes of request body read into memory at a time
+# Uploaded ZIP archives are rejected with 413 before anything is extracted if their central directory declares more
+# than ZIP_MAX_MEMBERS members, more than ZIP_MAX_SIZE bytes in all, or a member of over ZIP_RATIO_MIN_SIZE bytes
+# compressed more than ZIP_MAX_RATIO times. Converters only extract the members they read
+ZIP_MAX_MEMBERS = 10000
+ZIP_MAX_SIZE = 64 * 1024 * 1024 * 1024  # bytes
+ZIP_MAX_RATIO = 1000
+ZIP_RATIO_MIN_SIZE = 1024 * 1024  # bytes
+RESPONSE_CHUNK_SIZE = 64 * 1024  # bytes of output file read into memory at a time when streaming zip responses
+# orjson, from requirements.txt, encodes JSON output several times faster than the standard library encoder ('json'),
+# which is used, with a warning, if orjson is missing. Both write large documents to disk a part at a time
+JSON_ENCODER = 'orjson'
+# Request bodies may be sent with Content-Encoding gzip, or zstd if the zstandard package is installed. Responses of
+# these types are compressed as the request's Accept-Encoding allows, unless they are known to be smaller than
+# COMPRESSION_MIN_SIZE
+COMPRESSION_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/tab-separated-values'}
+COMPRESSION_MIN_SIZE = 1024  # bytes
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_ZSTD_LEVEL = 3
+# Endpoints to serve, None for all of them, or a list of operations e.g. ['validate-json', 'validate-isatab'].
+# Operations are the names of the /api/v1 resources, e.g. tab-to-json or tab-to-all, plus validate-json,
+# validate-isatab and import-mw
+ENABLED_ENDPOINTS = None
+
+# Scratch space for requests is handed out from a pool of recycled workspace directories. Point WORKSPACE_FOLDER at a
+# tmpfs mount such as /dev/shm/isarest-workspaces to keep it in RAM
+WORKSPACE_FOLDER = os.path.join(UPLOAD_FOLDER, 'isarest-workspaces')
+WORKSPACE_POOL_SIZE = 8
+WORKSPACE_QUOTA = 20 * 1024 * 1024 * 1024  # bytes across all workspaces on this node
+WORKSPACE_MAX_AGE = 2 * 60 * 60  # seconds after which a workspace that was never released is reclaimed
+WORKSPACE_REAP_INTERVAL = 60  # seconds
+
+# Conversion results are cached on disk keyed by a hash of endpoint, options and request body. Identical requests in
+# flight at the same time are only coalesced onto one conversion for the endpoints cached here, as the others are
+# served its result from the cache
+RESULT_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'isarest-cache')
+RESULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+RESULT_CACHE_ENDPOINTS = {
+    'tab-to-json': True,
+    'json-to-tab': True,
+    'tab-to-sra': True,
+    'json-to-sra': True,
+    'tab-to-cedar': True,
+    'sampletab-to-isatab': True,
+    'sampletab-to-json': True,
+    'json-to-sampletab': True,
+    'isatab-to-sampletab': True,
+    'magetab-to-json': True
+}
+
+# Validation results are cached per checked file, keyed by a hash of the files each check reads, see
+# isarest_validation.py. 0 turns the validation cache off
+VALIDATION_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'isarest-validation-cache')
+VALIDATION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Asynchronous jobs (/api/v2/jobs) run on a pool of JOB_WORKERS processes
+JOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'isarest-jobs')
+JOB_WORKERS = os.cpu_count()
+JOB_TIMEOUT = 60 * 60  # seconds
+JOB_MEMORY_LIMIT = 4 * 1024 * 1024 * 1024  # bytes of address space per job, None for no limit
+JOB_RETENTION = 24 * 60 * 60  # seconds a finished job and its result are kept
+BATCH_MAX_ITEMS = 1000  # inputs accepted in a single /api/v1/batch request
+
+# Admission control. Conversions of an operation run at most ADMISSION_MEMORY_BUDGET // ADMISSION_MEMORY_COST[operation]
+# at a time on this node, across all server processes, unless ADMISSION_LIMITS sets another limit. Up to
+# ADMISSION_QUEUE_SIZE more requests wait for up to ADMISSION_QUEUE_TIMEOUT seconds, further ones get 503 with
+# Retry-After. Costs are the peak memory of a conversion, e.g. the RSS growth recorded for a request of the operation
+ADMISSION_FOLDER = os.path.join(UPLOAD_FOLDER, 'isarest-admission')
+ADMISSION_MEMORY_BUDGET = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 3 // 4  # bytes
+ADMISSION_MEMORY_COST = {  # bytes, operations not listed are not limited
+    'tab-to-json': 1024 * 1024 * 1024,
+    'json-to-tab': 1024 * 1024 * 1024,
+    'tab-to-sra': 2 * 1024 * 1024 * 1024,
+    'json-to-sra': 2 * 1024 * 1024 * 1024,
+    'tab-to-cedar': 2 * 1024 * 1024 * 1024,
+    'isatab-to-sampletab': 1024 * 1024 * 1024,
+    'magetab-to-json': 1024 * 1024 * 1024,
+    'tab-to-all': 3 * 1024 * 1024 * 1024,
+    'json-to-all': 3 * 1024 * 1024 * 1024
+}
+ADMISSION_LIMITS = {}  # operation -> conversions at a time, e.g. {'tab-to-sra': 2}
+ADMISSION_QUEUE_SIZE = 16  # requests waiting per operation
+ADMISSION_QUEUE_TIMEOUT = 30  # seconds
+ADMISSION_RETRY_AFTER = 10  # seconds a conversion is assumed to take until one has been timed
+
+# Metrics (/metrics) of the server processes of a node are shared through METRICS_FOLDER, so a scrape of any of them
+# reports the whole node, see isarest_metrics.py. None keeps each process's metrics to itself
+METRICS_FOLDER = os.path.join(UPLOAD_FOLDER, 'isarest-metrics')
+
+# Every request is accounted its wall and CPU time, peak RSS growth and workspace bytes, see isarest_accounting.py
+ACCOUNTING_MAX_RECORDS = 1000  # records kept in memory by each server process
+ACCOUNTING_LOG = os.path.join(UPLOAD_FOLDER, 'isarest-accounting.jsonl')  # records of all processes, None for none
+ACCOUNTING_LOG_MAX_BYTES = 16 * 1024 * 1024  # size at which the log is rotated to ACCOUNTING_LOG.1
+# Requests sending ADMIN_TOKEN in an X-Admin-Token header may list recent requests at /api/v1/accounting, and profile a
+# conversion with ?profile=store, keeping the profile in PROFILE_FOLDER, or ?profile=return, getting the report in
+# place of the output. None turns both off
+ADMIN_TOKEN = os.environ.get('ISAREST_ADMIN_TOKEN')
+PROFILE_FOLDER = os.path.join(UPLOAD_FOLDER, 'isarest-profiles')
+
+# Upload-once sessions (/api/v1/sessions) keep an unpacked input, and the ISA model parsed from it, between requests
+SESSION_FOLDER = os.path.join(UPLOAD_FOLDER, 'isarest-sessions')
+SESSION_TTL = 30 * 60  # seconds a session is kept after it was last used
+SESSION_MAX = 100  # sessions open at a time
+SESSION_MAX_PARSED = 8  # parsed models each server process keeps in memory
+
+# Resumable uploads (/api/v1/uploads) are sent as numbered chunks, then handed to any conversion or validation by
+# naming them in an X-Upload-Id header instead of sending a body
+RESUMABLE_UPLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, 'isarest-uploads')
+RESUMABLE_UPLOAD_TTL = 24 * 60 * 60  # seconds an upload is kept after it was last used
+RESUMABLE_UPLOAD_MAX = 100  # uploads open at a time
+RESUMABLE_UPLOAD_MAX_SIZE = 64 * 1024 * 1024 * 1024  # bytes, in place of MAX_CONTENT_LENGTH for uploads
+RESUMABLE_UPLOAD_MAX_CHUNK_SIZE = 256 * 1024 * 1024  # bytes
+
+# ISA-Tab imported from the Metabolomics Workbench (/api/v1/import/mw) is cached per study accession
+MW_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'isarest-mw-cache')
+MW_CACHE_TTL = 24 * 60 * 60  # seconds
+MW_PREFETCH_WORKERS = 4  # concurrent imports for a prefetch request
+# Directory of ISA-Tab per study, <MW_STUB_FOLDER>/<accession>/, served instead of the Metabolomics Workbench when set
+MW_STUB_FOLDER = None
 
 if ENV == 'dev':
     PORT = 5000
     APP_BASE_LINK = 'http://localhost:' + str(PORT)
     DEBUG = True
 else:
+    PORT = 5000
     APP_BASE_LINK = 'https://something.ox.ac.uk'
     DEBUG = False
+
+# Production server (isarest_server.py), a pre-forking gunicorn master with the app and isatools preloaded
+SERVER_BIND = '0.0.0.0:' + str(PORT)
+SERVER_WORKERS = os.cpu_count()
+SERVER_TIMEOUT = 10 * 60  # seconds a worker may spend on one request before it is killed and replaced
+SERVER_MAX_REQUESTS = 500  # requests after which a worker is replaced, staggered by up to the jitter
+SERVER_MAX_REQUESTS_JITTER = 50
+SERVER_MAX_WORKER_RSS = 2 * 1024 * 1024 * 1024  # bytes, a worker above this is replaced after its current request
+SERVER_PRELOAD_CONVERTERS = True  # import the enabled converters before forking, False to start faster and defer them
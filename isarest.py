@@ -1,57 +1,479 @@
 import os
+import re
+import hmac
 import uuid
 import shutil
 import json
 import io
+import pstats
+import contextlib
 import zipfile
-from flask import Flask, Response, request, jsonify, send_file
+import hashlib
+import functools
+import itertools
+import time
+from flask import Flask, Response, request, jsonify, send_file, g
+from werkzeug.utils import secure_filename
+from werkzeug.exceptions import BadRequest, Forbidden, HTTPException, NotFound, RequestEntityTooLarge, ServiceUnavailable, \
+    UnsupportedMediaType
 from flask_restful import Api, Resource
 from flask_restful_swagger import swagger
 import config
-
-from isatools.convert import isatab2json, isatab2sra, json2isatab, json2sra, sampletab2isatab, sampletab2json, \
-    isatab2sampletab, json2sampletab, magetab2json
-from isatools.net import mw2isa
-from isatools.convert.isatab2cedar import ISATab2CEDAR
-from isatools import isajson, isatab
+from isarest_accounting import Accounting, Usage, profiled
+from isarest_admission import AdmissionController, Overloaded, configured_limits
+from isarest_cache import InFlight, ResultCache, make_key
+from isarest_converters import CONVERTERS, FANOUT_TARGETS, MODEL_OPERATIONS, enabled, output_members, parse_input, \
+    startup_report, tab_to_records
+from isarest_jobs import JobManager
+from isarest_mw import ImportInProgress, InvalidAccession, MWImporter, UnknownStudy, mw2isa_import, stub_import
+from isarest_sessions import SessionManager, TooManySessions
+from isarest_uploads import ChunkChecksumMismatch, TooManyUploads, UploadError, UploadIncomplete, UploadManager, \
+    UploadTooLarge
+import isarest_compression
+import isarest_configs
+import isarest_json
+import isarest_metrics
+import isarest_validation
+from isarest_workspace import WorkspaceManager, WorkspaceQuotaExceeded
+from isarest_zip import Archive, UnsafeArchive
 
 
 def _allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1] in config.ALLOWED_EXTENSIONS
 
 
-def _zipdir(path, ziph):
-    # ziph is zipfile handle
-    for file in os.listdir(path):
-        ziph.write(os.path.join(path, file), file)
+class _ZipSink(io.RawIOBase):
+
+    """Unseekable file object collecting what a ZipFile writes to it until drained"""
+
+    def __init__(self):
+        super(_ZipSink, self).__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _stream_zip(members, resource=None):
+    """Generate a zip archive of members, a sequence of (path, name in archive), a chunk at a time
+
+    As the sink cannot seek, ZipFile writes each member's sizes and CRC in a data descriptor after its contents, so
+    bytes can be handed on as soon as they are written and no more than RESPONSE_CHUNK_SIZE of a member is held. The
+    time spent packing, leaving out the time waiting on the client, is recorded as the pack phase of resource.
+    """
+    sink = _ZipSink()
+    packing = 0.0
+    started = time.time()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for path, arcname in members:
+            if os.path.isdir(path):
+                zf.write(path, arcname)
+                continue
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            with open(path, 'rb') as src_fp, zf.open(zinfo, 'w') as member_fp:
+                while True:
+                    chunk = src_fp.read(config.RESPONSE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    member_fp.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        packing += time.time() - started
+                        yield data
+                        started = time.time()
+            data = sink.drain()
+            if data:
+                packing += time.time() - started
+                yield data
+                started = time.time()
+    data = sink.drain()  # central directory
+    isarest_metrics.observe_phase(resource, 'pack', packing + time.time() - started)
+    yield data
+
+
+def _release_after(response):
+    """Keep the request workspace until response, streamed from files in it, has been sent"""
+    workspace = g.pop('workspace', None)
+    if workspace is not None:
+        response.call_on_close(lambda: workspace_manager.release(workspace))
+    return response
+
+
+def _log_error(e, exc_info=False):
+    """Log e to the server's error log with the request it was raised handling, with its traceback if exc_info"""
+    app.logger.error("%s %s (request %s): %s", request.method, request.path, g.get('request_id'), e, exc_info=exc_info)
+
+
+def _request_workspace():
+    """Workspace for everything written on behalf of the current request, released when the request is torn down"""
+    if 'workspace' not in g:
+        try:
+            g.workspace = workspace_manager.acquire()
+            g.workspace_path = g.workspace  # kept for accounting once the workspace is handed to the response
+        except WorkspaceQuotaExceeded as e:
+            _log_error(e)
+            raise ServiceUnavailable()
+    return g.workspace
+
+
+REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,128}$')
+
+
+def _admin(request_):
+    """Whether request_ carries the admin token, never if no ADMIN_TOKEN is configured"""
+    token = request_.headers.get('X-Admin-Token')
+    return config.ADMIN_TOKEN is not None and token is not None and \
+        hmac.compare_digest(token.encode('utf-8'), config.ADMIN_TOKEN.encode('utf-8'))
+
+
+def _profiling(request_):
+    """Profile what runs in the with statement if request_ asks for it with a profile parameter
+
+    :return: Context manager yielding a list the profile report is appended to, None when not profiling
+    :raises Forbidden: If request_ asks for a profile without the admin token
+    :raises BadRequest: If the profile parameter is not store or return
+    """
+    mode = request_.args.get('profile')
+    if mode is None:
+        return contextlib.nullcontext()
+    if not _admin(request_):
+        raise Forbidden()
+    if mode not in ('store', 'return'):
+        raise BadRequest()
+    os.makedirs(config.PROFILE_FOLDER, exist_ok=True)  # only once profiling is used
+    return profiled(os.path.join(config.PROFILE_FOLDER, g.request_id + '.prof'))
 
 
-def _create_temp_dir():
-    unique_id = str(uuid.uuid4())
-    if not os.path.exists(config.UPLOAD_FOLDER):
-        raise IOError("UPLOAD_FOLDER does not exist in file system or is not read/write-able")
-    ul_dir = os.path.join(config.UPLOAD_FOLDER, unique_id)
-    os.mkdir(ul_dir)
-    if os.path.exists(ul_dir):
-        return ul_dir
+def _overloaded(e):
+    _log_error(e)
+    return Response(status=503, headers={'Retry-After': str(e.retry_after)})
+
+
+def _too_large(request_):
+    """Whether request_ declares a body larger than MAX_CONTENT_LENGTH"""
+    return config.MAX_CONTENT_LENGTH is not None and (request_.content_length or 0) > config.MAX_CONTENT_LENGTH
+
+
+def _ingest_request(request_):
+    """Stream the request body to a spool file in the request workspace, hashing it on the way
+
+    At most UPLOAD_CHUNK_SIZE bytes of the body are held in memory at a time and bodies larger than MAX_CONTENT_LENGTH
+    are rejected with 413 as soon as that is known, bodies that would not fit in the workspace quota with 503. The body
+    is only read once per request, so later calls return the same path and digest.
+
+    A body sent with Content-Encoding gzip or zstd is decoded as it is read, and spooled, hashed and limited by its
+    decoded size, so it is cached like the same body sent as it is. Other encodings are rejected with 415, bodies that
+    cannot be decoded with 400.
+
+    A request naming a complete resumable upload in an X-Upload-Id header is given the file of that upload, linked into
+    the request workspace, in place of its body. Unknown or incomplete uploads are rejected with 404.
+    :return: Tuple of (path to the spooled body, hex SHA-256 digest of the decoded body)
+    """
+    if 'upload_path' in g:
+        return g.upload_path, g.upload_digest
+    upload_id = request_.headers.get('X-Upload-Id')
+    if upload_id is not None:
+        spool_path = os.path.join(_request_workspace(), str(uuid.uuid4()) + '.upload')
+        with isarest_metrics.phase('ingest'):
+            claimed = upload_manager.claim(upload_id, spool_path)
+        if claimed is None:
+            raise NotFound()
+        workspace_manager.charge(g.workspace, claimed[0])
+        g.upload_path = spool_path
+        g.upload_size, g.upload_digest = claimed
+        return g.upload_path, g.upload_digest
+    if _too_large(request_):
+        raise RequestEntityTooLarge()
+    free = workspace_manager.bytes_free()  # snapshot, so the quota is not looked up again for every chunk
+    if (request_.content_length or 0) > free:
+        raise ServiceUnavailable()
+    body = isarest_compression.decoded_stream(request_.stream, request_.headers.get('Content-Encoding'))
+    if body is None:
+        raise UnsupportedMediaType()
+    spool_path = os.path.join(_request_workspace(), str(uuid.uuid4()) + '.upload')
+    h = hashlib.sha256()
+    size = 0
+    with isarest_metrics.phase('ingest'), open(spool_path, 'wb') as spool_fp:
+        while True:
+            try:
+                chunk = body.read(config.UPLOAD_CHUNK_SIZE)
+            except isarest_compression.DECODE_ERRORS as e:
+                _log_error(e)
+                raise BadRequest()
+            if not chunk:
+                break
+            size += len(chunk)
+            if config.MAX_CONTENT_LENGTH is not None and size > config.MAX_CONTENT_LENGTH:
+                raise RequestEntityTooLarge()
+            if size > free:
+                raise ServiceUnavailable()
+            h.update(chunk)
+            spool_fp.write(chunk)
+    workspace_manager.charge(g.workspace, size)
+    g.upload_path = spool_path
+    g.upload_digest = h.hexdigest()
+    g.upload_size = size
+    return g.upload_path, g.upload_digest
 
 
 def _write_request_data(request_, tmp_dir, file_name):
-    data = request_.get_data()
+    upload_path, _ = _ingest_request(request_)
     file_path = os.path.join(tmp_dir, file_name)
-    fd = os.open(file_path, os.O_CREAT | os.O_RDWR)
-    os.write(fd, data)
+    shutil.move(upload_path, file_path)
+    g.upload_path = file_path
     if os.path.exists(file_path):
         return file_path
 
 
-def _file_to_response(response, file_path, mimetype):
-    fd = open(file_path, 'rb')
-    response.set_data(fd.read())
-    fd.close()
-    response.headers.add('content-length', str(len(response.get_data())))
-    response.mimetype = mimetype
-    return response
+def _release_when_sent(chunks, flight):
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        flight.release()
+
+
+def _cached(endpoint):
+    """Serve conversions of byte-identical input from the result cache, if enabled for endpoint in config
+
+    Of identical requests arriving while one of them is being converted, only that one runs the converter. The others
+    wait for its result to be committed to the cache and are served from there, and counted as coalesced. A request
+    that waited ADMISSION_QUEUE_TIMEOUT seconds, e.g. behind a conversion that hangs, converts by itself instead, under
+    admission control like any other, so waiting never holds on to more requests than admission would queue.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not config.RESULT_CACHE_ENDPOINTS.get(endpoint, False) or 'profile' in request.args:
+                return f(*args, **kwargs)
+            # refused before the body is spooled and hashed, as the conversion would refuse it
+            mimetype = CONVERTERS[endpoint].mimetype
+            if mimetype is not None and request.mimetype != mimetype:
+                return Response(status=415)
+            if _too_large(request):
+                return Response(status=413)
+            _, digest = _ingest_request(request)
+            options = dict(request.args.to_dict(), mimetype=request.mimetype)
+            key = make_key(endpoint, options, digest)
+            hit = result_cache.get(endpoint, key)
+            if hit is not None:
+                cached_path, mimetype = hit
+                return send_file(cached_path, mimetype=mimetype)
+            flight = in_flight.acquire(key, config.ADMISSION_QUEUE_TIMEOUT)
+            if flight.waited:
+                hit = result_cache.get(endpoint, key)
+                if hit is not None:
+                    flight.release()
+                    result_cache.count_coalesced(endpoint)
+                    isarest_metrics.coalesced.inc(1, endpoint)
+                    cached_path, mimetype = hit
+                    return send_file(cached_path, mimetype=mimetype)
+                # the request in flight failed or is taking too long, so this one converts after all
+            try:
+                response = f(*args, **kwargs)
+            except Exception:
+                flight.release()
+                raise
+            if response.status_code != 200:
+                flight.release()
+                return response
+            # released once the result is committed, or when the response is closed without being sent in full
+            response.response = _release_when_sent(
+                result_cache.tee(key, response.mimetype, response.iter_encoded()), flight)
+            response.call_on_close(flight.release)
+            return response
+        return wrapper
+    return decorator
+
+
+def _send_output(output_path, mimetype):
+    if os.path.isdir(output_path):
+        # no Content-Length, so the archive goes out with chunked transfer encoding as it is packed
+        return _release_after(Response(_stream_zip(output_members(output_path), isarest_metrics.current_resource()),
+                                       mimetype=mimetype))
+    return send_file(output_path, mimetype=mimetype)
+
+
+def _convert_request(name):
+    """Run the converter registered under name on the current request and respond with its output"""
+    converter = CONVERTERS[name]
+    if converter.mimetype is not None and request.mimetype != converter.mimetype:
+        return Response(status=415)
+    try:
+        # Write request data to file, the workspace is cleaned up on teardown
+        tmp_dir = _request_workspace()
+        file_path = _write_request_data(request, tmp_dir, converter.upload_name)
+        if file_path is None:
+            raise IOError("Could not create temporary file " + converter.upload_name)
+        with _profiling(request) as report, admission.admit(name), isarest_metrics.phase('convert'):
+            output_path = converter.convert(file_path, tmp_dir)
+        if report is None:
+            return _send_output(output_path, converter.output_mimetype)
+        if request.args['profile'] == 'return':
+            return Response(report[0], mimetype='text/plain')
+        response = _send_output(output_path, converter.output_mimetype)
+        response.headers['X-Profile'] = '/api/v1/profiles/' + g.request_id
+        return response
+    except HTTPException as e:
+        return Response(status=e.code)
+    except Overloaded as e:
+        return _overloaded(e)
+    except UnsafeArchive as e:
+        _log_error(e)
+        return Response(status=413)
+    except Exception as e:
+        _log_error(e, exc_info=True)
+        return Response(status=500)
+
+
+def _stream_records(records, resource=None):
+    """Generate records as line-delimited JSON, a line per record
+
+    The time spent encoding, leaving out the time waiting on the client, is recorded as the serialize phase of resource.
+    """
+    serializing = 0.0
+    started = time.time()
+    for record in records:
+        line = isarest_json.dumps_line(record)
+        serializing += time.time() - started
+        yield line
+        started = time.time()
+    isarest_metrics.observe_phase(resource, 'serialize', serializing + time.time() - started)
+
+
+def _ndjson_request():
+    """Convert the ISA-Tab archive of the current request and stream its ISA-JSON as NDJSON records"""
+    if request.mimetype != 'application/zip':
+        return Response(status=415)
+    try:
+        tmp_dir = _request_workspace()
+        file_path = _write_request_data(request, tmp_dir, CONVERTERS['tab-to-json'].upload_name)
+        if file_path is None:
+            raise IOError("Could not create temporary file " + CONVERTERS['tab-to-json'].upload_name)
+        with _profiling(request) as report, admission.admit('tab-to-json'), isarest_metrics.phase('convert'):
+            records = tab_to_records(file_path, tmp_dir)
+            first = next(records)  # the investigation, so that loading fails here rather than mid-response
+        if report is not None and request.args['profile'] == 'return':
+            return Response(report[0], mimetype='text/plain')
+        response = _release_after(Response(_stream_records(itertools.chain([first], records),
+                                                            isarest_metrics.current_resource()),
+                                           mimetype='application/x-ndjson'))
+        if report is not None:
+            response.headers['X-Profile'] = '/api/v1/profiles/' + g.request_id
+        return response
+    except HTTPException as e:
+        return Response(status=e.code)
+    except Overloaded as e:
+        return _overloaded(e)
+    except UnsafeArchive as e:
+        _log_error(e)
+        return Response(status=413)
+    except Exception as e:
+        _log_error(e, exc_info=True)
+        return Response(status=500)
+
+
+def _fanout_request(name):
+    """Parse the current request body once and respond with a zip archive of every requested target made from it"""
+    kind, targets = FANOUT_TARGETS[name]
+    requested = request.args.get('targets')
+    requested = [t.strip() for t in requested.split(',') if t.strip()] if requested else list(targets)
+    if not requested or any(t not in targets for t in requested):
+        return Response(status=400)
+    if request.mimetype not in ('application/zip', 'application/json') or \
+            (kind == 'isatab' and request.mimetype != 'application/zip'):
+        return Response(status=415)
+    try:
+        tmp_dir = _request_workspace()
+        upload_path, _ = _ingest_request(request)
+        with isarest_metrics.phase('unpack'):
+            parsed = parse_input(kind, upload_path, tmp_dir)
+        with admission.admit(name), isarest_metrics.phase('convert'):
+            results = job_manager.run_fanout(parsed, [targets[t] for t in requested], tmp_dir,
+                                             timeout=request.args.get('timeout', type=int),
+                                             memory_limit=request.args.get('memory_limit', type=int))
+        out_dir = os.path.join(tmp_dir, 'all')
+        os.mkdir(out_dir)
+        manifest = []
+        for target, (output_path, error) in zip(requested, results):
+            entry = {'target': target, 'operation': targets[target]}
+            if error is None:
+                target_dir = os.path.join(out_dir, target)
+                if os.path.isdir(output_path):
+                    shutil.move(output_path, target_dir)
+                else:
+                    os.mkdir(target_dir)
+                    shutil.move(output_path, target_dir)
+                entry.update(status='finished', result=sorted(os.listdir(target_dir)))
+            else:
+                entry.update(status='failed', error=error)
+            manifest.append(entry)
+        with open(os.path.join(out_dir, 'manifest.json'), 'w') as manifest_fp:
+            json.dump(manifest, manifest_fp, indent=2)
+        return _send_output(out_dir, 'application/zip')
+    except HTTPException as e:
+        return Response(status=e.code)
+    except Overloaded as e:
+        return _overloaded(e)
+    except UnsafeArchive as e:
+        _log_error(e)
+        return Response(status=413)
+    except (IOError, zipfile.BadZipFile) as e:
+        _log_error(e)
+        return Response(status=400)
+    except Exception as e:
+        _log_error(e, exc_info=True)
+        return Response(status=500)
+
+
+def _unique_name(name, taken):
+    stem, ext = os.path.splitext(secure_filename(name) or 'item')
+    candidate, n = stem, 1
+    while candidate in taken:
+        n += 1
+        candidate = '{}-{}'.format(stem, n)
+    taken.add(candidate)
+    return candidate + ext
+
+
+def _batch_items(request_, tmp_dir, converter):
+    """Unpack the inputs of a batch, uploaded as multipart/form-data files or as a zip archive of inputs
+
+    Every input gets an item directory of its own under tmp_dir, holding the input as converter.upload_name.
+    :return: List of (item name, path of input, item directory)
+    """
+    items = []
+    taken = set()
+
+    def new_item(name):
+        item_dir = os.path.join(tmp_dir, 'items', str(len(items)))
+        os.makedirs(item_dir)
+        items.append((_unique_name(name, taken), os.path.join(item_dir, converter.upload_name), item_dir))
+        if len(items) > config.BATCH_MAX_ITEMS:
+            raise RequestEntityTooLarge()
+        return items[-1][1]
+
+    if request_.mimetype == 'multipart/form-data':
+        if request_.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            raise UnsupportedMediaType()  # parsed as it is sent, so compress the files instead
+        for key in request_.files:
+            for file_storage in request_.files.getlist(key):
+                file_storage.save(new_item(file_storage.filename or key))
+    elif request_.mimetype == 'application/zip':
+        upload_path, _ = _ingest_request(request_)
+        with Archive(upload_path) as archive:
+            for name in archive.files():
+                archive.copy(name, new_item(os.path.basename(name)))
+    return items
 
 
 class ConvertTabToJson(Resource):
@@ -59,8 +481,19 @@ class ConvertTabToJson(Resource):
     """Convert to ISA- tab (zip) to ISA-JSON"""
     @swagger.operation(
         summary='Convert ISA tab to JSON',
-        notes='Converts a ZIP file containing a collection of ISA tab files to ISA-JSON',
+        notes='Converts a ZIP file containing a collection of ISA tab files to ISA-JSON. With format=ndjson the '
+              'ISA-JSON is streamed as application/x-ndjson, one record per line: the investigation without its '
+              'studies, then each study followed by its sources, samples, other materials and processes, and by each '
+              'of its assays with their materials, data files and processes. Every record holds its type, the file '
+              'names of the study and assay it belongs to, and its ISA-JSON as data',
         parameters=[
+            {
+                "name": "format",
+                "description": "json for one ISA-JSON document, the default, or ndjson for line-delimited records",
+                "required": False,
+                "dataType": "string",
+                "paramType": "query"
+            },
             {
                 "name": "body",
                 "description": "Given a ZIP file containing valid ISA tab files, convert and return a valid ISA-JSON",
@@ -76,48 +509,24 @@ class ConvertTabToJson(Resource):
                 "code": 200,
                 "message": "OK. The converted ISA content should be in the returned JSON."
             },
+            {
+                "code": 400,
+                "message": "Bad request. Unknown format."
+            },
             {
                 "code": 415,
                 "message": "Media not supported. Unexpected MIME type sent."
             }
         ]
     )
+    @_cached('tab-to-json')
     def post(self):
-        response = Response(status=415)
-        if request.mimetype == "application/zip":
-            tmp_dir = None
-            tmp_file = None
-            J = None
-            try:
-                # Write request data to file
-                tmp_file = str(uuid.uuid4()) + ".zip"
-                file_path = _write_request_data(request, config.UPLOAD_FOLDER, tmp_file)
-                if file_path is None:
-                    return Response(500)
-                # Extract ISArchive files
-                with zipfile.ZipFile(file_path, 'r') as z:
-                    # Create temporary directory
-                    tmp_dir = _create_temp_dir()
-                    if tmp_dir is None:
-                        return Response(500)
-                    z.extractall(tmp_dir)
-                    # Convert
-                    src_dir = os.path.normpath(tmp_dir)
-                    J = isatab2json.convert(src_dir, validate_first=False, use_new_parser=True)
-                    if J is None:
-                        raise IOError("Could not generate JSON from input ISA-Tab")
-            except Exception as e:
-                print("Error: {}".format(e))
-                return Response(status=500)
-            finally:
-                # cleanup generated directories
-                try:
-                    shutil.rmtree(tmp_dir, ignore_errors=True)
-                    os.remove(os.path.join(config.UPLOAD_FOLDER, tmp_file))
-                except:
-                    pass
-            response = jsonify(J)
-        return response
+        output_format = request.args.get('format', 'json')
+        if output_format == 'ndjson':
+            return _ndjson_request()
+        if output_format != 'json':
+            return Response(status=400)
+        return _convert_request('tab-to-json')
 
 
 class ConvertJsonToTab(Resource):
@@ -148,28 +557,9 @@ class ConvertJsonToTab(Resource):
             }
         ]
     )
+    @_cached('json-to-tab')
     def post(self):
-        response = Response(status=415)
-        if request.mimetype == "application/json":
-            tmp_file = str(uuid.uuid4()) + ".json"
-            tmp_dir = _create_temp_dir()
-            try:
-                # Write request data to file
-                file_path = _write_request_data(request, tmp_dir, tmp_file)
-                if file_path is None:
-                    return Response(500)
-                json2isatab.convert(open(file_path), tmp_dir)
-                os.remove(file_path)
-                memf = io.BytesIO()
-                with zipfile.ZipFile(memf, 'w') as zf:
-                    for file in os.listdir(tmp_dir):
-                        zf.write(os.path.join(tmp_dir, file), file)
-                memf.seek(0)
-                response = send_file(memf, mimetype='application/zip')
-            finally:
-                # cleanup generated directories
-                shutil.rmtree(tmp_dir, ignore_errors=True)
-        return response
+        return _convert_request('json-to-tab')
 
 
 class ConvertTabToSra(Resource):
@@ -200,45 +590,9 @@ class ConvertTabToSra(Resource):
             }
         ]
     )
+    @_cached('tab-to-sra')
     def post(self):
-        response = Response(status=500)
-        # Create temporary directory
-        tmp_dir = _create_temp_dir()
-        target_tmp_dir = _create_temp_dir()
-        try:
-            if tmp_dir is None or target_tmp_dir is None:
-                raise IOError("Could not create temporary directory " + tmp_dir)
-            if not request.mimetype == "application/zip":
-                raise TypeError("Incorrect media type received. Got " + request.mimetype + ", expected application/zip")
-            else:
-                # Write request data to file
-                file_path = _write_request_data(request, tmp_dir, 'isatab.zip')
-                if file_path is None:
-                    raise IOError("Could not create temporary file " + file_path)
-
-                with zipfile.ZipFile(file_path, 'r') as z:
-                    # extract ISArchive files
-                    z.extractall(tmp_dir)
-                    src_dir = os.path.normpath(tmp_dir)
-                    # convert to SRA writes to /sra
-                    isatab2sra.convert(src_dir, target_tmp_dir, validate_first=False)
-                    memf = io.BytesIO()
-                    with zipfile.ZipFile(memf, 'w') as zf:
-                        for file in os.listdir(target_tmp_dir):
-                            print("Adding {} to zip".format(os.path.join(target_tmp_dir, file)))
-                            zf.write(os.path.join(target_tmp_dir, file), file)
-                    memf.seek(0)
-                    response = send_file(memf, mimetype='application/zip')
-        except TypeError as t:
-            print("TypeError: {}".format(t))
-            response = Response(status=415)
-        except Exception as e:
-            print("Error: {}".format(e))
-            response = Response(status=500)
-        finally:
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            shutil.rmtree(target_tmp_dir, ignore_errors=True)
-            return response
+        return _convert_request('tab-to-sra')
 
 
 class ConvertJsonToSra(Resource):
@@ -269,47 +623,9 @@ class ConvertJsonToSra(Resource):
             }
         ]
     )
+    @_cached('json-to-sra')
     def post(self):
-        response = Response(status=500)
-        # Create temporary directory
-        tmp_dir = _create_temp_dir()
-        target_tmp_dir = _create_temp_dir()
-        try:
-            if tmp_dir is None:
-                raise IOError("Could not create temporary directory " + tmp_dir)
-            if not request.mimetype == "application/zip":
-                raise TypeError("Incorrect media type received. Got " + request.mimetype +
-                                ", expected application/zip")
-            else:
-                # Write request data to file
-                file_path = _write_request_data(request, tmp_dir, 'isatab.zip')
-                if file_path is None:
-                    raise IOError("Could not create temporary file " + file_path)
-
-                with zipfile.ZipFile(file_path, 'r') as z:
-                    # extract ISArchive files
-                    z.extractall(tmp_dir)
-                    src_file_path = os.path.normpath(os.path.join(tmp_dir, z.filelist[0].filename))
-                    # find just the combined JSON
-                    with open(src_file_path) as json_fp:
-                        json2sra.convert(json_fp, target_tmp_dir, validate_first=False)
-                        memf = io.BytesIO()
-                        with zipfile.ZipFile(memf, 'w') as zf:
-                            for file in os.listdir(target_tmp_dir):
-                                print("Adding {} to zip".format(os.path.join(target_tmp_dir, file)))
-                                zf.write(os.path.join(target_tmp_dir, file), file)
-                        memf.seek(0)
-                        response = send_file(memf, mimetype='application/zip')
-        except TypeError as t:
-            print("TypeError: {}".format(t))
-            response = Response(status=415)
-        except Exception as e:
-            print("Error: {}".format(e))
-            response = Response(status=500)
-        finally:
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            shutil.rmtree(target_tmp_dir, ignore_errors=True)
-            return response
+        return _convert_request('json-to-sra')
 
 
 class ConvertTabToCedar(Resource):
@@ -340,42 +656,9 @@ class ConvertTabToCedar(Resource):
             }
         ]
     )
+    @_cached('tab-to-cedar')
     def post(self):
-        response = Response(status=415)
-        if request.mimetype == "application/zip":
-            try:
-                # Write request data to file
-                tmp_file = str(uuid.uuid4()) + ".zip"
-                file_path = _write_request_data(request, config.UPLOAD_FOLDER, tmp_file)
-                if file_path is None:
-                    return Response(500)
-                # Extract ISArchive files
-                with zipfile.ZipFile(file_path, 'r') as z:
-                    # Create temporary directory
-                    tmp_dir = _create_temp_dir()
-                    if tmp_dir is None:
-                        return Response(500)
-                    z.extractall(tmp_dir)
-                    # Convert
-                    src_dir = os.path.normpath(tmp_dir)
-                    tab2cedar = ISATab2CEDAR('http://www.isa-tools.org/')
-                    tab2cedar.createCEDARjson(src_dir, src_dir, True)
-                    # return just the combined JSON
-                    files = [f for f in os.listdir(src_dir) if f.endswith('.json')]
-                    if len(files) == 1:  # current assumption is that only one JSON should exist to know what to return
-                        combined_json_file = os.path.join(src_dir, files[0])
-                        combined_json = json.load(open(combined_json_file))
-                    else:
-                        raise IOError("More than one .json was output - cannot disambiguate what to return")
-            except Exception as e:
-                print("Error: {}".format(e))
-                return Response(status=500)
-            finally:
-                # cleanup generated directories
-                shutil.rmtree(tmp_dir, ignore_errors=True)
-                os.remove(os.path.join(config.UPLOAD_FOLDER, tmp_file))
-            response = jsonify(combined_json)
-        return response
+        return _convert_request('tab-to-cedar')
 
 
 class ValidateIsaJSON(Resource):
@@ -408,23 +691,7 @@ class ValidateIsaJSON(Resource):
         ]
     )
     def post(self):
-        response = Response(status=415)
-        if request.mimetype == "application/json":
-            tmp_file = str(uuid.uuid4()) + ".json"
-            tmp_dir = _create_temp_dir()
-            try:
-                # Write request data to file
-                file_path = _write_request_data(request, tmp_dir, tmp_file)
-                if file_path is None:
-                    return Response(500)
-                result = isajson.validate(open(file_path))
-                response = jsonify(result)
-            except Exception:
-                response = Response(status=500)
-            finally:
-                # cleanup generated directories
-                shutil.rmtree(tmp_dir, ignore_errors=True)
-        return response
+        return _convert_request('validate-json')
 
 
 class ValidateIsaTab(Resource):
@@ -457,40 +724,7 @@ class ValidateIsaTab(Resource):
         ]
     )
     def post(self):
-        response = Response(status=415)
-        if request.mimetype == "application/zip":
-            tmp_dir = _create_temp_dir()
-            try:
-                if tmp_dir is None:
-                    raise IOError("Could not create temporary directory " + tmp_dir)
-                if not request.mimetype == "application/zip":
-                    raise TypeError("Incorrect media type received. Got " + request.mimetype +
-                                    ", expected application/zip")
-                else:
-                    # Write request data to file
-                    file_path = _write_request_data(request, tmp_dir, 'isatab.zip')
-                    if file_path is None:
-                        raise IOError("Could not create temporary file " + file_path)
-
-                    # Setup path to configuration
-                    with zipfile.ZipFile(file_path, 'r') as z:
-                        # extract ISArchive files
-                        z.extractall(tmp_dir)
-                        i_file_list = [i.filename for i in z.filelist if 'i_' in i.filename and i.filename.endswith('.txt')]
-                        if len(i_file_list) == 1:
-                            src_file_path = os.path.normpath(os.path.join(tmp_dir, i_file_list[0]))
-                            fp = open(src_file_path)
-                            # find just the combined JSON
-                            result = isatab.validate(fp)
-                            response = jsonify(result)
-                        else:
-                            raise Exception("Could not resolve investigation file entry point")
-            except Exception:
-                response = Response(status=500)
-            finally:
-                # cleanup generated directories
-                shutil.rmtree(tmp_dir, ignore_errors=True)
-        return response
+        return _convert_request('validate-isatab')
 
 
 class ImportMWToIsaTab(Resource):
@@ -498,7 +732,8 @@ class ImportMWToIsaTab(Resource):
     """Convert to ISA tab (zip) to SRA XML (zip)"""
     @swagger.operation(
         summary='Import from Metabolomics Workbench to ISA-Tab',
-        notes='Imports a study from Metabolomics Workbench to ISA-Tab',
+        notes='Imports a study from Metabolomics Workbench to ISA-Tab. The ISA-Tab of a study is cached for a while, '
+              'and concurrent requests for a study wait on a single import',
         parameters=[
             {
                 "name": "studyid",
@@ -512,31 +747,97 @@ class ImportMWToIsaTab(Resource):
                 "code": 200,
                 "message": "OK. The converted MW content should be in the returned ZIP."
             },
+            {
+                "code": 400,
+                "message": "Bad request. Not a Metabolomics Workbench study ID."
+            },
+            {
+                "code": 404,
+                "message": "No such study."
+            },
             {
                 "code": 415,
                 "message": "Media not supported. Unexpected MIME type sent."
+            },
+            {
+                "code": 503,
+                "message": "An import of the study is still in progress. Retry after the number of seconds in the "
+                           "Retry-After header."
             }
         ]
     )
     def get(self, studyid):
-        tmp_dir = _create_temp_dir()
         try:
-            mw2isa.mw2isa_convert(studyid=studyid, outputdir=tmp_dir, dl_option="no", validate_option="no")
-            memf = io.BytesIO()
-            with zipfile.ZipFile(memf, 'w') as zf:
-                for file in os.listdir(os.path.join(tmp_dir, studyid)):
-                    print("Adding {} to zip".format(os.path.join(tmp_dir, studyid, file)))
-                    zf.write(os.path.join(tmp_dir, studyid, file), file)
-            memf.seek(0)
-            response = send_file(memf, mimetype='application/zip')
+            with isarest_metrics.phase('convert'):
+                archive_path, _ = mw_importer.archive(studyid)
+            response = send_file(archive_path, mimetype='application/zip')
+        except HTTPException as e:
+            response = Response(status=e.code)
+        except InvalidAccession as e:
+            _log_error(e)
+            response = Response(status=400)
+        except ImportInProgress as e:
+            response = _overloaded(e)
+        except UnknownStudy as e:
+            _log_error(e)
+            response = Response(status=404)
         except Exception as e:
-            print("Error: {}".format(e))
+            _log_error(e, exc_info=True)
             response = Response(status=500)
-        finally:
-            shutil.rmtree(tmp_dir, ignore_errors=True)
         return response
 
 
+class ImportMWPrefetch(Resource):
+
+    """Import several studies from Metabolomics Workbench ahead of their use"""
+    @swagger.operation(
+        summary='Prefetch Metabolomics Workbench studies',
+        notes='Imports the listed studies from Metabolomics Workbench to ISA-Tab, a few at a time, unless they are '
+              'already cached, so that later requests for them are served from the cache. Returns the status of '
+              'each study: cached, imported or failed',
+        parameters=[
+            {
+                "name": "body",
+                "description": "JSON object listing the study IDs, e.g. {\"studyids\": [\"ST000367\"]}",
+                "required": True,
+                "allowMultiple": False,
+                "dataType": "JSON",
+                "supportedContentTypes": ['application/json'],
+                "paramType": "body"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The status of each study should be in the returned JSON."
+            },
+            {
+                "code": 400,
+                "message": "No list of study IDs in the request."
+            },
+            {
+                "code": 413,
+                "message": "Too many studies in one request."
+            },
+            {
+                "code": 415,
+                "message": "Media not supported. Unexpected MIME type sent."
+            }
+        ]
+    )
+    def post(self):
+        if request.mimetype != 'application/json':
+            return Response(status=415)
+        body = request.get_json(silent=True)
+        studyids = body.get('studyids') if isinstance(body, dict) else None
+        if not isinstance(studyids, list) or not all(isinstance(studyid, str) for studyid in studyids):
+            return Response(status=400)
+        if len(studyids) > config.BATCH_MAX_ITEMS:
+            return Response(status=413)
+        with isarest_metrics.phase('convert'):
+            return jsonify(mw_importer.prefetch(studyids))
+
+
 class ConvertSampleTabToIsaTab(Resource):
 
     """Convert SampleTab to ISA-Tab"""
@@ -565,34 +866,9 @@ class ConvertSampleTabToIsaTab(Resource):
             }
         ]
     )
+    @_cached('sampletab-to-isatab')
     def post(self):
-        response = Response(status=500)
-        tmp_file = str(uuid.uuid4()) + ".txt"
-        tmp_dir = _create_temp_dir()
-        target_tmp_dir = _create_temp_dir()
-        try:
-            # Write request data to file
-            file_path = _write_request_data(request, tmp_dir, tmp_file)
-            if file_path is None:
-                raise IOError("Could not create temporary file " + file_path)
-            sampletab2isatab.convert(open(file_path), target_tmp_dir)
-            memf = io.BytesIO()
-            with zipfile.ZipFile(memf, 'w') as zf:
-                for file in os.listdir(target_tmp_dir):
-                    print("Adding {} to zip".format(os.path.join(target_tmp_dir, file)))
-                    zf.write(os.path.join(target_tmp_dir, file), file)
-            memf.seek(0)
-            response = send_file(memf, mimetype='application/zip')
-        except TypeError as t:
-            print("TypeError: {}".format(t))
-            response = Response(status=415)
-        except Exception as e:
-            print("Error: {}".format(e))
-            response = Response(status=500)
-        finally:
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            shutil.rmtree(target_tmp_dir, ignore_errors=True)
-            return response
+        return _convert_request('sampletab-to-isatab')
 
 
 class ConvertSampleTabToJson(Resource):
@@ -623,30 +899,9 @@ class ConvertSampleTabToJson(Resource):
             }
         ]
     )
+    @_cached('sampletab-to-json')
     def post(self):
-        response = Response(status=500)
-        tmp_file = str(uuid.uuid4()) + ".txt"
-        tmp_dir = _create_temp_dir()
-        tmp_json_file = str(uuid.uuid4()) + ".json"
-        try:
-            # Write request data to file
-            file_path = _write_request_data(request, tmp_dir, tmp_file)
-            if file_path is None:
-                raise IOError("Could not create temporary file " + file_path)
-            with open(file_path, 'r') as input_fp:
-                with open(os.path.join(tmp_dir, tmp_json_file), 'w') as json_fp:
-                    sampletab2json.convert(input_fp, json_fp)
-            with open(os.path.join(tmp_dir, tmp_json_file), 'r') as json_fp:
-                response = jsonify(json.load(json_fp))
-        except TypeError as t:
-            print("TypeError: {}".format(t))
-            response = Response(status=415)
-        except Exception as e:
-            print("Error: {}".format(e))
-            response = Response(status=500)
-        finally:
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            return response
+        return _convert_request('sampletab-to-json')
 
 
 class ConvertJsonToSampleTab(Resource):
@@ -677,37 +932,9 @@ class ConvertJsonToSampleTab(Resource):
             }
         ]
     )
+    @_cached('json-to-sampletab')
     def post(self):
-        response = Response(status=500)
-        # Create temporary directory
-        tmp_dir = _create_temp_dir()
-        target_tmp_dir = _create_temp_dir()
-        try:
-            if tmp_dir is None:
-                raise IOError("Could not create temporary directory " + tmp_dir)
-            if not request.mimetype == "application/json":
-                raise TypeError("Incorrect media type received. Got " + request.mimetype +
-                                ", expected application/json")
-            else:
-                # Write request data to file
-                file_path = _write_request_data(request, tmp_dir, 'in.json')
-                if file_path is None:
-                    raise IOError("Could not create temporary file " + file_path)
-                with open(file_path) as json_fp:
-                    with open(os.path.join(tmp_dir, 'out.txt'), 'w') as st_fp:
-                        json2sampletab.convert(json_fp, st_fp)
-                with open(os.path.join(tmp_dir, 'out.txt'), 'r') as st_fp:
-                    response = send_file(st_fp, mimetype='text/tab-separated-values')
-        except TypeError as t:
-            print("TypeError: {}".format(t))
-            response = Response(status=415)
-        except Exception as e:
-            print("Error: {}".format(e))
-            response = Response(status=500)
-        finally:
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            shutil.rmtree(target_tmp_dir, ignore_errors=True)
-            return response
+        return _convert_request('json-to-sampletab')
 
 
 class ConvertIsaTabToSampleTab(Resource):
@@ -738,42 +965,9 @@ class ConvertIsaTabToSampleTab(Resource):
             }
         ]
     )
+    @_cached('isatab-to-sampletab')
     def post(self):
-        response = Response(status=500)
-        # Create temporary directory
-        tmp_dir = _create_temp_dir()
-        target_tmp_dir = _create_temp_dir()
-        try:
-            if tmp_dir is None:
-                raise IOError("Could not create temporary directory " + tmp_dir)
-            if not request.mimetype == "application/zip":
-                raise TypeError("Incorrect media type received. Got " + request.mimetype +
-                                ", expected application/zip")
-            else:
-                # Write request data to file
-                file_path = _write_request_data(request, tmp_dir, 'in.zip')
-                if file_path is None:
-                    raise IOError("Could not create temporary file " + file_path)
-                with zipfile.ZipFile(file_path, 'r') as z:
-                    # extract ISArchive files
-                    z.extractall(tmp_dir)
-                    i_file_list = [i.filename for i in z.filelist if 'i_' in i.filename and i.filename.endswith('.txt')]
-                    if len(i_file_list) == 1:
-                        src_file_path = os.path.normpath(os.path.join(tmp_dir, i_file_list[0]))
-                        with open(src_file_path) as fp:
-                            with open(os.path.join(tmp_dir, 'out.txt'), 'w') as st_out_fp:
-                                isatab2sampletab.convert(fp, st_out_fp)
-                        response = send_file(os.path.join(tmp_dir, 'out.txt'), mimetype='text/tab-separated-values')
-        except TypeError as t:
-            print("TypeError: {}".format(t))
-            response = Response(status=415)
-        except Exception as e:
-            print("Error: {}".format(e))
-            response = Response(status=500)
-        finally:
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            shutil.rmtree(target_tmp_dir, ignore_errors=True)
-            return response
+        return _convert_request('isatab-to-sampletab')
 
 
 class ConvertMageTabToJson(Resource):
@@ -804,63 +998,1253 @@ class ConvertMageTabToJson(Resource):
             }
         ]
     )
+    @_cached('magetab-to-json')
     def post(self):
-        response = Response(status=415)
-        if request.mimetype == "application/zip":
-            tmp_dir = None
-            tmp_file = None
-            J = None
-            try:
-                # Write request data to file
-                tmp_file = str(uuid.uuid4()) + ".zip"
-                file_path = _write_request_data(request, config.UPLOAD_FOLDER, tmp_file)
-                if file_path is None:
-                    return Response(500)
-                # Extract ISArchive files
-                with zipfile.ZipFile(file_path, 'r') as z:
-                    # Create temporary directory
-                    tmp_dir = _create_temp_dir()
-                    if tmp_dir is None:
-                        return Response(500)
-                    z.extractall(tmp_dir)
-                    # Convert
-                    src_dir = os.path.normpath(tmp_dir)
-                    files = [f for f in os.listdir(src_dir) if f.endswith('.idf.txt')]
-                    if len(files) == 1:
-                        J = magetab2json.convert(os.path.join(src_dir, files[0]))
-                    if J is None:
-                        raise IOError("Could not generate JSON from input MAGE-TAB")
-            except Exception as e:
-                print("Error: {}".format(e))
-                return Response(status=500)
-            finally:
-                # cleanup generated directories
-                try:
-                    shutil.rmtree(tmp_dir, ignore_errors=True)
-                    os.remove(os.path.join(config.UPLOAD_FOLDER, tmp_file))
-                except:
-                    pass
-            response = jsonify(J)
-        return response
+        return _convert_request('magetab-to-json')
 
 
-app = Flask(__name__)
-app.config.from_object(config)
+class ConvertTabToAll(Resource):
+
+    """Convert an ISA tab archive to several formats from one parse"""
+    @swagger.operation(
+        summary='Convert ISA tab to several formats',
+        notes='Parses the input once and produces every requested output format from that parse in parallel. '
+              'Returns a ZIP archive with a directory per target, along with manifest.json giving the status of '
+              'each target. Targets that fail to convert are listed in the manifest with their error',
+        parameters=[
+            {
+                "name": "targets",
+                "description": "Comma separated formats to output, any of json, sra, sampletab and cedar. All of them "
+                               "by default",
+                "required": False,
+                "dataType": "string",
+                "paramType": "query"
+            },
+            {
+                "name": "body",
+                "description": "ISA tab ZIP archive",
+                "required": True,
+                "allowMultiple": False,
+                "dataType": "ISA tab (ZIP)",
+                "supportedContentTypes": ['application/zip'],
+                "paramType": "body"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The outputs and manifest.json are returned in a ZIP archive."
+            },
+            {
+                "code": 400,
+                "message": "Unknown target, or input could not be unpacked."
+            },
+            {
+                "code": 415,
+                "message": "Media not supported. Unexpected MIME type sent."
+            }
+        ]
+    )
+    def post(self):
+        return _fanout_request('tab-to-all')
+
+
+class ConvertJsonToAll(Resource):
+
+    """Convert an ISA JSON document to several formats from one parse"""
+    @swagger.operation(
+        summary='Convert ISA JSON to several formats',
+        notes='Parses the input once and produces every requested output format from that parse in parallel. '
+              'Returns a ZIP archive with a directory per target, along with manifest.json giving the status of '
+              'each target. Targets that fail to convert are listed in the manifest with their error',
+        parameters=[
+            {
+                "name": "targets",
+                "description": "Comma separated formats to output, any of tab, sra and sampletab. All of them by "
+                               "default",
+                "required": False,
+                "dataType": "string",
+                "paramType": "query"
+            },
+            {
+                "name": "body",
+                "description": "ISA JSON document, or ZIP archive holding one along with its data files",
+                "required": True,
+                "allowMultiple": False,
+                "dataType": "ISA JSON or ZIP",
+                "supportedContentTypes": ['application/json', 'application/zip'],
+                "paramType": "body"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The outputs and manifest.json are returned in a ZIP archive."
+            },
+            {
+                "code": 400,
+                "message": "Unknown target, or input could not be unpacked."
+            },
+            {
+                "code": 415,
+                "message": "Media not supported. Unexpected MIME type sent."
+            }
+        ]
+    )
+    def post(self):
+        return _fanout_request('json-to-all')
+
+
+class ConfigList(Resource):
+
+    """List the ISA-Tab configurations validation runs against"""
+    @swagger.operation(
+        summary='List ISA configurations',
+        notes='Returns the ISA-Tab configurations in the configuration registry, by measurement and technology type. '
+              'The configurations are held in memory and reloaded when their files change',
+        parameters=[
+            {
+                "name": "measurement",
+                "description": "Only list configurations for this measurement type, e.g. transcription profiling",
+                "required": False,
+                "dataType": "string",
+                "paramType": "query"
+            },
+            {
+                "name": "technology",
+                "description": "Only list configurations for this technology type, e.g. DNA microarray",
+                "required": False,
+                "dataType": "string",
+                "paramType": "query"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The configurations should be in the returned JSON."
+            }
+        ]
+    )
+    def get(self):
+        entries = isarest_configs.registry().entries(request.args.get('measurement'), request.args.get('technology'))
+        return jsonify([{'name': entry.name, 'file': entry.file, 'measurement': entry.measurement,
+                         'technology': entry.technology, 'table_name': entry.table_name,
+                         'href': '/api/v1/configs/' + entry.name} for entry in entries])
+
+
+class ConfigXml(Resource):
+
+    """Fetch an ISA-Tab configuration"""
+    @swagger.operation(
+        summary='Get ISA configuration',
+        notes='Returns the XML of an ISA-Tab configuration from the configuration registry',
+        parameters=[
+            {
+                "name": "name",
+                "description": "Name of the configuration, e.g. transcription_micro",
+                "type": "String",
+                "required": True
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The configuration XML is returned."
+            },
+            {
+                "code": 404,
+                "message": "No such configuration."
+            }
+        ]
+    )
+    def get(self, name):
+        entry = isarest_configs.registry().get(name)
+        if entry is None:
+            return Response(status=404)
+        return Response(entry.xml, mimetype='application/xml')
+
+
+class CacheStats(Resource):
+
+    """Report conversion result cache statistics"""
+    @swagger.operation(
+        summary='Result cache statistics',
+        notes='Returns hit and miss counters, overall and per endpoint, and the current size of the result cache, '
+              'and the same for the validation cache under validation',
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The cache statistics should be in the returned JSON."
+            }
+        ]
+    )
+    def get(self):
+        stats = result_cache.stats()
+        validation_cache = isarest_validation.cache()
+        if validation_cache is not None:
+            stats['validation'] = validation_cache.stats()
+        return jsonify(stats)
+
+
+class AccountingList(Resource):
+
+    """Report the resources recent requests used"""
+    @swagger.operation(
+        summary='Per-request resource accounting',
+        notes='Returns the latest requests handled by this server process, latest first, with their wall and CPU '
+              'time, the growth of the peak resident set size while they ran and the bytes their workspace held. '
+              'Needs the admin token in X-Admin-Token',
+        parameters=[
+            {
+                "name": "resource",
+                "description": "Only report requests to this resource, e.g. /api/v1/convert/tab-to-json",
+                "required": False,
+                "dataType": "string",
+                "paramType": "query"
+            },
+            {
+                "name": "limit",
+                "description": "Requests to report, 100 by default",
+                "required": False,
+                "dataType": "integer",
+                "paramType": "query"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The requests should be in the returned JSON."
+            },
+            {
+                "code": 403,
+                "message": "No admin token, or none is configured."
+            }
+        ]
+    )
+    def get(self):
+        if not _admin(request):
+            return Response(status=403)
+        return jsonify(accounting.recent(request.args.get('resource'), request.args.get('limit', 100, type=int)))
+
+
+class AccountingRecord(Resource):
+
+    """Report the resources a request used"""
+    @swagger.operation(
+        summary='Resource accounting of a request',
+        notes='Returns the resources used by the request answered with this X-Request-Id, by any server process. '
+              'The ID is generated by the server, an X-Request-Id sent by the client is recorded as client_request_id',
+        parameters=[
+            {
+                "name": "request_id",
+                "description": "Request ID",
+                "type": "String",
+                "required": True
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The request should be in the returned JSON."
+            },
+            {
+                "code": 404,
+                "message": "No such request."
+            }
+        ]
+    )
+    def get(self, request_id):
+        entry = accounting.get(request_id)
+        if entry is None:
+            return Response(status=404)
+        return jsonify(entry)
+
+
+class Profile(Resource):
+
+    """Fetch the profile of a conversion"""
+    @swagger.operation(
+        summary='Conversion profile',
+        notes='Returns the profile kept for a conversion requested with ?profile=store, as a report sorted by '
+              'cumulative time, or in pstats format with ?format=pstats. Needs the admin token in X-Admin-Token',
+        parameters=[
+            {
+                "name": "request_id",
+                "description": "Request ID of the profiled conversion",
+                "type": "String",
+                "required": True
+            },
+            {
+                "name": "format",
+                "description": "report (default) or pstats",
+                "required": False,
+                "dataType": "string",
+                "paramType": "query"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The profile should be in the returned text or pstats file."
+            },
+            {
+                "code": 403,
+                "message": "No admin token, or profiling is off."
+            },
+            {
+                "code": 404,
+                "message": "No such profile."
+            }
+        ]
+    )
+    def get(self, request_id):
+        if not _admin(request):
+            return Response(status=403)
+        profile_path = os.path.join(config.PROFILE_FOLDER, secure_filename(request_id) + '.prof')
+        if not os.path.exists(profile_path):
+            return Response(status=404)
+        if request.args.get('format') == 'pstats':
+            return send_file(profile_path, mimetype='application/octet-stream')
+        text = io.StringIO()
+        pstats.Stats(profile_path, stream=text).sort_stats('cumulative').print_stats(50)
+        return Response(text.getvalue(), mimetype='text/plain')
+
+
+class JobSubmit(Resource):
+
+    """Submit a conversion or validation job"""
+    @swagger.operation(
+        summary='Submit an asynchronous conversion or validation job',
+        notes='Queues the request body for conversion or validation on a worker process and returns the job status. '
+              'Poll /api/v2/jobs/{job_id} until the job is finished, then fetch /api/v2/jobs/{job_id}/result',
+        parameters=[
+            {
+                "name": "operation",
+                "description": "Conversion or validation to run, e.g. tab-to-json, json-to-sra or validate-isatab",
+                "required": True,
+                "dataType": "string",
+                "paramType": "query"
+            },
+            {
+                "name": "timeout",
+                "description": "Time limit for the job in seconds, cannot exceed the configured limit",
+                "required": False,
+                "dataType": "integer",
+                "paramType": "query"
+            },
+            {
+                "name": "memory_limit",
+                "description": "Memory ceiling for the job in bytes, cannot exceed the configured limit",
+                "required": False,
+                "dataType": "integer",
+                "paramType": "query"
+            },
+            {
+                "name": "body",
+                "description": "Input of the same type the corresponding /api/v1 resource accepts",
+                "required": True,
+                "allowMultiple": False,
+                "dataType": "ISA tab (ZIP), ISA JSON or SampleTab",
+                "paramType": "body"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 202,
+                "message": "Accepted. The job status should be in the returned JSON."
+            },
+            {
+                "code": 400,
+                "message": "Unknown operation."
+            },
+            {
+                "code": 415,
+                "message": "Media not supported. Unexpected MIME type sent."
+            }
+        ]
+    )
+    def post(self):
+        operation = request.args.get('operation')
+        if operation not in CONVERTERS or not enabled(operation):
+            return Response(status=400)
+        converter = CONVERTERS[operation]
+        if converter.mimetype is not None and request.mimetype != converter.mimetype:
+            return Response(status=415)
+        job_id, job_dir = job_manager.create(operation)
+        error = None
+        try:
+            file_path = _write_request_data(request, job_dir, converter.upload_name)
+            if file_path is None:
+                raise IOError("Could not create temporary file " + converter.upload_name)
+            job_manager.submit(job_id, file_path, timeout=request.args.get('timeout', type=int),
+                               memory_limit=request.args.get('memory_limit', type=int))
+        except HTTPException as e:
+            error = str(e)
+            return Response(status=e.code)
+        except Exception as e:
+            error = str(e) or repr(e)
+            _log_error(e, exc_info=True)
+            return Response(status=500)
+        finally:
+            if error is not None:
+                job_manager.abandon(job_id, error)
+        response = jsonify(job_manager.status(job_id))
+        response.status_code = 202
+        response.headers['Location'] = '/api/v2/jobs/' + job_id
+        return response
+
+
+class JobStatus(Resource):
+
+    """Report the status of a job"""
+    @swagger.operation(
+        summary='Get job status',
+        notes='Returns the status of a job: created, queued, running, finished or failed',
+        parameters=[
+            {
+                "name": "job_id",
+                "description": "Job ID",
+                "type": "String",
+                "required": True
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The job status should be in the returned JSON."
+            },
+            {
+                "code": 404,
+                "message": "No such job."
+            }
+        ]
+    )
+    def get(self, job_id):
+        status = job_manager.status(job_id)
+        if status is None:
+            return Response(status=404)
+        return jsonify(status)
+
+
+class JobResult(Resource):
+
+    """Fetch the output of a finished job"""
+    @swagger.operation(
+        summary='Get job result',
+        notes='Returns the output of a finished job, in the same format the corresponding /api/v1 resource returns',
+        parameters=[
+            {
+                "name": "job_id",
+                "description": "Job ID",
+                "type": "String",
+                "required": True
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The job output is returned."
+            },
+            {
+                "code": 404,
+                "message": "No such job."
+            },
+            {
+                "code": 409,
+                "message": "Job is not finished. The job status should be in the returned JSON."
+            }
+        ]
+    )
+    def get(self, job_id):
+        status = job_manager.status(job_id)
+        if status is None:
+            return Response(status=404)
+        result_path = job_manager.result_path(job_id)
+        if result_path is None:
+            response = jsonify(status)
+            response.status_code = 409
+            return response
+        return send_file(result_path, mimetype=CONVERTERS[status['operation']].output_mimetype)
+
+
+class ConvertBatch(Resource):
+
+    """Convert or validate many inputs in one request"""
+    @swagger.operation(
+        summary='Batch conversion or validation',
+        notes='Runs the operation on every uploaded input in parallel on the worker processes and returns a ZIP '
+              'archive of the outputs, along with manifest.json giving the status of each input. Inputs that fail '
+              'to convert are listed in the manifest with their error and do not fail the batch',
+        parameters=[
+            {
+                "name": "operation",
+                "description": "Conversion or validation to run, e.g. tab-to-json, json-to-sra or validate-isatab",
+                "required": True,
+                "dataType": "string",
+                "paramType": "path"
+            },
+            {
+                "name": "body",
+                "description": "Inputs as multipart/form-data files, or as a ZIP archive (application/zip) holding one "
+                               "input per member, each of the type the corresponding /api/v1 resource accepts",
+                "required": True,
+                "allowMultiple": False,
+                "dataType": "multipart/form-data or ZIP",
+                "paramType": "body"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The outputs and manifest.json are returned in a ZIP archive."
+            },
+            {
+                "code": 400,
+                "message": "No inputs found in the request."
+            },
+            {
+                "code": 404,
+                "message": "Unknown operation."
+            },
+            {
+                "code": 413,
+                "message": "Too many inputs in one batch."
+            },
+            {
+                "code": 415,
+                "message": "Media not supported. Unexpected MIME type sent."
+            }
+        ]
+    )
+    def post(self, operation):
+        if operation not in CONVERTERS or not enabled(operation):
+            return Response(status=404)
+        if request.mimetype not in ('multipart/form-data', 'application/zip'):
+            return Response(status=415)
+        try:
+            tmp_dir = _request_workspace()
+            with isarest_metrics.phase('ingest'):
+                items = _batch_items(request, tmp_dir, CONVERTERS[operation])
+            if not items:
+                return Response(status=400)
+            with isarest_metrics.phase('convert'):
+                results = job_manager.run_batch(operation, [(src_path, item_dir) for _, src_path, item_dir in items],
+                                                timeout=request.args.get('timeout', type=int),
+                                                memory_limit=request.args.get('memory_limit', type=int))
+            out_dir = os.path.join(tmp_dir, 'batch')
+            os.mkdir(out_dir)
+            manifest = []
+            taken = {'manifest'}
+            for (name, _, _), (result_path, error) in zip(items, results):
+                entry = {'name': name, 'operation': operation}
+                if error is None:
+                    result_name = _unique_name(os.path.splitext(name)[0] + os.path.splitext(result_path)[1], taken)
+                    shutil.move(result_path, os.path.join(out_dir, result_name))
+                    entry.update(status='finished', result=result_name)
+                else:
+                    entry.update(status='failed', error=error)
+                manifest.append(entry)
+            with open(os.path.join(out_dir, 'manifest.json'), 'w') as manifest_fp:
+                json.dump(manifest, manifest_fp, indent=2)
+            return _send_output(out_dir, 'application/zip')
+        except HTTPException as e:
+            return Response(status=e.code)
+        except UnsafeArchive as e:
+            _log_error(e)
+            return Response(status=413)
+        except zipfile.BadZipFile as e:
+            _log_error(e)
+            return Response(status=400)
+        except Exception as e:
+            _log_error(e, exc_info=True)
+            return Response(status=500)
+
+
+class SessionCreate(Resource):
+
+    """Upload an ISA-Tab or ISA-JSON input once to run several operations on"""
+    @swagger.operation(
+        summary='Open an upload-once session',
+        notes='Unpacks the request body into a session and returns the session, with the operations that can be run '
+              'on it by posting to /api/v1/sessions/{session_id}/{operation}. The input is parsed on the first such '
+              'operation and the parsed model reused by the following ones. Sessions expire once unused for a while',
+        parameters=[
+            {
+                "name": "kind",
+                "description": "isatab (default) for a ZIP of ISA-Tab, json for a ZIP holding an ISA-JSON document "
+                               "and its data files. Implied by an application/json body",
+                "required": False,
+                "dataType": "string",
+                "paramType": "query"
+            },
+            {
+                "name": "body",
+                "description": "ISA-Tab ZIP archive, ISA-JSON document, or ZIP archive of an ISA-JSON document",
+                "required": True,
+                "allowMultiple": False,
+                "dataType": "ISA tab (ZIP) or ISA JSON",
+                "supportedContentTypes": ['application/zip', 'application/json'],
+                "paramType": "body"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 201,
+                "message": "Created. The session should be in the returned JSON."
+            },
+            {
+                "code": 400,
+                "message": "Input could not be unpacked."
+            },
+            {
+                "code": 415,
+                "message": "Media not supported. Unexpected MIME type sent."
+            },
+            {
+                "code": 503,
+                "message": "Too many sessions open."
+            }
+        ]
+    )
+    def post(self):
+        if request.mimetype == 'application/json':
+            kind = 'json'
+        elif request.mimetype == 'application/zip':
+            kind = request.args.get('kind', 'isatab')
+        else:
+            return Response(status=415)
+        if kind not in ('isatab', 'json'):
+            return Response(status=400)
+        try:
+            upload_path, _ = _ingest_request(request)
+            with isarest_metrics.phase('unpack'):
+                session = session_manager.create(kind, upload_path)
+        except HTTPException as e:
+            return Response(status=e.code)
+        except UnsafeArchive as e:
+            _log_error(e)
+            return Response(status=413)
+        except TooManySessions as e:
+            _log_error(e)
+            return Response(status=503)
+        except (IOError, zipfile.BadZipFile) as e:
+            _log_error(e)
+            return Response(status=400)
+        except Exception as e:
+            _log_error(e, exc_info=True)
+            return Response(status=500)
+        response = jsonify(session)
+        response.status_code = 201
+        response.headers['Location'] = '/api/v1/sessions/' + session['id']
+        return response
+
+
+class SessionStatus(Resource):
+
+    """Report on or close a session"""
+    @swagger.operation(
+        summary='Get session',
+        notes='Returns the session, whether its input has been parsed in this server process, the operations that '
+              'can be run on it and when it expires',
+        parameters=[
+            {
+                "name": "session_id",
+                "description": "Session ID",
+                "type": "String",
+                "required": True
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The session should be in the returned JSON."
+            },
+            {
+                "code": 404,
+                "message": "No such session."
+            }
+        ]
+    )
+    def get(self, session_id):
+        session = session_manager.status(session_id)
+        if session is None:
+            return Response(status=404)
+        return jsonify(session)
+
+    @swagger.operation(
+        summary='Close session',
+        notes='Removes the session and its input',
+        parameters=[
+            {
+                "name": "session_id",
+                "description": "Session ID",
+                "type": "String",
+                "required": True
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 204,
+                "message": "Session closed."
+            },
+            {
+                "code": 404,
+                "message": "No such session."
+            }
+        ]
+    )
+    def delete(self, session_id):
+        if not session_manager.delete(session_id):
+            return Response(status=404)
+        return Response(status=204)
+
+
+class SessionOperation(Resource):
+
+    """Run a conversion or validation on the input of a session"""
+    @swagger.operation(
+        summary='Convert or validate the input of a session',
+        notes='Returns the output of the operation on the session input, in the same format the corresponding '
+              '/api/v1 resource returns, without uploading or parsing the input again',
+        parameters=[
+            {
+                "name": "session_id",
+                "description": "Session ID",
+                "type": "String",
+                "required": True
+            },
+            {
+                "name": "operation",
+                "description": "Conversion or validation to run, one of the operations listed in the session",
+                "required": True,
+                "dataType": "string",
+                "paramType": "path"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The output of the operation is returned."
+            },
+            {
+                "code": 400,
+                "message": "Operation cannot be run on this kind of input."
+            },
+            {
+                "code": 404,
+                "message": "No such session."
+            }
+        ]
+    )
+    def post(self, session_id, operation):
+        parsed = session_manager.get(session_id)
+        if parsed is None:
+            return Response(status=404)
+        if operation not in MODEL_OPERATIONS[parsed.kind] or not enabled(operation):
+            return Response(status=400)
+        try:
+            tmp_dir = _request_workspace()
+            with admission.admit(operation), isarest_metrics.phase('convert'):
+                output_path = parsed.run(operation, tmp_dir)
+            return _send_output(output_path, CONVERTERS[operation].output_mimetype)
+        except HTTPException as e:
+            return Response(status=e.code)
+        except Overloaded as e:
+            return _overloaded(e)
+        except Exception as e:
+            _log_error(e, exc_info=True)
+            return Response(status=500)
+
+
+class UploadCreate(Resource):
+
+    """Start a resumable upload"""
+    @swagger.operation(
+        summary='Start a resumable upload',
+        notes='Returns the new upload. Its chunks are then sent, numbered from 0 to below its max_chunks, to '
+              '/api/v1/uploads/{upload_id}/chunks/{index}, each of them as often as needed, and the upload completed '
+              'by posting to /api/v1/uploads/{upload_id}/complete. Any conversion or validation then takes the '
+              'upload in place of a request body, named in an X-Upload-Id header, until the upload expires',
+        parameters=[
+            {
+                "name": "body",
+                "description": "Optional JSON object with the size in bytes and the hex SHA-256 digest of the whole "
+                               "upload, checked when it is completed, e.g. {\"size\": 1048576, \"sha256\": \"...\"}",
+                "required": False,
+                "allowMultiple": False,
+                "dataType": "JSON",
+                "supportedContentTypes": ['application/json'],
+                "paramType": "body"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 201,
+                "message": "Created. The upload should be in the returned JSON."
+            },
+            {
+                "code": 400,
+                "message": "Size or digest given are not valid."
+            },
+            {
+                "code": 413,
+                "message": "Upload too large."
+            },
+            {
+                "code": 503,
+                "message": "Too many uploads open."
+            }
+        ]
+    )
+    def post(self):
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            return Response(status=400)
+        size, sha256 = body.get('size'), body.get('sha256')
+        if size is not None and (not isinstance(size, int) or size < 0) or \
+                sha256 is not None and not isinstance(sha256, str):
+            return Response(status=400)
+        try:
+            upload = upload_manager.create(size, sha256)
+        except UploadTooLarge as e:
+            _log_error(e)
+            return Response(status=413)
+        except TooManyUploads as e:
+            _log_error(e)
+            return Response(status=503)
+        response = jsonify(upload)
+        response.status_code = 201
+        response.headers['Location'] = '/api/v1/uploads/' + upload['id']
+        return response
+
+
+class UploadStatus(Resource):
+
+    """Report on or remove a resumable upload"""
+    @swagger.operation(
+        summary='Get upload',
+        notes='Returns the upload, with the chunks received so far to resume it from, whether it is complete and '
+              'when it expires',
+        parameters=[
+            {
+                "name": "upload_id",
+                "description": "Upload ID",
+                "type": "String",
+                "required": True
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The upload should be in the returned JSON."
+            },
+            {
+                "code": 404,
+                "message": "No such upload."
+            }
+        ]
+    )
+    def get(self, upload_id):
+        upload = upload_manager.status(upload_id)
+        if upload is None:
+            return Response(status=404)
+        return jsonify(upload)
+
+    @swagger.operation(
+        summary='Remove upload',
+        notes='Removes the upload and its chunks',
+        parameters=[
+            {
+                "name": "upload_id",
+                "description": "Upload ID",
+                "type": "String",
+                "required": True
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 204,
+                "message": "Upload removed."
+            },
+            {
+                "code": 404,
+                "message": "No such upload."
+            }
+        ]
+    )
+    def delete(self, upload_id):
+        if not upload_manager.delete(upload_id):
+            return Response(status=404)
+        return Response(status=204)
+
+
+class UploadChunk(Resource):
+
+    """Send a chunk of a resumable upload"""
+    @swagger.operation(
+        summary='Send upload chunk',
+        notes='Stores the request body as chunk {index} of the upload, replacing the chunk if it was sent before, '
+              'and returns the upload. Chunks are numbered below the max_chunks of the upload, and the chunks '
+              'stored for an upload may add up to RESUMABLE_UPLOAD_MAX_SIZE bytes at most',
+        parameters=[
+            {
+                "name": "upload_id",
+                "description": "Upload ID",
+                "type": "String",
+                "required": True
+            },
+            {
+                "name": "index",
+                "description": "Number of the chunk, from 0",
+                "type": "Integer",
+                "required": True
+            },
+            {
+                "name": "X-Chunk-Sha256",
+                "description": "Hex SHA-256 digest of the chunk",
+                "required": True,
+                "dataType": "string",
+                "paramType": "header"
+            },
+            {
+                "name": "body",
+                "description": "Bytes of the chunk",
+                "required": True,
+                "allowMultiple": False,
+                "dataType": "bytes",
+                "supportedContentTypes": ['application/octet-stream'],
+                "paramType": "body"
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The upload should be in the returned JSON."
+            },
+            {
+                "code": 400,
+                "message": "No digest given, or the chunk does not match it. The chunk should be sent again."
+            },
+            {
+                "code": 404,
+                "message": "No such upload."
+            },
+            {
+                "code": 409,
+                "message": "Upload already complete."
+            },
+            {
+                "code": 413,
+                "message": "Chunk too large, index beyond max_chunks, or upload too large."
+            },
+            {
+                "code": 503,
+                "message": "Disk quota used up. The chunk should be sent again later."
+            }
+        ]
+    )
+    def put(self, upload_id, index):
+        sha256 = request.headers.get('X-Chunk-Sha256')
+        if not sha256:
+            return Response(status=400)
+        body = isarest_compression.decoded_stream(request.stream, request.headers.get('Content-Encoding'))
+        if body is None:
+            return Response(status=415)
+        try:
+            upload = upload_manager.put_chunk(upload_id, index, body, sha256)
+        except WorkspaceQuotaExceeded as e:  # an IOError, as some of the decode errors are
+            _log_error(e)
+            return Response(status=503)
+        except (ChunkChecksumMismatch,) + isarest_compression.DECODE_ERRORS as e:
+            _log_error(e)
+            return Response(status=400)
+        except UploadTooLarge as e:
+            _log_error(e)
+            return Response(status=413)
+        except UploadError as e:
+            _log_error(e)
+            return Response(status=409)
+        if upload is None:
+            return Response(status=404)
+        return jsonify(upload)
+
+
+class UploadComplete(Resource):
+
+    """Complete a resumable upload"""
+    @swagger.operation(
+        summary='Complete upload',
+        notes='Joins the chunks of the upload and checks the result against the size and digest given when the '
+              'upload was started. Returns the upload, which requests to the conversion and validation resources can '
+              'then name in an X-Upload-Id header instead of sending a body',
+        parameters=[
+            {
+                "name": "upload_id",
+                "description": "Upload ID",
+                "type": "String",
+                "required": True
+            }
+        ],
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The upload should be in the returned JSON."
+            },
+            {
+                "code": 404,
+                "message": "No such upload."
+            },
+            {
+                "code": 409,
+                "message": "Chunks are missing, or the upload does not match its size or digest."
+            },
+            {
+                "code": 413,
+                "message": "Upload too large."
+            }
+        ]
+    )
+    def post(self, upload_id):
+        try:
+            upload = upload_manager.complete(upload_id)
+        except UploadTooLarge as e:
+            _log_error(e)
+            return Response(status=413)
+        except UploadIncomplete as e:
+            _log_error(e)
+            return Response(status=409)
+        if upload is None:
+            return Response(status=404)
+        return jsonify(upload)
+
+
+class Metrics(Resource):
+
+    """Report service metrics for Prometheus"""
+    @swagger.operation(
+        summary='Service metrics',
+        notes='Returns request counters, request and per-phase (ingest, unpack, convert, pack, serialize) latency '
+              'histograms, bytes in and out per resource, in-flight requests and workspace disk usage in the '
+              'Prometheus text exposition format. The counters and histograms add up those of all server '
+              'processes of the node, including exited ones, and the in-flight requests those of the running ones. '
+              'Workspace and admission gauges are the node-wide values as seen by the process answering',
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The metrics should be in the returned text."
+            }
+        ]
+    )
+    def get(self):
+        stats = workspace_manager.stats()
+        isarest_metrics.workspace_bytes.set(stats['bytes_used'])
+        isarest_metrics.workspace_quota.set(stats['quota'])
+        isarest_metrics.workspaces.set(stats['busy'], 'busy')
+        isarest_metrics.workspaces.set(stats['idle'], 'idle')
+        for operation, counts in admission.stats().items():
+            isarest_metrics.admission_limit.set(counts['limit'], operation)
+            isarest_metrics.admission_running.set(counts['running'], operation)
+            isarest_metrics.admission_waiting.set(counts['waiting'], operation)
+        return Response(isarest_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+class StartupReport(Resource):
+
+    """Report what this server process has imported so far and how long each import took"""
+    @swagger.operation(
+        summary='Startup time report',
+        notes='Returns the enabled endpoints, those whose converter modules are already imported, and the time '
+              'each converter module import took, in the order they were imported',
+        responseMessages=[
+            {
+                "code": 200,
+                "message": "OK. The report should be in the returned JSON."
+            }
+        ]
+    )
+    def get(self):
+        return jsonify(startup_report())
+
+
+def _count_bytes_out(chunks, resource):
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        isarest_metrics.bytes_out.inc(sent, resource)
+
+
+result_cache = ResultCache(config.RESULT_CACHE_FOLDER, config.RESULT_CACHE_MAX_BYTES)
+in_flight = InFlight(os.path.join(config.RESULT_CACHE_FOLDER, 'in-flight'))
+workspace_manager = WorkspaceManager(config.WORKSPACE_FOLDER, config.WORKSPACE_POOL_SIZE, config.WORKSPACE_QUOTA,
+                                     config.WORKSPACE_MAX_AGE, config.WORKSPACE_REAP_INTERVAL)
+job_manager = JobManager(config.JOB_FOLDER, config.JOB_WORKERS, config.JOB_TIMEOUT, config.JOB_MEMORY_LIMIT,
+                         config.JOB_RETENTION)
+mw_importer = MWImporter(config.MW_CACHE_FOLDER, config.MW_CACHE_TTL,
+                         stub_import(config.MW_STUB_FOLDER) if config.MW_STUB_FOLDER else mw2isa_import,
+                         config.MW_PREFETCH_WORKERS, config.ADMISSION_QUEUE_TIMEOUT)
+session_manager = SessionManager(config.SESSION_FOLDER, config.SESSION_TTL, config.SESSION_MAX,
+                                 config.SESSION_MAX_PARSED)
+accounting = Accounting(config.ACCOUNTING_MAX_RECORDS, config.ACCOUNTING_LOG, config.ACCOUNTING_LOG_MAX_BYTES)
+admission = AdmissionController(config.ADMISSION_FOLDER, configured_limits(), config.ADMISSION_QUEUE_SIZE,
+                                config.ADMISSION_QUEUE_TIMEOUT)
+upload_manager = UploadManager(config.RESUMABLE_UPLOAD_FOLDER, config.RESUMABLE_UPLOAD_TTL, config.RESUMABLE_UPLOAD_MAX,
+                               config.RESUMABLE_UPLOAD_MAX_SIZE, config.RESUMABLE_UPLOAD_MAX_CHUNK_SIZE,
+                               workspace_manager.bytes_free)
+workspace_manager.count_usage(upload_manager.bytes_stored)  # uploads share the disk quota of the workspaces
+isarest_metrics.configure(config.METRICS_FOLDER)
+
+app = Flask(__name__)
+app.config.from_object(config)
+
+
+def _metrics_resource():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@app.before_request
+def _start_accounting():
+    g.request_id = str(uuid.uuid4())  # never the client's, which could collide with the records of other requests
+    g.usage = Usage()
+
+
+@app.after_request
+def _account_request(response):
+    """Record the resources the request used once its response has been sent, see isarest_accounting.py"""
+    if 'usage' not in g:
+        return response
+    response.headers['X-Request-Id'] = g.request_id
+    entry = {'request_id': g.request_id, 'resource': _metrics_resource(), 'method': request.method,
+             'status': response.status_code, 'started': g.usage.started,
+             'workspace_bytes': workspace_manager.usage(g.workspace_path) if 'workspace_path' in g else 0}
+    client_request_id = request.headers.get('X-Request-Id', '')
+    if REQUEST_ID.match(client_request_id):
+        entry['client_request_id'] = client_request_id  # for clients to correlate, never looked up by
+    usage = g.usage
+
+    def record():
+        entry.update(usage.finish())
+        isarest_metrics.request_cpu.inc(entry['cpu_seconds'], entry['resource'])
+        isarest_metrics.request_rss_growth.observe(entry['peak_rss_growth'], entry['resource'])
+        accounting.record(entry)
+    if response.direct_passthrough:
+        record()  # werkzeug hands such a file straight to the server and never closes the response
+    else:
+        response.call_on_close(record)
+    return response
+
+
+@app.before_request
+def _start_metrics():
+    g.request_started = time.time()
+    isarest_metrics.in_flight.inc(1)
+    isarest_metrics.begin(_metrics_resource())
+
+
+@app.after_request
+def _count_request(response):
+    resource = _metrics_resource()
+    isarest_metrics.requests_total.inc(1, resource, str(response.status_code))
+    isarest_metrics.bytes_in.inc(g.get('upload_size', request.content_length or 0), resource)
+    if response.content_length is not None:
+        isarest_metrics.bytes_out.inc(response.content_length, resource)
+    elif not response.direct_passthrough:
+        # streamed, only known once the whole body has been sent
+        response.response = _count_bytes_out(response.iter_encoded(), resource)
+    if not response.direct_passthrough:
+        response.call_on_close(isarest_metrics.flush)  # after the metrics recorded while the body was sent
+    return response
+
+
+@app.after_request
+def _compress_response(response):
+    """Compress JSON and TSV responses with the best content coding the request accepts
+
+    Registered after _count_request so it runs before it, and bytes sent are counted compressed. Responses known to be
+    smaller than COMPRESSION_MIN_SIZE go out as they are. The body is compressed a chunk at a time as it is sent, so
+    the response loses its Content-Length.
+    """
+    if response.status_code != 200 or response.mimetype not in config.COMPRESSION_MIMETYPES or \
+            'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < config.COMPRESSION_MIN_SIZE:
+        return response
+    encoding = isarest_compression.negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    body = response.response
+    response.response = isarest_compression.compressed(response.iter_encoded(), encoding)
+    if hasattr(body, 'close'):
+        response.call_on_close(body.close)  # e.g. the file of a send_file response, no longer closed by werkzeug
+    response.direct_passthrough = False
+    response.headers.pop('Content-Length', None)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag('{}-{}'.format(etag, encoding), weak)
+    return response
+
+
+@app.teardown_request
+def _stop_metrics(exception):
+    if 'request_started' in g:
+        isarest_metrics.in_flight.inc(-1)
+        isarest_metrics.request_duration.observe(time.time() - g.request_started, _metrics_resource())
+    isarest_metrics.end()
+    isarest_metrics.flush()
+
+
+@app.teardown_request
+def _release_workspace(exception):
+    workspace = g.pop('workspace', None)
+    if workspace is not None:
+        workspace_manager.release(workspace)
+
 
 api = swagger.docs(Api(app), apiVersion='0.8')
-api.add_resource(ConvertTabToJson, '/api/v1/convert/tab-to-json')
-api.add_resource(ConvertJsonToTab, '/api/v1/convert/json-to-tab')
-api.add_resource(ConvertTabToSra, '/api/v1/convert/tab-to-sra')
-api.add_resource(ConvertJsonToSra, '/api/v1/convert/json-to-sra')
-api.add_resource(ConvertTabToCedar, '/api/v1/convert/tab-to-cedar')
-api.add_resource(ValidateIsaJSON, '/api/v1/validate/json')
-api.add_resource(ValidateIsaTab, '/api/v1/validate/isatab')
-api.add_resource(ImportMWToIsaTab, '/api/v1/import/mw/<studyid>')
-api.add_resource(ConvertSampleTabToIsaTab, '/api/v1/convert/sampletab-to-isatab')
-api.add_resource(ConvertSampleTabToJson, '/api/v1/convert/sampletab-to-json')
-api.add_resource(ConvertJsonToSampleTab, '/api/v1/convert/json-to-sampletab')
-api.add_resource(ConvertIsaTabToSampleTab, '/api/v1/convert/isatab-to-sampletab')
-api.add_resource(ConvertMageTabToJson, '/api/v1/convert/magetab-to-json')
+# endpoints that can be switched off with ENABLED_ENDPOINTS, by operation
+for operation, resource, path in [
+    ('tab-to-json', ConvertTabToJson, '/api/v1/convert/tab-to-json'),
+    ('json-to-tab', ConvertJsonToTab, '/api/v1/convert/json-to-tab'),
+    ('tab-to-sra', ConvertTabToSra, '/api/v1/convert/tab-to-sra'),
+    ('json-to-sra', ConvertJsonToSra, '/api/v1/convert/json-to-sra'),
+    ('tab-to-cedar', ConvertTabToCedar, '/api/v1/convert/tab-to-cedar'),
+    ('validate-json', ValidateIsaJSON, '/api/v1/validate/json'),
+    ('validate-isatab', ValidateIsaTab, '/api/v1/validate/isatab'),
+    ('import-mw', ImportMWToIsaTab, '/api/v1/import/mw/<studyid>'),
+    ('import-mw', ImportMWPrefetch, '/api/v1/import/mw'),
+    ('sampletab-to-isatab', ConvertSampleTabToIsaTab, '/api/v1/convert/sampletab-to-isatab'),
+    ('sampletab-to-json', ConvertSampleTabToJson, '/api/v1/convert/sampletab-to-json'),
+    ('json-to-sampletab', ConvertJsonToSampleTab, '/api/v1/convert/json-to-sampletab'),
+    ('isatab-to-sampletab', ConvertIsaTabToSampleTab, '/api/v1/convert/isatab-to-sampletab'),
+    ('magetab-to-json', ConvertMageTabToJson, '/api/v1/convert/magetab-to-json'),
+    ('tab-to-all', ConvertTabToAll, '/api/v1/convert/tab-to-all'),
+    ('json-to-all', ConvertJsonToAll, '/api/v1/convert/json-to-all')
+]:
+    if enabled(operation):
+        api.add_resource(resource, path)
+api.add_resource(CacheStats, '/api/v1/cache/stats')
+api.add_resource(ConfigList, '/api/v1/configs')
+api.add_resource(ConfigXml, '/api/v1/configs/<name>')
+api.add_resource(ConvertBatch, '/api/v1/batch/<operation>')
+api.add_resource(SessionCreate, '/api/v1/sessions')
+api.add_resource(SessionStatus, '/api/v1/sessions/<session_id>')
+api.add_resource(SessionOperation, '/api/v1/sessions/<session_id>/<operation>')
+api.add_resource(UploadCreate, '/api/v1/uploads')
+api.add_resource(UploadStatus, '/api/v1/uploads/<upload_id>')
+api.add_resource(UploadChunk, '/api/v1/uploads/<upload_id>/chunks/<int:index>')
+api.add_resource(UploadComplete, '/api/v1/uploads/<upload_id>/complete')
+api.add_resource(AccountingList, '/api/v1/accounting')
+api.add_resource(AccountingRecord, '/api/v1/accounting/<request_id>')
+api.add_resource(Profile, '/api/v1/profiles/<request_id>')
+api.add_resource(Metrics, '/metrics')
+api.add_resource(StartupReport, '/api/v1/startup')
+api.add_resource(JobSubmit, '/api/v2/jobs')
+api.add_resource(JobStatus, '/api/v2/jobs/<job_id>')
+api.add_resource(JobResult, '/api/v2/jobs/<job_id>/result')
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=config.PORT, debug=config.DEBUG)
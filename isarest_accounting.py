@@ -0,0 +1,161 @@
+"""
+Per-request resource accounting, and profiling of single conversions.
+
+Every request is accounted wall and CPU time, the growth of the server process's peak resident set size while it ran,
+and the bytes its workspace held when it was answered. Records are kept in memory, the latest ACCOUNTING_MAX_RECORDS of
+them per server process, and appended to ACCOUNTING_LOG as JSON lines for all processes to share. The log is rotated to
+ACCOUNTING_LOG.1 once it reaches ACCOUNTING_LOG_MAX_BYTES, so looking a record up reads at most twice that.
+
+The peak is reset at the start of a request where Linux allows it, so the growth is exact for a process handling one
+request at a time, as gunicorn's sync workers do. Requests overlapping in one process see each other's allocations.
+"""
+import io
+import os
+import logging
+import json
+import fcntl
+import time
+import pstats
+import cProfile
+import resource
+import threading
+import contextlib
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def _status_bytes(field):
+    """Value of field, e.g. VmRSS or VmHWM, of /proc/self/status in bytes, None without procfs"""
+    try:
+        with open('/proc/self/status') as status_fp:
+            for line in status_fp:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak():
+    """Reset the peak resident set size of this process to its current one
+    :return: False if the kernel does not allow it
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_fp:
+            clear_refs_fp.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    peak = _status_bytes('VmHWM')
+    if peak is None:  # reported in KiB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+
+class Usage:
+
+    """Resources used by the calling thread from when it was created until finish is called"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.cpu_started = time.thread_time()
+        self.peak_reset = _reset_peak()
+        self.rss_started = _status_bytes('VmRSS') if self.peak_reset else None
+        self.peak_started = _peak_rss()
+
+    def finish(self):
+        """
+        :return: Dict of wall_seconds, cpu_seconds and peak_rss_growth, the bytes the peak resident set size grew by
+        """
+        peak = _peak_rss()
+        base = self.rss_started if self.rss_started is not None else self.peak_started
+        return {'wall_seconds': time.time() - self.started, 'cpu_seconds': time.thread_time() - self.cpu_started,
+                'peak_rss_growth': max(peak - base, 0)}
+
+
+class Accounting:
+
+    def __init__(self, max_records, log_path=None, log_max_bytes=None):
+        self.log_path = log_path
+        self.log_max_bytes = log_max_bytes
+        self._records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def record(self, entry):
+        """Keep entry, a dict holding at least request_id and resource"""
+        with self._lock:
+            self._records.append(entry)
+            if self.log_path is not None:
+                try:
+                    self._append(json.dumps(entry) + '\n')
+                except OSError as e:
+                    logger.error("Could not log request %s: %s", entry.get('request_id'), e)
+
+    def _append(self, line):
+        with open(self.log_path, 'a') as log_fp:
+            fcntl.flock(log_fp, fcntl.LOCK_EX)  # released when closed, serializes rotation across processes
+            size = os.fstat(log_fp.fileno()).st_size
+            if self.log_max_bytes is None or size + len(line) <= self.log_max_bytes or size == 0 or \
+                    os.stat(self.log_path).st_ino != os.fstat(log_fp.fileno()).st_ino:  # rotated while waiting
+                log_fp.write(line)
+                return
+            os.replace(self.log_path, self.log_path + '.1')
+        with open(self.log_path, 'a') as log_fp:
+            log_fp.write(line)
+
+    def recent(self, resource=None, limit=100):
+        """
+        :return: List of the latest limit records of this process, for resource if given, latest first
+        """
+        with self._lock:
+            records = [entry for entry in reversed(self._records) if resource is None or entry['resource'] == resource]
+        return records[:limit]
+
+    def get(self, request_id):
+        """
+        :return: Record of request_id, looked up in this process and then in the log and its rotated predecessor, None
+            if there is none
+        """
+        with self._lock:
+            for entry in reversed(self._records):
+                if entry['request_id'] == request_id:
+                    return entry
+        if self.log_path is None:
+            return None
+        for log_path in (self.log_path, self.log_path + '.1'):
+            try:
+                with open(log_path) as log_fp:
+                    for line in log_fp:
+                        if request_id in line:
+                            try:
+                                entry = json.loads(line)
+                            except ValueError:
+                                continue
+                            if entry.get('request_id') == request_id:
+                                return entry  # request IDs are generated by the server, so unique
+            except OSError:
+                pass
+        return None
+
+
+@contextlib.contextmanager
+def profiled(out_path):
+    """Profile the body of the with statement with cProfile, writing the statistics to out_path in pstats format
+
+    :return: Context manager yielding a list, to which the report sorted by cumulative time is appended on exit
+    """
+    report = []
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield report
+    finally:
+        profile.disable()
+        profile.dump_stats(out_path)
+        text = io.StringIO()
+        pstats.Stats(profile, stream=text).sort_stats('cumulative').print_stats(50)
+        report.append(text.getvalue())
@@ -0,0 +1,162 @@
+"""
+Admission control: a limit on the conversions of each operation running at a time on a node, with a bounded queue.
+
+Running and waiting requests each hold a lock file, <lock_dir>/<operation>.run.<n> or <operation>.wait.<n>, so the
+limits hold across every server process sharing lock_dir, and locks of processes that die are released with them. The
+holder of a slot writes its pid into the file, so slots can be counted without taking their locks, which would make
+requests trying to take them at the same moment find them held. A
+request finding every run slot taken waits in a wait slot, polling for a run slot to free up. One finding every wait
+slot taken as well, or waiting longer than the queue timeout, is turned away with Overloaded, carrying the seconds
+after which a retry can be expected to get in.
+"""
+import os
+import math
+import time
+import fcntl
+import threading
+import contextlib
+
+import config
+import isarest_metrics
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Overloaded(Exception):
+
+    def __init__(self, message, retry_after):
+        super(Overloaded, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def configured_limits():
+    """
+    :return: Dict of operation -> conversions that may run at a time, ADMISSION_MEMORY_BUDGET divided by the
+        operation's ADMISSION_MEMORY_COST unless set in ADMISSION_LIMITS
+    """
+    limits = {operation: max(1, config.ADMISSION_MEMORY_BUDGET // cost)
+              for operation, cost in config.ADMISSION_MEMORY_COST.items()}
+    limits.update(config.ADMISSION_LIMITS)
+    return limits
+
+
+class AdmissionController:
+
+    def __init__(self, lock_dir, limits, queue_size, queue_timeout, poll_interval=0.05):
+        """
+        :param limits: Dict of operation -> conversions that may run at a time, operations not in it are not limited
+        :param queue_size: Requests per operation that may wait for a conversion to finish
+        :param queue_timeout: Seconds a request may wait
+        """
+        self.lock_dir = lock_dir
+        self.limits = limits
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.poll_interval = poll_interval
+        self._durations = dict()  # operation -> moving average of the seconds a conversion runs, in this process
+        self._lock = threading.Lock()
+        if not os.path.exists(lock_dir):
+            os.makedirs(lock_dir)
+
+    def _path(self, operation, kind, n):
+        return os.path.join(self.lock_dir, '{}.{}.{}'.format(operation, kind, n))
+
+    def _take(self, operation, kind, count):
+        """
+        :return: File object holding the first of count slots of kind that was free, None if none was
+        """
+        for n in range(count):
+            slot_fp = open(self._path(operation, kind, n), 'a')
+            try:
+                fcntl.flock(slot_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)  # released when closed
+            except BlockingIOError:
+                slot_fp.close()
+                continue
+            slot_fp.truncate(0)
+            slot_fp.write(str(os.getpid()))
+            slot_fp.flush()
+            return slot_fp
+        return None
+
+    @staticmethod
+    def _give_back(slot_fp):
+        slot_fp.truncate(0)  # before the lock is released, so the slot is never seen free and marked
+        slot_fp.close()
+
+    def _held(self, operation, kind, count):
+        """Count the slots marked with the pid of a live process, leaving their locks alone"""
+        held = 0
+        for n in range(count):
+            try:
+                with open(self._path(operation, kind, n)) as slot_fp:
+                    pid = slot_fp.read()
+            except OSError:
+                continue
+            if pid.isdigit() and _pid_alive(int(pid)):
+                held += 1
+        return held
+
+    def _reject(self, operation, message):
+        isarest_metrics.admission_rejected.inc(1, operation)
+        raise Overloaded(message, self.retry_after(operation))
+
+    def retry_after(self, operation):
+        """
+        :return: Seconds until the requests waiting for operation can be expected to have got in, at least 1
+        """
+        with self._lock:
+            duration = self._durations.get(operation, config.ADMISSION_RETRY_AFTER)
+        waiting = self._held(operation, 'wait', self.queue_size)
+        return max(1, int(math.ceil(duration * (waiting + 1) / self.limits[operation])))
+
+    @contextlib.contextmanager
+    def admit(self, operation):
+        """Run the body of the with statement once a conversion of operation may start
+
+        :raises Overloaded: If the queue of operation is full, or the request waited queue_timeout seconds
+        """
+        limit = self.limits.get(operation)
+        if limit is None:
+            yield
+            return
+        started = time.time()
+        slot_fp = self._take(operation, 'run', limit)
+        if slot_fp is None:
+            ticket_fp = self._take(operation, 'wait', self.queue_size)
+            if ticket_fp is None:
+                self._reject(operation, "{} conversions running and {} waiting for {}".format(
+                    limit, self.queue_size, operation))
+            try:
+                while slot_fp is None:
+                    if time.time() - started >= self.queue_timeout:
+                        self._reject(operation, "Waited {} seconds for {}".format(self.queue_timeout, operation))
+                    time.sleep(self.poll_interval)
+                    slot_fp = self._take(operation, 'run', limit)
+            finally:
+                self._give_back(ticket_fp)
+        running = time.time()
+        isarest_metrics.admission_wait.observe(running - started, operation)
+        try:
+            yield
+        finally:
+            self._give_back(slot_fp)
+            with self._lock:
+                previous = self._durations.get(operation)
+                duration = time.time() - running
+                self._durations[operation] = duration if previous is None else 0.8 * previous + 0.2 * duration
+
+    def stats(self):
+        """
+        :return: Dict of operation -> dict of its limit, and the conversions running and waiting on this node
+        """
+        return {operation: {'limit': limit, 'running': self._held(operation, 'run', limit),
+                            'waiting': self._held(operation, 'wait', self.queue_size)}
+                for operation, limit in sorted(self.limits.items())}
@@ -0,0 +1,320 @@
+"""Load test the ISA REST service and generate large synthetic studies to drive it with
+
+Run every registered resource at a few concurrency levels against the app in process, or against a running server
+with --url, and write throughput and latency percentiles as JSON:
+
+    python isarest_bench.py run --concurrency 1,4,16 --requests 50 --samples 100000 --output bench.json
+
+Write the BII-S-3 ISA-Tab scaled up to a million sample rows:
+
+    python isarest_bench.py generate --samples 1000000 BII-S-3-1M.zip
+"""
+import os
+import logging
+import csv
+import sys
+import json
+import math
+import time
+import shutil
+import zipfile
+import argparse
+import platform
+import tempfile
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+# upload name of a converter, or kind of input of a fan-out, -> fixture posted to it
+FIXTURES = {
+    'isatab.zip': 'BII-S-3.zip',
+    'in.zip': 'BII-S-3.zip',
+    'isajson.zip': 'BII-S-3_json.zip',
+    'in.json': 'BII-S-3.json',
+    'in.txt': 'GSB-3.txt',
+    'magetab.zip': 'E-MEXP-31.zip',
+    'isatab': 'BII-S-3.zip',
+    'json': 'BII-S-3_json.zip'
+}
+
+
+def _resource_path(operation):
+    if operation.startswith('validate-'):
+        return '/api/v1/validate/' + operation[len('validate-'):]
+    return '/api/v1/convert/' + operation
+
+
+def resources():
+    """
+    :return: Dict of operation -> (path of the resource, fixture posted to it) for every enabled conversion,
+        validation and fan-out registered in isarest_converters
+    """
+    from isarest_converters import CONVERTERS, FANOUT_TARGETS, enabled
+    found = {operation: (_resource_path(operation), FIXTURES[converter.upload_name])
+             for operation, converter in CONVERTERS.items() if enabled(operation)}
+    found.update({operation: (_resource_path(operation), FIXTURES[kind])
+                  for operation, (kind, _) in FANOUT_TARGETS.items() if enabled(operation)})
+    return found
+
+
+# columns naming a node of the experimental graph, made unique in every copy of a row
+NAME_COLUMNS = {'Source Name', 'Sample Name', 'Extract Name', 'Labeled Extract Name', 'Assay Name',
+                'Hybridization Assay Name', 'Scan Name', 'Normalization Name', 'Data Transformation Name'}
+
+
+def _read_table(zf, name):
+    with zf.open(name) as table_fp:
+        rows = list(csv.reader((line.decode('utf-8') for line in table_fp), delimiter='\t'))
+    return rows[0], [row for row in rows[1:] if row]
+
+
+class _TextSink:
+
+    """Encodes what a csv.writer writes on its way to a binary file object"""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def write(self, s):
+        return self.fp.write(s.encode('utf-8'))
+
+
+def _write_copies(zf, name, header, rows, copies, keep):
+    """Write rows copies times to member name, suffixing node names with the number of the copy
+
+    :param keep: Function(index of row, row, copy) telling whether the copy of the row is written
+    """
+    name_cols = [i for i, column in enumerate(header) if column in NAME_COLUMNS]
+    written = 0
+    with zf.open(name, 'w', force_zip64=True) as member_fp:
+        writer = csv.writer(_TextSink(member_fp), delimiter='\t', quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow(header)
+        for copy in range(copies):
+            for index, row in enumerate(rows):
+                if not keep(index, row, copy):
+                    continue
+                if copy:
+                    row = list(row)
+                    for i in name_cols:
+                        if row[i]:
+                            row[i] = '{}.{}'.format(row[i], copy)
+                writer.writerow(row)
+                written += 1
+    return written
+
+
+def generate_study(samples, out_path, template=os.path.join(TESTDATA, 'BII-S-3.zip')):
+    """Scale up an ISA-Tab archive by copying its study and assay rows until the study has samples sample rows
+
+    Copies get node names of their own, so the result is a valid study with samples times as many samples, extracts
+    and assays as the template has. Data files are shared between the copies rather than duplicated. Tables are
+    written a row at a time, so studies with millions of rows can be generated.
+    :param samples: Number of sample rows in the generated study file
+    :param out_path: Path of the ZIP archive to write
+    :param template: ISA-Tab ZIP archive to scale up, BII-S-3 by default
+    :return: Dict of member name -> number of rows written to it
+    """
+    counts = dict()
+    with zipfile.ZipFile(template) as src, zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED) as dst:
+        study_names = [name for name in src.namelist() if os.path.basename(name).startswith('s_')]
+        assay_names = [name for name in src.namelist() if os.path.basename(name).startswith('a_')]
+        included = set()  # (original sample name, copy) of the sample rows written
+        copies = 0
+        for name in study_names:
+            header, rows = _read_table(src, name)
+            copies = max(copies, int(math.ceil(samples / float(len(rows)))) if rows else 0)
+            sample_col = header.index('Sample Name')
+
+            def keep_sample(index, row, copy, per_copy=len(rows), sample_col=sample_col):
+                if copy * per_copy + index >= samples:
+                    return False
+                included.add((row[sample_col], copy))
+                return True
+            counts[name] = _write_copies(dst, name, header, rows, copies, keep_sample)
+        for name in assay_names:
+            header, rows = _read_table(src, name)
+            sample_col = header.index('Sample Name')
+            counts[name] = _write_copies(dst, name, header, rows, copies,
+                                         lambda index, row, copy: (row[sample_col], copy) in included)
+        for info in src.infolist():
+            if info.filename not in study_names and info.filename not in assay_names:
+                with src.open(info) as src_fp, dst.open(info.filename, 'w') as dst_fp:
+                    shutil.copyfileobj(src_fp, dst_fp)
+    return counts
+
+
+def _percentile(ordered, p):
+    # nearest rank
+    if not ordered:
+        return None
+    return ordered[max(int(math.ceil(p / 100.0 * len(ordered))) - 1, 0)]
+
+
+def _format(value, spec):
+    # throughput and latencies are None when there is nothing to measure them on
+    return 'n/a' if value is None else format(value, spec)
+
+
+def _in_process_post():
+    from isarest import app
+
+    def post(path, data, mimetype):
+        response = app.test_client().post(path=path, data=data, headers={'Content-Type': mimetype})
+        return response.status_code, len(response.get_data())
+    return post
+
+
+def _http_post(base_url):
+    def post(path, data, mimetype):
+        req = urllib.request.Request(base_url.rstrip('/') + path, data=data, headers={'Content-Type': mimetype})
+        try:
+            with urllib.request.urlopen(req) as response:
+                received = 0
+                while True:
+                    chunk = response.read(config.RESPONSE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                return response.status, received
+        except urllib.error.HTTPError as e:
+            return e.code, len(e.read())
+    return post
+
+
+def bench(post, path, data, mimetype, concurrency, requests):
+    """Post data to path requests times from concurrency threads
+
+    :return: Dict of throughput, latency percentiles in seconds, status code counts and bytes transferred
+    """
+    def timed(_):
+        started = time.time()
+        try:
+            status, received = post(path, data, mimetype)
+        except Exception as e:
+            logger.error("Request to %s failed: %s", path, e)
+            status, received = None, 0
+        return time.time() - started, status, received
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, range(requests)))
+    elapsed = time.time() - started
+    latencies = sorted(latency for latency, _, _ in outcomes)
+    statuses = dict()
+    for _, status, _ in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': sum(1 for _, status, _ in outcomes if status != 200),
+        'statuses': statuses,
+        'elapsed': elapsed,
+        'throughput': requests / elapsed if elapsed else None,
+        'latency': {
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'p50': _percentile(latencies, 50),
+            'p95': _percentile(latencies, 95),
+            'p99': _percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None
+        },
+        'bytes_in': len(data) * requests,
+        'bytes_out': sum(received for _, _, received in outcomes)
+    }
+
+
+def run(operations=None, concurrency=(1,), requests=10, samples=None, url=None, use_cache=False):
+    """Benchmark the resources for operations, all of them by default
+
+    :param samples: If given, post a study generated with that many sample rows to the resources taking ISA-Tab,
+        instead of BII-S-3
+    :param url: Base URL of a running server, the app is driven in process if None
+    :param use_cache: Leave the result and validation caches on when running in process, so repeated requests
+        measure cache hits
+    :return: Dict describing the run, with a result per operation and concurrency level
+    """
+    registered = resources()
+    operations = operations or sorted(registered)
+    tmp_dir = tempfile.mkdtemp()
+    cache_endpoints, validation_cache_max_bytes = config.RESULT_CACHE_ENDPOINTS, config.VALIDATION_CACHE_MAX_BYTES
+    try:
+        if url is None:
+            if not use_cache:
+                config.RESULT_CACHE_ENDPOINTS = dict()
+                config.VALIDATION_CACHE_MAX_BYTES = 0
+            post = _in_process_post()
+        else:
+            post = _http_post(url)
+        generated = None
+        if samples:
+            generated = os.path.join(tmp_dir, 'generated.zip')
+            generate_study(samples, generated)
+        results = []
+        for operation in operations:
+            path, fixture = registered[operation]
+            payload_path = generated if generated and fixture == 'BII-S-3.zip' else os.path.join(TESTDATA, fixture)
+            with open(payload_path, 'rb') as payload_fp:
+                data = payload_fp.read()
+            mimetype = {'.zip': 'application/zip', '.json': 'application/json'}.get(
+                os.path.splitext(fixture)[1], 'text/tab-separated-values')
+            for level in concurrency:
+                result = bench(post, path, data, mimetype, level, requests)
+                result.update(operation=operation, resource=path, payload=os.path.basename(payload_path))
+                print("{} c={}: {} req/s, p50 {}s, p95 {}s, p99 {}s, {} errors".format(
+                    operation, level, _format(result['throughput'], '.2f'), _format(result['latency']['p50'], '.3f'),
+                    _format(result['latency']['p95'], '.3f'), _format(result['latency']['p99'], '.3f'),
+                    result['errors']))
+                results.append(result)
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'target': url or 'in-process',
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'samples': samples,
+            'results': results
+        }
+    finally:
+        config.RESULT_CACHE_ENDPOINTS, config.VALIDATION_CACHE_MAX_BYTES = cache_endpoints, validation_cache_max_bytes
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='benchmark the resources')
+    run_parser.add_argument('--url', help='base URL of a running server, e.g. http://localhost:5000, instead of '
+                                          'driving the app in process')
+    run_parser.add_argument('--operations', help='comma separated operations to benchmark, all by default')
+    run_parser.add_argument('--concurrency', default='1', help='comma separated concurrency levels, e.g. 1,4,16')
+    run_parser.add_argument('--requests', type=int, default=10, help='requests per operation and concurrency level')
+    run_parser.add_argument('--samples', type=int, help='post a generated study with this many sample rows to the '
+                                                        'resources taking ISA-Tab')
+    run_parser.add_argument('--cache', action='store_true',
+                            help='keep the result and validation caches on when running in process')
+    run_parser.add_argument('--output', default='bench.json', help='file to write the results to as JSON')
+    generate_parser = commands.add_parser('generate', help='generate a scaled up BII-S-3 ISA-Tab archive')
+    generate_parser.add_argument('--samples', type=int, required=True, help='sample rows in the study file')
+    generate_parser.add_argument('output', help='ZIP archive to write')
+    args = parser.parse_args(argv)
+    if args.command == 'generate':
+        print(json.dumps(generate_study(args.samples, args.output), indent=2))
+    elif args.command == 'run':
+        report = run(operations=args.operations.split(',') if args.operations else None,
+                     concurrency=[int(level) for level in args.concurrency.split(',')], requests=args.requests,
+                     samples=args.samples, url=args.url, use_cache=args.cache)
+        with open(args.output, 'w') as output_fp:
+            json.dump(report, output_fp, indent=2)
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def make_key(endpoint, options, digest):
+    """
+    :param endpoint: Name of the endpoint producing the result, e.g. tab-to-json
+    :param options: Dict of converter options that influence the result
+    :param digest: Hex digest of the request body
+    :return: Hex key addressing the cached result
+    """
+    h = hashlib.sha256()
+    h.update(endpoint.encode('utf-8'))
+    h.update(b'\0')
+    h.update(json.dumps(options or {}, sort_keys=True).encode('utf-8'))
+    h.update(b'\0')
+    h.update(digest.encode('utf-8'))
+    return h.hexdigest()
+
+
+class ResultCache:
+
+    """Content-addressed cache of conversion outputs kept on disk
+
+    Each entry is stored as two files in cache_dir: <key> holding the output bytes and <key>.json holding its
+    metadata. Once the total size of the outputs exceeds max_bytes, least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = dict()
+        self.misses = dict()
+        self.coalesced = dict()
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._load()
+
+    def _data_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _meta_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def _load(self):
+        # rebuild the LRU index from what is already on disk, oldest access first
+        found = []
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.part'):
+                # left behind by a write interrupted an hour or more ago, not one still in progress
+                part_path = os.path.join(self.cache_dir, file)
+                if time.time() - os.path.getmtime(part_path) > 3600:
+                    os.remove(part_path)
+            if not file.endswith('.json'):
+                continue
+            key = file[:-len('.json')]
+            try:
+                st = os.stat(self._data_path(key))
+            except OSError:
+                continue
+            found.append((st.st_mtime, key, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            for path in (self._data_path(key), self._meta_path(key)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _adopt(self, key):
+        # committed by another server process sharing cache_dir since this one loaded the index
+        try:
+            size = os.stat(self._data_path(key)).st_size
+            if not os.path.exists(self._meta_path(key)):
+                return
+        except OSError:
+            return
+        self._entries[key] = size
+        self._size += size
+
+    def get(self, endpoint, key):
+        """
+        :param endpoint: Endpoint name the lookup is counted against
+        :param key: Key as returned by make_key()
+        :return: Tuple of (path to cached output, mimetype), or None on a miss
+        """
+        with self._lock:
+            if key not in self._entries:
+                self._adopt(key)
+            if key in self._entries:
+                try:
+                    with open(self._meta_path(key)) as meta_fp:
+                        meta = json.load(meta_fp)
+                    os.utime(self._data_path(key), None)
+                except (OSError, ValueError):
+                    self._size -= self._entries.pop(key)
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits[endpoint] = self.hits.get(endpoint, 0) + 1
+                    return self._data_path(key), meta['mimetype']
+            self.misses[endpoint] = self.misses.get(endpoint, 0) + 1
+            return None
+
+    def tee(self, key, mimetype, chunks):
+        """Pass chunks through unchanged while writing them to the cache
+
+        The entry is only committed once chunks has been fully consumed, so an aborted response never leaves a
+        truncated result behind.
+        """
+        part_path = self._data_path(key) + '.' + str(uuid.uuid4()) + '.part'
+        size = 0
+        committed = False
+        try:
+            with open(part_path, 'wb') as part_fp:
+                for chunk in chunks:
+                    part_fp.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            if size <= self.max_bytes:
+                with open(self._meta_path(key), 'w') as meta_fp:
+                    json.dump({'mimetype': mimetype}, meta_fp)
+                with self._lock:
+                    os.replace(part_path, self._data_path(key))
+                    committed = True
+                    self._size -= self._entries.pop(key, 0)
+                    self._entries[key] = size
+                    self._size += size
+                    self._evict()
+        finally:
+            if not committed:
+                try:
+                    os.remove(part_path)
+                except OSError:
+                    pass
+
+    def put(self, key, mimetype, data):
+        """Store the bytes data under key"""
+        for _ in self.tee(key, mimetype, [data]):
+            pass
+
+    def count_coalesced(self, endpoint):
+        """Count a request that waited for an identical one in flight and was served its result"""
+        with self._lock:
+            self.coalesced[endpoint] = self.coalesced.get(endpoint, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': sum(self.hits.values()),
+                'misses': sum(self.misses.values()),
+                'coalesced': sum(self.coalesced.values()),
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'endpoints': {
+                    endpoint: {'hits': self.hits.get(endpoint, 0), 'misses': self.misses.get(endpoint, 0),
+                               'coalesced': self.coalesced.get(endpoint, 0)}
+                    for endpoint in set(self.hits) | set(self.misses)
+                }
+            }
+
+
+class Flight:
+
+    """Lock held by the one request computing the result for a key, see InFlight"""
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.waited = False  # set if an identical request was in flight when this one arrived
+        self.held = True  # cleared if this request gave up waiting for the lead, see InFlight.acquire
+        self._fp = open(lock_path, 'w')
+        self._released = False
+
+    def _close(self):
+        self._released = True
+        self._fp.close()
+
+    def release(self):
+        if self._released:
+            return
+        if not self.held:
+            self._close()  # the lock file is the leader's
+            return
+        try:
+            # the result is in the cache by now, so requests arriving from here on find it without locking
+            os.remove(self.lock_path)
+        except OSError:
+            pass
+        self._close()
+
+
+class InFlight:
+
+    """Lets only one of several identical requests, in any server process sharing lock_dir, run at a time
+
+    The others wait until it is done, so they can be served its result from the cache rather than compute it again. They
+    poll for the lead rather than block on it, so one that waited timeout seconds goes ahead without it.
+    """
+
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        if not os.path.exists(lock_dir):
+            os.makedirs(lock_dir)
+
+    def acquire(self, key, timeout=None, poll_interval=0.05):
+        """Wait until no identical request is in flight, then take the lead
+
+        :param timeout: Seconds to wait for an identical request in flight, None to wait as long as it runs
+        :return: Flight, to be released once the result is in the cache or the request failed. If its waited is set
+            the cache should be looked up again first. If its held is cleared the wait timed out, and the request
+            computes its result alongside the one in flight
+        """
+        waited = False
+        started = time.time()
+        while True:
+            flight = Flight(os.path.join(self.lock_dir, key + '.lock'))
+            try:
+                fcntl.flock(flight._fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                waited = True
+                if timeout is not None and time.time() - started >= timeout:
+                    flight.held = False
+                    flight.waited = True
+                    flight.release()
+                    return flight
+                flight._close()
+                time.sleep(poll_interval)
+                continue
+            try:
+                if os.path.samestat(os.fstat(flight._fp.fileno()), os.stat(flight.lock_path)):
+                    flight.waited = waited
+                    return flight
+            except FileNotFoundError:
+                pass
+            # locked a file the leader removed when done, lock the one in place now instead
+            flight._close()
@@ -1,199 +1,336 @@
-import requests
-import json
 import os
+import sys
+import gzip
+import shutil
+import hashlib
+import json
+import math
+import logging
+import time
+import asyncio
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes of a response held in memory at a time
+COMPRESS_MIMETYPES = {'application/json', 'text/tab-separated-values'}  # inputs sent gzipped, ZIP archives are not
+COMPRESS_MIN_SIZE = 1024  # bytes, smaller inputs are sent as they are
+RESUMABLE_CHUNK_SIZE = 16 * 1024 * 1024  # bytes of a resumable upload sent per request
+
+# operation -> (path of the resource, mimetype of the input, suffix of the output file). Operations without a mimetype
+# get the path with their input filled in, e.g. import-mw the accession of a Metabolomics Workbench study
+ENDPOINTS = {
+    'tab-to-json': ('/api/v1/convert/tab-to-json', 'application/zip', '.json'),
+    'json-to-tab': ('/api/v1/convert/json-to-tab', 'application/json', '.zip'),
+    'tab-to-sra': ('/api/v1/convert/tab-to-sra', 'application/zip', '.zip'),
+    'json-to-sra': ('/api/v1/convert/json-to-sra', 'application/zip', '.zip'),
+    'tab-to-cedar': ('/api/v1/convert/tab-to-cedar', 'application/zip', '.json'),
+    'validate-json': ('/api/v1/validate/json', 'application/json', '.json'),
+    'validate-isatab': ('/api/v1/validate/isatab', 'application/zip', '.json'),
+    'sampletab-to-isatab': ('/api/v1/convert/sampletab-to-isatab', 'text/tab-separated-values', '.zip'),
+    'sampletab-to-json': ('/api/v1/convert/sampletab-to-json', 'text/tab-separated-values', '.json'),
+    'json-to-sampletab': ('/api/v1/convert/json-to-sampletab', 'application/json', '.txt'),
+    'isatab-to-sampletab': ('/api/v1/convert/isatab-to-sampletab', 'application/zip', '.txt'),
+    'magetab-to-json': ('/api/v1/convert/magetab-to-json', 'application/zip', '.json'),
+    'tab-to-all': ('/api/v1/convert/tab-to-all', 'application/zip', '.zip'),
+    'json-to-all': ('/api/v1/convert/json-to-all', 'application/json', '.zip'),
+    'import-mw': ('/api/v1/import/mw/{}', None, '.zip')
+}
+
+
+def _retry(retries, backoff_factor):
+    # conversions have no side effects, so POSTs are retried as well
+    options = dict(total=retries, connect=retries, read=retries, backoff_factor=backoff_factor,
+                   status_forcelist=(502, 503, 504), raise_on_status=False)
+    try:
+        return Retry(allowed_methods=None, **options)
+    except TypeError:  # urllib3 < 1.26
+        return Retry(method_whitelist=False, **options)
 
 
 class IsaRestClient:
 
-    def __init__(self, baseurl='http://localhost:5000', dl_folder='/tmp'):
+    """Client for the ISA REST service
+
+    Requests go through one pooled session, so connections are kept alive and reused between calls, and requests
+    failing to connect or answered with 502, 503 or 504 are retried with exponential backoff. Inputs can be given as
+    bytes or as the path of a file, which is streamed from disk. Outputs are streamed to a new file in dl_folder.
+
+    JSON and SampleTab inputs are sent gzipped, and responses are accepted compressed and decoded as they are read.
+    """
+
+    def __init__(self, baseurl='http://localhost:5000', dl_folder='/tmp', retries=3, backoff_factor=0.5,
+                 pool_maxsize=10, timeout=None, verify=False, compress=True):
+        """
+        :param retries: Times a failed request is retried
+        :param backoff_factor: Seconds to wait before the first retry, doubled for every further one
+        :param pool_maxsize: Connections kept open to the service, the most concurrent calls can use
+        :param timeout: Seconds to wait for the service to connect or to send more of a response, None to wait forever
+        :param compress: Whether to gzip JSON and SampleTab inputs of COMPRESS_MIN_SIZE bytes or more
+        """
         self.baseurl = baseurl
         self.dl_folder = dl_folder
+        self.timeout = timeout
+        self.verify = verify
+        self.compress = compress
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize,
+                              max_retries=_retry(retries, backoff_factor))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
 
-    def convert_tab_to_json(self, zipped_tab_bytes):
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _request(self, method, path, data=None, mimetype=None, headers=None):
+        """Send data, bytes or the path of a file to stream from disk, to path
+
+        :return: Response, with its content not read yet
+        """
+        headers = dict(headers or {}, **({'Content-type': mimetype} if mimetype else {}))
+        compress = self.compress and mimetype in COMPRESS_MIMETYPES
+        if isinstance(data, (str, os.PathLike)):
+            # a file is sent a block at a time, with its length, and rewound by the retries
+            with open(data, 'rb') as data_fp:
+                if compress and os.fstat(data_fp.fileno()).st_size >= COMPRESS_MIN_SIZE:
+                    headers['Content-Encoding'] = 'gzip'
+                    with tempfile.TemporaryFile() as gz_fp:
+                        with gzip.GzipFile(fileobj=gz_fp, mode='wb') as gzip_fp:
+                            shutil.copyfileobj(data_fp, gzip_fp, DOWNLOAD_CHUNK_SIZE)
+                        gz_fp.seek(0)
+                        response = self.session.request(method, self.baseurl + path, data=gz_fp, headers=headers,
+                                                        stream=True, timeout=self.timeout, verify=self.verify)
+                else:
+                    response = self.session.request(method, self.baseurl + path, data=data_fp, headers=headers,
+                                                    stream=True, timeout=self.timeout, verify=self.verify)
+        else:
+            if compress and data is not None and len(data) >= COMPRESS_MIN_SIZE:
+                headers['Content-Encoding'] = 'gzip'
+                data = gzip.compress(data)
+            response = self.session.request(method, self.baseurl + path, data=data, headers=headers, stream=True,
+                                            timeout=self.timeout, verify=self.verify)
+        logger.debug("%s %s: HTTP %s", method, path, response.status_code)
+        return response
+
+    def _download(self, response, suffix):
+        """Write the body of response to a new file in dl_folder, named out-<unique>.<suffix>
+
+        :return: Absolute path of the file, None if the request failed
         """
-        :param zipped_tab_bytes: Bytes of zip file containing ISA tabs to sent to converter service
-        :return: Absolute path for local JSON file returned by converter service called out.json
+        with response:
+            if not response.ok:
+                return None
+            fd, outpath = tempfile.mkstemp(prefix='out-', suffix=suffix, dir=self.dl_folder)
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+            return os.path.abspath(outpath)
+
+    def convert(self, operation, data=None, upload_id=None):
+        """Run any of the operations in ENDPOINTS
+
+        :param data: Bytes of, or path to, the input, or the accession to import for import-mw
+        :param upload_id: ID of a complete resumable upload to use as the input instead, see upload
+        :return: Tuple of (HTTP status code, absolute path of the output file or None if the request failed)
+        """
+        path, mimetype, suffix = ENDPOINTS[operation]
+        if mimetype is None:
+            response = self._request('GET', path.format(data))
+            return response.status_code, self._download(response, suffix)
+        headers = {'X-Upload-Id': upload_id} if upload_id is not None else None
+        response = self._request('POST', path, data, mimetype, headers)
+        return response.status_code, self._download(response, suffix)
+
+    def upload(self, file_path, upload_id=None, chunk_size=RESUMABLE_CHUNK_SIZE):
+        """Send a file as a resumable upload, a chunk of chunk_size bytes at a time
+
+        Every chunk is retried like any other request. An upload that failed part way can be resumed by calling upload
+        again with its ID, which sends only the chunks the service has not received yet.
+        :param upload_id: ID of the upload to resume, None to start a new one
+        :return: ID of the complete upload, to pass to convert, or None if the upload failed
+        """
+        if upload_id is None:
+            h = hashlib.sha256()
+            with open(file_path, 'rb') as data_fp:
+                for data in iter(lambda: data_fp.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    h.update(data)
+            response = self.session.post(self.baseurl + '/api/v1/uploads', timeout=self.timeout, verify=self.verify,
+                                         json={'size': os.path.getsize(file_path), 'sha256': h.hexdigest()})
+        else:
+            response = self.session.get(self.baseurl + '/api/v1/uploads/' + upload_id, timeout=self.timeout,
+                                        verify=self.verify)
+        if not response.ok:
+            return None
+        upload = response.json()
+        if upload['complete']:
+            return upload['id']
+        received = set(upload['chunks'])
+        if upload.get('max_chunks'):
+            # larger chunks for a file that would otherwise need more chunks than the service takes
+            chunk_size = min(max(chunk_size, -(-os.path.getsize(file_path) // upload['max_chunks'])),
+                             upload['max_chunk_size'])
+        chunk_url = self.baseurl + '/api/v1/uploads/' + upload['id'] + '/chunks/{}'
+        with open(file_path, 'rb') as data_fp:
+            for index, data in enumerate(iter(lambda: data_fp.read(chunk_size), b'')):
+                if index in received:
+                    continue
+                response = self.session.put(chunk_url.format(index), data=data, timeout=self.timeout,
+                                            verify=self.verify,
+                                            headers={'Content-type': 'application/octet-stream',
+                                                     'X-Chunk-Sha256': hashlib.sha256(data).hexdigest()})
+                if not response.ok:
+                    return None
+        response = self.session.post(self.baseurl + '/api/v1/uploads/' + upload['id'] + '/complete',
+                                     timeout=self.timeout, verify=self.verify)
+        logger.debug("Completed upload %s: HTTP %s", upload['id'], response.status_code)
+        return upload['id'] if response.ok else None
+
+    def convert_tab_to_json(self, zipped_tab):
+        """
+        :param zipped_tab: Bytes of, or path to, zip file containing ISA tabs to sent to converter service
+        :return: Absolute path for local JSON file returned by converter service, named out-<unique>.json
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient(dl_folder='tmp/')
-            client.convert_tab_to_json(open('testdata/BII-S-3.zip', 'rb').read())
+            client.convert_tab_to_json('testdata/BII-S-3.zip')
         """
-        response = requests.post(self.baseurl + '/api/v1/convert/tab-to-json',
-                                 headers={'Content-type': 'application/zip'}, data=zipped_tab_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            data = response.json()
-            outpath = os.path.join(self.dl_folder, 'out.json')
-            with open(outpath, 'w') as f:
-                json.dump(data, f)
-            return os.path.abspath(f.name)
+        return self._download(self._request('POST', '/api/v1/convert/tab-to-json', zipped_tab, 'application/zip'),
+                              '.json')
 
-    def convert_json_to_tab(self, isa_json_bytes):
+    def convert_json_to_tab(self, isa_json):
         """
-        :param isa_json_bytes: Bytes of zip file containing ISA tabs to sent to converter service
-        :return: Absolute path for local ZIP file named out.zip returned by converter service
+        :param isa_json: Bytes of, or path to, ISA JSON to sent to converter service
+        :return: Absolute path for local ZIP file returned by converter service, named out-<unique>.zip
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient(dl_folder='tmp/')
-            client.convert_json_to_tab(open('testdata/BII-S-3.json', 'rb').read())
+            client.convert_json_to_tab('testdata/BII-S-3.json')
         """
-        response = requests.post(self.baseurl + '/api/v1/convert/json-to-tab',
-                                 headers={'Content-type': 'application/json'}, data=isa_json_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            data = response.content
-            outpath = os.path.join(self.dl_folder, 'out.zip')
-            with open(outpath, 'wb') as f:
-                f.write(data)
-            return os.path.abspath(f.name)
+        return self._download(self._request('POST', '/api/v1/convert/json-to-tab', isa_json, 'application/json'),
+                              '.zip')
 
-    def convert_json_to_sra(self, isa_json_zip_bytes):
+    def convert_json_to_sra(self, isa_json_zip):
         """
-        :param isa_json_zip_bytes: Bytes of zip file containing ISA JSON and data files to sent to converter service
-        :return: Absolute path for local ZIP file named out.zip returned by converter service
+        :param isa_json_zip: Bytes of, or path to, zip file containing ISA JSON and data files to sent to converter
+            service
+        :return: Absolute path for local ZIP file returned by converter service, named out-<unique>.zip
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient(dl_folder='tmp/')
-            client.convert_json_to_tab(open('testdata/BII-S-3_json.zip', 'rb').read())
+            client.convert_json_to_sra('testdata/BII-S-3_json.zip')
         """
-        response = requests.post(self.baseurl + '/api/v1/convert/json-to-sra',
-                                 headers={'Content-type': 'application/zip'}, data=isa_json_zip_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            data = response.content
-            outpath = os.path.join(self.dl_folder, 'out.zip')
-            with open(outpath, 'wb') as f:
-                f.write(data)
-            return os.path.abspath(f.name)
+        return self._download(self._request('POST', '/api/v1/convert/json-to-sra', isa_json_zip, 'application/zip'),
+                              '.zip')
 
-    def convert_tab_to_sra(self, zipped_tab_bytes):
+    def convert_tab_to_sra(self, zipped_tab):
         """
-        :param isa_json_zip_bytes: Bytes of zip file containing ISA JSON and data files to sent to converter service
-        :return: Absolute path for local ZIP file named out.zip returned by converter service
+        :param zipped_tab: Bytes of, or path to, zip file containing ISA tabs to sent to converter service
+        :return: Absolute path for local ZIP file returned by converter service, named out-<unique>.zip
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient(dl_folder='tmp/')
-            client.convert_json_to_tab(open('testdata/BII-S-3_json.zip', 'rb').read())
+            client.convert_tab_to_sra('testdata/BII-S-3.zip')
         """
-        response = requests.post(self.baseurl + '/api/v1/convert/tab-to-sra',
-                                 headers={'Content-type': 'application/zip'}, data=zipped_tab_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            data = response.content
-            outpath = os.path.join(self.dl_folder, 'out.zip')
-            with open(outpath, 'wb') as f:
-                f.write(data)
-            return os.path.abspath(f.name)
+        return self._download(self._request('POST', '/api/v1/convert/tab-to-sra', zipped_tab, 'application/zip'),
+                              '.zip')
 
-    def convert_tab_to_cedar(self, zipped_tab_bytes):
+    def convert_tab_to_cedar(self, zipped_tab):
         """
-        :param zipped_tab_bytes: Bytes of zip file containing ISA tabs to sent to converter service
-        :return: Absolute path for local CEDAR JSON file returned by converter service called out.json
+        :param zipped_tab: Bytes of, or path to, zip file containing ISA tabs to sent to converter service
+        :return: Absolute path for local CEDAR JSON file returned by converter service, named out-<unique>.json
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient(dl_folder='tmp/')
-            client.convert_tab_to_json(open('testdata/BII-S-3.zip', 'rb').read())
+            client.convert_tab_to_cedar('testdata/BII-S-3.zip')
         """
-        response = requests.post(self.baseurl + '/api/v1/convert/tab-to-cedar',
-                                 headers={'Content-type': 'application/zip'}, data=zipped_tab_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            data = response.json()
-            outpath = os.path.join(self.dl_folder, 'out.json')
-            with open(outpath, 'w') as f:
-                json.dump(data, f)
-            return os.path.abspath(f.name)
+        return self._download(self._request('POST', '/api/v1/convert/tab-to-cedar', zipped_tab, 'application/zip'),
+                              '.json')
 
-    def validate_json(self, isa_json_bytes):
+    def validate_json(self, isa_json):
         """
-        :param isa_json_bytes: Bytes of ISA JSON to sent to converter service
+        :param isa_json: Bytes of, or path to, ISA JSON to sent to converter service
         :return: JSON validation report: Validation report as JSON
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient()
-            client.validate_json(open('testdata/BII-S-3.json', 'rb').read())
+            client.validate_json('testdata/BII-S-3.json')
         """
-        response = requests.post(self.baseurl + '/api/v1/validate/json',
-                                 headers={'Content-type': 'application/json'}, data=isa_json_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            print(response.content)
+        with self._request('POST', '/api/v1/validate/json', isa_json, 'application/json') as response:
+            if response.ok:
+                print(response.content)
 
-    def validate_isatab(self, isatab_zip_bytes):
+    def validate_isatab(self, isatab_zip):
         """
-        :param isatab_zip_bytes: Bytes of zip file containing ISA tabs to sent to converter service
+        :param isatab_zip: Bytes of, or path to, zip file containing ISA tabs to sent to converter service
         :return: JSON validation report: Validation report as JSON
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient()
-            client.validate_tab(open('testdata/BII-S-3.zip', 'rb').read())
+            client.validate_isatab('testdata/BII-S-3.zip')
         """
-        response = requests.post(self.baseurl + '/api/v1/validate/isatab',
-                                 headers={'Content-type': 'application/zip'}, data=isatab_zip_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            print(response.content)
+        with self._request('POST', '/api/v1/validate/isatab', isatab_zip, 'application/zip') as response:
+            if response.ok:
+                print(response.content)
 
-    def convert_sampletab_to_tab(self, sampletab_bytes):
+    def convert_sampletab_to_tab(self, sampletab):
         """
-        :param sampletab_bytes: Bytes of SampleTab input file to sent to converter service
-        :return: Absolute path for local ZIP file named out.zip returned by converter service
+        :param sampletab: Bytes of, or path to, SampleTab input file to sent to converter service
+        :return: Absolute path for local ZIP file returned by converter service, named out-<unique>.zip
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient(dl_folder='tmp/')
-            client.convert_sampletab_to_tab(open('testdata/GSB-3.txt', 'rb').read())
+            client.convert_sampletab_to_tab('testdata/GSB-3.txt')
         """
-        response = requests.post(self.baseurl + '/api/v1/convert/sampletab-to-isatab',
-                                 headers={'Content-type': 'text/tab-separated-values'}, data=sampletab_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            data = response.content
-            outpath = os.path.join(self.dl_folder, 'out.zip')
-            with open(outpath, 'wb') as f:
-                f.write(data)
-            return os.path.abspath(f.name)
+        return self._download(self._request('POST', '/api/v1/convert/sampletab-to-isatab', sampletab,
+                                            'text/tab-separated-values'), '.zip')
 
-    def convert_sampletab_to_json(self, sampletab_bytes):
+    def convert_sampletab_to_json(self, sampletab):
         """
-        :param sampletab_bytes: Bytes of SampleTab input file to sent to converter service
-         :return: Absolute path for local JSON file returned by converter service called out.json
+        :param sampletab: Bytes of, or path to, SampleTab input file to sent to converter service
+        :return: Absolute path for local JSON file returned by converter service, named out-<unique>.json
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient(dl_folder='tmp/')
-            client.convert_sampletab_to_json(open('testdata/GSB-3.txt', 'rb').read())
-        """
-        response = requests.post(self.baseurl + '/api/v1/convert/sampletab-to-json',
-                                 headers={'Content-type': 'text/tab-separated-values'}, data=sampletab_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            data = response.json()
-            outpath = os.path.join(self.dl_folder, 'out.json')
-            with open(outpath, 'w') as f:
-                json.dump(data, f)
-            return os.path.abspath(f.name)
+            client.convert_sampletab_to_json('testdata/GSB-3.txt')
+        """
+        return self._download(self._request('POST', '/api/v1/convert/sampletab-to-json', sampletab,
+                                            'text/tab-separated-values'), '.json')
 
     def import_mw_to_tab(self, accession):
         """
         :param accession: Accession ID for study in MetabolomicsWorkbench
-        :return: Absolute path for local ZIP file named out.zip returned by converter service
+        :return: Absolute path for local ZIP file returned by converter service, named out-<unique>.zip
 
         Example usage
 
@@ -201,53 +338,204 @@ class IsaRestClient:
             client = IsaRestClient(dl_folder='tmp/')
             client.import_mw_to_tab('ST000367')
         """
-        response = requests.get(self.baseurl + '/api/v1/import/mw/' + accession)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            data = response.content
-            outpath = os.path.join(self.dl_folder, 'out.zip')
-            with open(outpath, 'wb') as f:
-                f.write(data)
-            return os.path.abspath(f.name)
+        return self._download(self._request('GET', '/api/v1/import/mw/' + accession), '.zip')
 
-    def convert_tab_to_sampletab(self, zipped_tab_bytes):
+    def convert_tab_to_sampletab(self, zipped_tab):
         """
-        :param isa_json_zip_bytes: Bytes of zip file containing ISA JSON and data files to sent to converter service
-        :return: Absolute path for SampleTab file named out.txt returned by converter service
+        :param zipped_tab: Bytes of, or path to, zip file containing ISA tabs to sent to converter service
+        :return: Absolute path for SampleTab file returned by converter service, named out-<unique>.txt
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient(dl_folder='tmp/')
-            client.convert_tab_to_sampletab(open('testdata/BII-S-3_json.zip', 'rb').read())
+            client.convert_tab_to_sampletab('testdata/BII-S-3.zip')
         """
-        response = requests.post(self.baseurl + '/api/v1/convert/isatab-to-sampletab',
-                                 headers={'Content-type': 'application/zip'}, data=zipped_tab_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            data = response.content
-            outpath = os.path.join(self.dl_folder, 'out.txt')
-            with open(outpath, 'wb') as f:
-                f.write(data)
-            return os.path.abspath(f.name)
+        return self._download(self._request('POST', '/api/v1/convert/isatab-to-sampletab', zipped_tab,
+                                            'application/zip'), '.txt')
 
-    def convert_json_to_sampletab(self, isa_json_bytes):
+    def convert_json_to_sampletab(self, isa_json):
         """
-        :param isa_json_bytes: Bytes of zip file containing ISA tabs to sent to converter service
-        :return: Absolute path for local ZIP file named out.zip returned by converter service
+        :param isa_json: Bytes of, or path to, ISA JSON to sent to converter service
+        :return: Absolute path for SampleTab file returned by converter service, named out-<unique>.txt
 
         Example usage
 
             from isarest_client import IsaRestClient
             client = IsaRestClient(dl_folder='tmp/')
-            client.convert_json_to_sampletab(open('testdata/BII-S-3.zip', 'rb').read())
-        """
-        response = requests.post(self.baseurl + '/api/v1/convert/json-to-sampletab',
-                                 headers={'Content-type': 'application/json'}, data=isa_json_bytes, verify=False)
-        print("HTTP response code: " + str(response.status_code))
-        if response.ok:
-            data = response.content
-            outpath = os.path.join(self.dl_folder, 'out.txt')
-            with open(outpath, 'wb') as f:
-                f.write(data)
-            return os.path.abspath(f.name)
\ No newline at end of file
+            client.convert_json_to_sampletab('testdata/BII-S-3.json')
+        """
+        return self._download(self._request('POST', '/api/v1/convert/json-to-sampletab', isa_json,
+                                            'application/json'), '.txt')
+
+
+class AsyncIsaRestClient:
+
+    """asyncio interface to IsaRestClient, running at most concurrency requests at a time
+
+    This is not a non-blocking client: requests are made by a blocking IsaRestClient, with its connection pool, retries
+    and streaming, on a pool of concurrency threads, so they do not block the event loop. Calls beyond that wait for a
+    free slot, so awaiting many calls at once does not open more connections.
+
+    Example usage
+
+        from isarest_client import AsyncIsaRestClient
+        async with AsyncIsaRestClient(dl_folder='tmp/', concurrency=8) as client:
+            status, path = await client.convert('tab-to-json', 'testdata/BII-S-3.zip')
+    """
+
+    def __init__(self, baseurl='http://localhost:5000', dl_folder='/tmp', concurrency=8, **options):
+        """
+        :param options: Further options of IsaRestClient, e.g. retries or timeout
+        """
+        self.concurrency = concurrency
+        self.client = IsaRestClient(baseurl=baseurl, dl_folder=dl_folder, pool_maxsize=concurrency, **options)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='isarest-client')
+        self._slots = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # waits for the calls still running in the thread pool without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.client.close()
+
+    async def convert(self, operation, data):
+        """Run any of the operations in ENDPOINTS, see IsaRestClient.convert"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)  # bound to the running event loop
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self.client.convert, operation,
+                                                                    data)
+
+    async def convert_many(self, operation, inputs):
+        """Run operation on every input, concurrency at a time
+
+        Inputs are taken from the iterable inputs only as fast as they are converted, so it may be a generator over
+        more inputs than fit in memory.
+        :param inputs: Iterable of bytes of, or paths to, inputs
+        :return: List of dicts with the input, its status (finished or failed), HTTP status code, output path or
+            error, and latency in seconds, in the order the conversions finished
+        """
+        queue = asyncio.Queue(maxsize=self.concurrency)
+        results = []
+
+        async def worker():
+            while True:
+                data = await queue.get()
+                if data is None:
+                    return
+                started = time.time()
+                result = {'input': data if isinstance(data, (str, os.PathLike)) else '<{} bytes>'.format(len(data))}
+                try:
+                    status_code, output = await self.convert(operation, data)
+                    result.update(status_code=status_code)
+                    if output is None:
+                        result.update(status='failed', error='HTTP {}'.format(status_code))
+                    else:
+                        result.update(status='finished', output=output)
+                except Exception as e:
+                    result.update(status='failed', error=str(e) or repr(e))
+                result['seconds'] = time.time() - started
+                results.append(result)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        try:
+            for data in inputs:
+                await queue.put(data)  # waits while every worker is busy and the queue is full
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        return results
+
+
+def _percentile(ordered, p):
+    # nearest rank
+    if not ordered:
+        return None
+    return ordered[max(int(math.ceil(p / 100.0 * len(ordered))) - 1, 0)]
+
+
+def summarize(results, elapsed):
+    """
+    :param results: Results of AsyncIsaRestClient.convert_many
+    :param elapsed: Seconds the conversions took altogether
+    :return: Dict of counts, throughput and latency percentiles, with the result of every input
+    """
+    latencies = sorted(result['seconds'] for result in results)
+    return {
+        'inputs': len(results),
+        'finished': sum(1 for result in results if result['status'] == 'finished'),
+        'failed': sum(1 for result in results if result['status'] == 'failed'),
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed else None,
+        'latency': {
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'p50': _percentile(latencies, 50),
+            'p95': _percentile(latencies, 95),
+            'p99': _percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None
+        },
+        'results': sorted(results, key=lambda result: str(result['input']))
+    }
+
+
+def bulk_convert(operation, input_dir, dl_folder, baseurl='http://localhost:5000', concurrency=8, **options):
+    """Run operation on every file in input_dir, writing the outputs to dl_folder
+
+    :return: Summary as returned by summarize()
+    """
+    inputs = (os.path.join(input_dir, name) for name in sorted(os.listdir(input_dir))
+              if not name.startswith('.') and os.path.isfile(os.path.join(input_dir, name)))
+
+    async def run():
+        async with AsyncIsaRestClient(baseurl=baseurl, dl_folder=dl_folder, concurrency=concurrency,
+                                      **options) as client:
+            return await client.convert_many(operation, inputs)
+    started = time.time()
+    results = asyncio.run(run())
+    return summarize(results, time.time() - started)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert or validate every file in a directory with the ISA REST '
+                                                 'service, several at a time')
+    parser.add_argument('operation', choices=sorted(name for name, (_, mimetype, _) in ENDPOINTS.items() if mimetype),
+                        help='conversion or validation to run')
+    parser.add_argument('input_dir', help='directory of inputs')
+    parser.add_argument('--url', default='http://localhost:5000', help='base URL of the service')
+    parser.add_argument('--output-dir', default='.', help='directory to write the outputs to')
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight at a time')
+    parser.add_argument('--retries', type=int, default=3, help='times a failed request is retried')
+    parser.add_argument('--timeout', type=float, help='seconds to wait on the service before giving up')
+    parser.add_argument('--no-compress', dest='compress', action='store_false',
+                        help='send JSON and SampleTab inputs as they are instead of gzipped')
+    parser.add_argument('--report', help='file to write the summary, with the result of every input, to as JSON')
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    summary = bulk_convert(args.operation, args.input_dir, args.output_dir, baseurl=args.url,
+                           concurrency=args.concurrency, retries=args.retries, timeout=args.timeout,
+                           compress=args.compress)
+    for result in summary['results']:
+        print("{input}: {status} in {seconds:.3f}s {detail}".format(detail=result.get('output', result.get('error')),
+                                                                    **result))
+    latency = summary['latency']
+    print("{} inputs, {} finished, {} failed in {:.2f}s, {:.2f}/s, p50 {:.3f}s, p95 {:.3f}s, p99 {:.3f}s".format(
+        summary['inputs'], summary['finished'], summary['failed'], summary['elapsed'], summary['throughput'] or 0,
+        latency['p50'] or 0, latency['p95'] or 0, latency['p99'] or 0))
+    if args.report:
+        with open(args.report, 'w') as report_fp:
+            json.dump(summary, report_fp, indent=2)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Content-Encoding of request and response bodies: gzip, and zstd if the zstandard package is installed.
+
+Request bodies are decoded as they are read, so a compressed upload is never inflated in memory as a whole, and
+responses are compressed a chunk at a time as they are sent.
+"""
+import gzip
+import zlib
+
+import config
+
+try:
+    import zstandard
+except ImportError:  # optional, zstd bodies are then rejected and zstd is never offered for responses
+    zstandard = None
+
+
+# errors raised reading a corrupt or truncated body
+DECODE_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def encodings():
+    """
+    :return: List of the content codings supported, in order of preference for responses
+    """
+    return (['zstd'] if zstandard is not None else []) + ['gzip']
+
+
+def decoded_stream(fileobj, encoding):
+    """
+    :param fileobj: Binary file object of the body as sent
+    :param encoding: Value of the Content-Encoding header, None or identity for an unencoded body
+    :return: Binary file object reading the decoded body from fileobj, None if encoding is not supported
+    """
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return fileobj
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+    return None
+
+
+def negotiate(accept_encodings):
+    """
+    :param accept_encodings: werkzeug Accept of the request's Accept-Encoding header
+    :return: Content coding to compress the response with, None to send it as it is
+    """
+    return accept_encodings.best_match(encodings())
+
+
+def compressed(chunks, encoding):
+    """Generate chunks, an iterable of bytes, compressed with encoding as returned by negotiate"""
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=config.COMPRESSION_ZSTD_LEVEL).compressobj()
+    else:
+        compressor = zlib.compressobj(config.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,125 @@
+"""
+Registry of the ISA-Tab configurations in ISA_CONFIG_FOLDER, parsed once and indexed by measurement and technology type.
+
+The XML files are parsed on first use, or ahead of forking by isarest_server, and kept in memory along with their
+contents. Every CONFIG_RELOAD_INTERVAL seconds a lookup checks the directory for added, removed or changed files and,
+if there are any, parses it again and swaps the new configurations in.
+"""
+import os
+import logging
+import glob
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import config
+import isarest_converters
+
+logger = logging.getLogger(__name__)
+
+
+# measurement and technology are the term labels as written in the file, key is them lowered as isatools looks them up
+ConfigEntry = namedtuple('ConfigEntry', 'name, file, measurement, technology, table_name, key, xml, config')
+
+
+def _stamp(config_dir):
+    """Identifies the files in config_dir as they are now, without reading them"""
+    h = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(config_dir, '*.xml'))):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue  # removed meanwhile
+        h.update('{}:{}:{}'.format(os.path.basename(path), st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _parse(config_dir):
+    """
+    :return: OrderedDict of name -> ConfigEntry, ordered by name
+    """
+    configurator = isarest_converters.load_module('isatools.io.isatab_configurator')
+    entries = OrderedDict()
+    for path in sorted(glob.glob(os.path.join(config_dir, '*.xml'))):
+        with open(path, 'rb') as xml_fp:
+            xml = xml_fp.read()
+        try:
+            config_obj = configurator.parse(inFileName=path, silence=True)
+            table = config_obj.get_isatab_configuration()[0]
+            measurement = table.get_measurement().get_term_label()
+            technology = table.get_technology().get_term_label()
+        except Exception as e:
+            logger.error("Could not parse ISA configuration %s: %s", path, e)
+            continue
+        name = os.path.splitext(os.path.basename(path))[0]
+        entries[name] = ConfigEntry(name, os.path.basename(path), measurement, technology, table.table_name,
+                                    (measurement.lower(), technology.lower()), xml, config_obj)
+    return entries
+
+
+class ConfigRegistry:
+
+    """ISA-Tab configurations of config_dir, reloaded when the files change"""
+
+    def __init__(self, config_dir, reload_interval):
+        self.config_dir = config_dir
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._state = None  # (stamp, entries by name, configs by key), replaced as a whole on reload
+        self._checked = 0
+
+    def _current(self):
+        now = time.time()
+        if self._state is not None and now - self._checked < self.reload_interval:
+            return self._state
+        with self._lock:
+            if self._state is None or now - self._checked >= self.reload_interval:
+                stamp = _stamp(self.config_dir)
+                if self._state is None or stamp != self._state[0]:
+                    entries = _parse(self.config_dir)
+                    self._state = (stamp, entries, {entry.key: entry.config for entry in entries.values()})
+                self._checked = now
+            return self._state
+
+    @property
+    def fingerprint(self):
+        """Changes whenever the configurations are reloaded"""
+        return self._current()[0]
+
+    def configs(self):
+        """
+        :return: Dict of (measurement type, technology type) -> configuration, as isatools.isatab.load_config
+            returns it, not to be modified
+        """
+        return self._current()[2]
+
+    def entries(self, measurement=None, technology=None):
+        """
+        :return: List of ConfigEntry, those for measurement and technology type if given, matched case-insensitively
+        """
+        return [entry for entry in self._current()[1].values()
+                if (measurement is None or entry.key[0] == measurement.lower()) and
+                (technology is None or entry.key[1] == technology.lower())]
+
+    def get(self, name):
+        """
+        :param name: Name of the configuration file without .xml, e.g. transcription_micro
+        :return: ConfigEntry, None if there is no such configuration
+        """
+        return self._current()[1].get(name)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def registry():
+    """
+    :return: The ConfigRegistry of ISA_CONFIG_FOLDER
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ConfigRegistry(config.ISA_CONFIG_FOLDER, config.CONFIG_RELOAD_INTERVAL)
+        return _registry
@@ -0,0 +1,518 @@
+"""
+File based conversion and validation functions. Each takes the path of the uploaded input and a work directory it may
+write into, and returns the path of its output: a single file, or a directory whose top level files make up the output
+archive. They do not touch the Flask request, so they can run in the request thread or in a job worker process alike.
+
+The isatools modules a converter needs are only imported the first time it runs, or when load() warms it up, so a
+process serving a few endpoints does not pay for importing every converter at start up.
+"""
+import io
+import os
+import sys
+import glob
+import posixpath
+import shutil
+import copy
+import time
+import zipfile
+import importlib
+import threading
+from collections import namedtuple, OrderedDict
+
+import config
+import isarest_json
+import isarest_metrics
+import isarest_validation
+import isarest_zip
+
+
+IMPORT_TIMES = OrderedDict()  # module name -> seconds its first import took, in the order they were imported
+_import_lock = threading.Lock()
+
+
+def load_module(name):
+    """Import module name on first use, recording how long the import took in IMPORT_TIMES"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    with _import_lock:
+        if name not in sys.modules:
+            started = time.time()
+            importlib.import_module(name)
+            IMPORT_TIMES[name] = time.time() - started
+    return sys.modules[name]
+
+
+def _extract(zip_path, work_dir, members=None):
+    """Unpack into work_dir/src the members of the ZIP archive at zip_path that a converter reads
+
+    :param members: Function(isarest_zip.Archive) returning the names of the members to unpack, None for all of them
+    :return: Tuple of (the source directory, names of all members of the archive)
+    """
+    src_dir = os.path.join(work_dir, 'src')
+    with isarest_metrics.phase('unpack'), isarest_zip.Archive(zip_path) as archive:
+        names = archive.names()
+        os.makedirs(src_dir, exist_ok=True)
+        archive.extract(names if members is None else members(archive), src_dir)
+        return os.path.normpath(src_dir), names
+
+
+def _is_investigation(name):
+    return 'i_' in name and name.endswith('.txt')
+
+
+def _referenced(archive, name, labels):
+    """
+    :return: Names of the members that the rows of tab separated member name labelled with any of labels refer to
+    """
+    base = posixpath.dirname(name)
+    refs = []
+    with io.TextIOWrapper(archive.open(name), encoding='utf-8', errors='replace') as fp:
+        for line in fp:
+            cells = [cell.strip().strip('"') for cell in line.rstrip('\r\n').split('\t')]
+            if cells[0] in labels:
+                refs.extend(posixpath.join(base, cell) for cell in cells[1:] if cell)
+    return refs
+
+
+def _isatab_members(archive):
+    """The investigation files and the study and assay tables, those they name and those named as such, leaving out
+    data files"""
+    names = archive.files()
+    selected = [n for n in names if _is_investigation(n) or
+                posixpath.basename(n).startswith(('s_', 'a_')) and n.endswith('.txt')]
+    for name in [n for n in names if _is_investigation(n)]:
+        selected.extend(_referenced(archive, name, ('Study File Name', 'Study Assay File Name')))
+    return sorted(set(selected) & set(names))
+
+
+def _magetab_members(archive):
+    """The IDF and the SDRF files, those it names and those named as such, leaving out data files"""
+    names = archive.files()
+    selected = [n for n in names if n.endswith(('.idf.txt', '.sdrf.txt'))]
+    for name in [n for n in names if n.endswith('.idf.txt')]:
+        selected.extend(_referenced(archive, name, ('SDRF File',)))
+    return sorted(set(selected) & set(names))
+
+
+def _json_members(archive):
+    return [n for n in archive.files() if n.endswith('.json')]
+
+
+def _out_dir(work_dir):
+    out_dir = os.path.join(work_dir, 'out')
+    os.mkdir(out_dir)
+    return out_dir
+
+
+def _dump_json(obj, work_dir, default=None):
+    out_path = os.path.join(work_dir, 'out.json')
+    with isarest_metrics.phase('serialize'):
+        isarest_json.dump(obj, out_path, default=default)
+    return out_path
+
+
+def _dump_isa_json(ISA, work_dir):
+    # encode the model straight to the output file, where isatab2json and magetab2json would round trip it through
+    # an in memory JSON string and a parsed dict first
+    return _dump_json(ISA, work_dir, default=load_module('isatools.isajson').ISAJSONEncoder().default)
+
+
+def _load_isatab(src_dir):
+    i_files = glob.glob(os.path.join(src_dir, 'i_*.txt'))
+    if len(i_files) == 0:
+        raise IOError("Could not resolve input investigation file")
+    with open(i_files[0], 'r', encoding='utf-8') as i_fp:
+        return load_module('isatools.isatab').load(i_fp)
+
+
+def _investigation_file(src_dir, names):
+    i_file_list = [n for n in names if _is_investigation(n)]
+    if len(i_file_list) != 1:
+        raise IOError("Could not resolve investigation file entry point")
+    return os.path.normpath(os.path.join(src_dir, i_file_list[0]))
+
+
+def output_members(output_dir):
+    """
+    :param output_dir: Output directory returned by one of the converters
+    :return: Generator of (path, name in archive) for everything below output_dir, directories before their contents
+    """
+    for root, dirs, files in os.walk(output_dir):
+        dirs.sort()
+        for name in dirs + sorted(files):
+            path = os.path.join(root, name)
+            yield path, os.path.relpath(path, output_dir)
+
+
+def tab_to_json(src_path, work_dir):
+    src_dir, _ = _extract(src_path, work_dir, _isatab_members)
+    return _dump_isa_json(_load_isatab(src_dir), work_dir)
+
+
+def json_to_tab(src_path, work_dir):
+    out_dir = _out_dir(work_dir)
+    with open(src_path) as json_fp:
+        load_module('isatools.convert.json2isatab').convert(json_fp, out_dir)
+    return out_dir
+
+
+def tab_to_sra(src_path, work_dir):
+    src_dir, _ = _extract(src_path, work_dir, _isatab_members)
+    out_dir = _out_dir(work_dir)
+    load_module('isatools.convert.isatab2sra').convert(src_dir, out_dir, validate_first=False)
+    return out_dir
+
+
+def json_to_sra(src_path, work_dir):
+    # the SRA export only reads the document, data files are referred to by name
+    src_dir, names = _extract(src_path, work_dir, lambda archive: archive.names()[:1])
+    out_dir = _out_dir(work_dir)
+    with open(os.path.normpath(os.path.join(src_dir, names[0]))) as json_fp:
+        load_module('isatools.convert.json2sra').convert(json_fp, out_dir, validate_first=False)
+    return out_dir
+
+
+def tab_to_cedar(src_path, work_dir):
+    src_dir, _ = _extract(src_path, work_dir, _isatab_members)
+    tab2cedar = load_module('isatools.convert.isatab2cedar').ISATab2CEDAR('http://www.isa-tools.org/')
+    tab2cedar.createCEDARjson(src_dir, src_dir, True)
+    # return just the combined JSON
+    files = [f for f in os.listdir(src_dir) if f.endswith('.json')]
+    if len(files) != 1:  # current assumption is that only one JSON should exist to know what to return
+        raise IOError("More than one .json was output - cannot disambiguate what to return")
+    return os.path.join(src_dir, files[0])
+
+
+def validate_json(src_path, work_dir):
+    return _dump_json(isarest_validation.validate_json(src_path), work_dir)
+
+
+def validate_isatab(src_path, work_dir):
+    src_dir, names = _extract(src_path, work_dir, _isatab_members)
+    return _dump_json(isarest_validation.validate_isatab(_investigation_file(src_dir, names)), work_dir)
+
+
+def sampletab_to_isatab(src_path, work_dir):
+    out_dir = _out_dir(work_dir)
+    with open(src_path) as input_fp:
+        load_module('isatools.convert.sampletab2isatab').convert(input_fp, out_dir)
+    return out_dir
+
+
+def sampletab_to_json(src_path, work_dir):
+    with open(src_path) as input_fp:
+        return _dump_isa_json(load_module('isatools.sampletab').load(input_fp), work_dir)
+
+
+def json_to_sampletab(src_path, work_dir):
+    out_path = os.path.join(work_dir, 'out.txt')
+    with open(src_path) as json_fp:
+        with open(out_path, 'w') as st_fp:
+            load_module('isatools.convert.json2sampletab').convert(json_fp, st_fp)
+    return out_path
+
+
+def isatab_to_sampletab(src_path, work_dir):
+    src_dir, names = _extract(src_path, work_dir, _isatab_members)
+    out_path = os.path.join(work_dir, 'out.txt')
+    with open(_investigation_file(src_dir, names)) as i_fp:
+        with open(out_path, 'w') as st_fp:
+            load_module('isatools.convert.isatab2sampletab').convert(i_fp, st_fp)
+    return out_path
+
+
+def magetab_to_json(src_path, work_dir):
+    src_dir, _ = _extract(src_path, work_dir, _magetab_members)
+    files = [f for f in os.listdir(src_dir) if f.endswith('.idf.txt')]
+    if len(files) != 1:
+        raise IOError("Could not generate JSON from input MAGE-TAB")
+    isatab_dir = os.path.join(work_dir, 'isatab')
+    os.mkdir(isatab_dir)
+    load_module('isatools.convert.magetab2isatab').convert(os.path.join(src_dir, files[0]), output_path=isatab_dir)
+    return _dump_isa_json(_load_isatab(isatab_dir), work_dir)
+
+
+def _material_records(materials, parents):
+    for key, record_type in (('sources', 'source'), ('samples', 'sample'), ('otherMaterials', 'otherMaterial')):
+        for data in materials.get(key, []):
+            yield dict(parents, type=record_type, data=data)
+
+
+def isa_records(ISA):
+    """Generate the records of an ISA model's line-delimited JSON (NDJSON) output, one at a time
+
+    The investigation comes first, without its studies. Each study follows without its materials, processes and
+    assays, then its sources, samples, other materials and processes. Then come each of its assays, likewise followed
+    by its materials, data files and processes. Every record is a dict of the type of the record, the file name of
+    its study and assay if it belongs to one, and its ISA-JSON as data. Only one study is encoded at a time.
+    """
+    encoder = load_module('isatools.isajson').ISAJSONEncoder()
+    investigation = copy.copy(ISA)
+    investigation.studies = []
+    data = encoder.default(investigation)
+    data.pop('studies', None)
+    yield {'type': 'investigation', 'data': data}
+    for study in ISA.studies:
+        data = encoder.default(study)
+        materials, processes, assays = data.pop('materials', {}), data.pop('processSequence', []), \
+            data.pop('assays', [])
+        parents = {'study': study.filename}
+        yield dict(parents, type='study', data=data)
+        for record in _material_records(materials, parents):
+            yield record
+        for process in processes:
+            yield dict(parents, type='process', data=process)
+        for assay in assays:
+            materials, data_files, processes = assay.pop('materials', {}), assay.pop('dataFiles', []), \
+                assay.pop('processSequence', [])
+            assay_parents = dict(parents, assay=assay.get('filename'))
+            yield dict(assay_parents, type='assay', data=assay)
+            for record in _material_records(materials, assay_parents):
+                yield record
+            for data_file in data_files:
+                yield dict(assay_parents, type='dataFile', data=data_file)
+            for process in processes:
+                yield dict(assay_parents, type='process', data=process)
+
+
+def tab_to_records(src_path, work_dir):
+    """
+    :return: Generator of the NDJSON records of the ISA-Tab archive at src_path, see isa_records
+    """
+    src_dir, _ = _extract(src_path, work_dir, _isatab_members)
+    return isa_records(_load_isatab(src_dir))
+
+
+class ParsedInput:
+
+    """An ISA-Tab or ISA-JSON input unpacked into a directory, and parsed into the ISA model at most once
+
+    Sessions run several operations on one ParsedInput, so however many outputs are produced from an upload it is
+    only extracted and parsed once. Operations on one input run one at a time, as the isatools dumpers are not known to
+    leave the model untouched.
+    """
+
+    def __init__(self, kind, src_dir, src_path, archive=None):
+        """
+        :param kind: isatab or json
+        :param src_dir: Directory holding the input files
+        :param src_path: Path of the investigation file or of the ISA-JSON document in src_dir
+        :param archive: Path of the uploaded ZIP archive, for the members that were not unpacked into src_dir
+        """
+        self.kind = kind
+        self.src_dir = src_dir
+        self.src_path = src_path
+        self.archive = archive
+        self._model = None
+        self._lock = threading.RLock()
+
+    @property
+    def parsed(self):
+        return self._model is not None
+
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                if self.kind == 'isatab':
+                    self._model = _load_isatab(self.src_dir)
+                else:
+                    with open(self.src_path) as json_fp:
+                        self._model = load_module('isatools.isajson').load(json_fp)
+            return self._model
+
+    def run(self, operation, work_dir):
+        """Run operation, one of MODEL_OPERATIONS[kind], writing into work_dir
+
+        :return: Path of the output, as for the functions in CONVERTERS
+        """
+        with self._lock:
+            return MODEL_OPERATIONS[self.kind][operation](self, work_dir)
+
+
+def parse_input(kind, upload_path, work_dir):
+    """Unpack an upload into work_dir/src, without parsing it yet
+
+    Only the ISA-Tab tables or the ISA-JSON document are unpacked. Data files uploaded along with an ISA-JSON document
+    stay in the archive, which is moved into work_dir, until an operation reads them.
+    :param kind: isatab for a ZIP archive of ISA-Tab, json for an ISA-JSON document or a ZIP archive holding one
+        along with its data files
+    :param upload_path: Path of the upload, which is moved into work_dir if not an ISA-Tab archive
+    :return: ParsedInput
+    """
+    if kind == 'isatab':
+        src_dir, names = _extract(upload_path, work_dir, _isatab_members)
+        return ParsedInput(kind, src_dir, _investigation_file(src_dir, names))
+    if kind != 'json':
+        raise ValueError("Unknown kind of input " + kind)
+    if zipfile.is_zipfile(upload_path):
+        src_dir, names = _extract(upload_path, work_dir, _json_members)
+        json_names = [n for n in names if n.endswith('.json')]
+        if len(json_names) != 1:
+            raise IOError("Could not resolve ISA-JSON document")
+        archive_path = os.path.join(work_dir, 'src.zip')
+        shutil.move(upload_path, archive_path)
+        return ParsedInput(kind, src_dir, os.path.normpath(os.path.join(src_dir, json_names[0])), archive_path)
+    src_dir = os.path.join(work_dir, 'src')
+    os.mkdir(src_dir)
+    src_path = os.path.join(src_dir, 'in.json')
+    shutil.move(upload_path, src_path)
+    return ParsedInput(kind, src_dir, src_path)
+
+
+def _model_to_json(parsed, work_dir):
+    return _dump_isa_json(parsed.model(), work_dir)
+
+
+def _model_to_sra(parsed, work_dir):
+    out_dir = _out_dir(work_dir)
+    load_module('isatools.sra').export(parsed.model(), out_dir)
+    return out_dir
+
+
+def _model_to_sampletab(parsed, work_dir):
+    out_path = os.path.join(work_dir, 'out.txt')
+    with open(out_path, 'w') as st_fp:
+        load_module('isatools.sampletab').dump(parsed.model(), st_fp)
+    return out_path
+
+
+def _model_to_tab(parsed, work_dir):
+    out_dir = _out_dir(work_dir)
+    load_module('isatools.isatab').dump(isa_obj=parsed.model(), output_path=out_dir)
+    # data files uploaded along with the ISA-JSON go into the archive too, as json2isatab does, copied straight from
+    # the upload
+    if parsed.archive is not None:
+        with isarest_zip.Archive(parsed.archive) as archive:
+            for name in archive.files():
+                if '/' not in name and not name.endswith('.json'):
+                    archive.copy(name, os.path.join(out_dir, name))
+    return out_dir
+
+
+def _input_to_cedar(parsed, work_dir):
+    # the CEDAR converter parses the ISA-Tab itself, so only the extraction is shared
+    out_dir = _out_dir(work_dir)
+    tab2cedar = load_module('isatools.convert.isatab2cedar').ISATab2CEDAR('http://www.isa-tools.org/')
+    tab2cedar.createCEDARjson(parsed.src_dir, out_dir, True)
+    files = [f for f in os.listdir(out_dir) if f.endswith('.json')]
+    if len(files) != 1:
+        raise IOError("More than one .json was output - cannot disambiguate what to return")
+    return os.path.join(out_dir, files[0])
+
+
+def _validate_isatab_input(parsed, work_dir):
+    return _dump_json(isarest_validation.validate_isatab(parsed.src_path), work_dir)
+
+
+def _validate_json_input(parsed, work_dir):
+    return _dump_json(isarest_validation.validate_json(parsed.src_path), work_dir)
+
+
+# kind of input -> operation -> function(ParsedInput, work directory) returning the path of the output
+MODEL_OPERATIONS = {
+    'isatab': {
+        'tab-to-json': _model_to_json,
+        'tab-to-sra': _model_to_sra,
+        'tab-to-cedar': _input_to_cedar,
+        'isatab-to-sampletab': _model_to_sampletab,
+        'validate-isatab': _validate_isatab_input
+    },
+    'json': {
+        'json-to-tab': _model_to_tab,
+        'json-to-sra': _model_to_sra,
+        'json-to-sampletab': _model_to_sampletab,
+        'validate-json': _validate_json_input
+    }
+}
+
+
+# mimetype is the expected request mimetype (None accepts any), upload_name the file name the request body is
+# written to, output_mimetype the mimetype of the returned file, application/zip for output directories, and modules
+# the modules convert imports
+Converter = namedtuple('Converter', ['mimetype', 'upload_name', 'convert', 'output_mimetype', 'modules'])
+
+CONVERTERS = {
+    'tab-to-json': Converter('application/zip', 'isatab.zip', tab_to_json, 'application/json',
+                             ('isatools.isatab', 'isatools.isajson')),
+    'json-to-tab': Converter('application/json', 'in.json', json_to_tab, 'application/zip',
+                             ('isatools.convert.json2isatab',)),
+    'tab-to-sra': Converter('application/zip', 'isatab.zip', tab_to_sra, 'application/zip',
+                            ('isatools.convert.isatab2sra',)),
+    'json-to-sra': Converter('application/zip', 'isajson.zip', json_to_sra, 'application/zip',
+                             ('isatools.convert.json2sra',)),
+    'tab-to-cedar': Converter('application/zip', 'isatab.zip', tab_to_cedar, 'application/json',
+                              ('isatools.convert.isatab2cedar',)),
+    'validate-json': Converter('application/json', 'in.json', validate_json, 'application/json',
+                               ('isatools.isajson',)),
+    'validate-isatab': Converter('application/zip', 'isatab.zip', validate_isatab, 'application/json',
+                                 ('isatools.isatab',)),
+    'sampletab-to-isatab': Converter(None, 'in.txt', sampletab_to_isatab, 'application/zip',
+                                     ('isatools.convert.sampletab2isatab',)),
+    'sampletab-to-json': Converter(None, 'in.txt', sampletab_to_json, 'application/json',
+                                   ('isatools.sampletab', 'isatools.isajson')),
+    'json-to-sampletab': Converter('application/json', 'in.json', json_to_sampletab, 'text/tab-separated-values',
+                                   ('isatools.convert.json2sampletab',)),
+    'isatab-to-sampletab': Converter('application/zip', 'in.zip', isatab_to_sampletab, 'text/tab-separated-values',
+                                     ('isatools.convert.isatab2sampletab',)),
+    'magetab-to-json': Converter('application/zip', 'magetab.zip', magetab_to_json, 'application/json',
+                                 ('isatools.convert.magetab2isatab', 'isatools.isatab', 'isatools.isajson'))
+}
+
+# fan-out endpoint -> (kind of input, target -> operation in MODEL_OPERATIONS), every target is produced from one parse
+FANOUT_TARGETS = {
+    'tab-to-all': ('isatab', OrderedDict([('json', 'tab-to-json'), ('sra', 'tab-to-sra'),
+                                          ('sampletab', 'isatab-to-sampletab'), ('cedar', 'tab-to-cedar')])),
+    'json-to-all': ('json', OrderedDict([('tab', 'json-to-tab'), ('sra', 'json-to-sra'),
+                                         ('sampletab', 'json-to-sampletab')]))
+}
+
+# modules of the endpoints that are not plain conversions of the request body
+ENDPOINT_MODULES = {
+    'import-mw': ('isatools.net.mw2isa',),
+    'tab-to-all': ('isatools.isatab', 'isatools.isajson', 'isatools.sra', 'isatools.sampletab',
+                   'isatools.convert.isatab2cedar'),
+    'json-to-all': ('isatools.isajson', 'isatools.isatab', 'isatools.sra', 'isatools.sampletab')
+}
+
+
+def _endpoint_modules():
+    modules = OrderedDict((name, converter.modules) for name, converter in CONVERTERS.items())
+    modules.update(ENDPOINT_MODULES)
+    return modules
+
+
+def enabled(name):
+    """
+    :param name: Name of a conversion or validation, a key of CONVERTERS, or of another endpoint in ENDPOINT_MODULES
+    :return: Whether the endpoint is served, according to ENABLED_ENDPOINTS
+    """
+    return config.ENABLED_ENDPOINTS is None or name in config.ENABLED_ENDPOINTS
+
+
+def modules(names=None):
+    """
+    :return: Names of the modules of the endpoints names, by default all enabled ones
+    """
+    endpoint_modules = _endpoint_modules()
+    return [module for name in (names if names is not None else filter(enabled, endpoint_modules))
+            for module in endpoint_modules[name]]
+
+
+def load(names=None):
+    """Import the modules of the endpoints names, by default all enabled ones, ahead of their first use"""
+    for module in modules(names):
+        load_module(module)
+
+
+def startup_report():
+    """
+    :return: Dict of the enabled endpoints, those whose modules are imported, and the time each import took
+    """
+    endpoint_modules = _endpoint_modules()
+    return {
+        'enabled': list(filter(enabled, endpoint_modules)),
+        'loaded': [name for name, modules in endpoint_modules.items() if all(m in sys.modules for m in modules)],
+        'imports': [{'module': module, 'seconds': seconds} for module, seconds in IMPORT_TIMES.items()],
+        'import_seconds': sum(IMPORT_TIMES.values())
+    }
@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import signal
+import zipfile
+import resource
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import config
+import isarest_converters
+from isarest_converters import CONVERTERS, ParsedInput, output_members
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def _write_status(job_dir, **fields):
+    status_path = os.path.join(job_dir, 'job.json')
+    with open(status_path) as status_fp:
+        status = json.load(status_fp)
+    status.update(fields)
+    tmp_path = status_path + '.' + str(uuid.uuid4())
+    with open(tmp_path, 'w') as tmp_fp:
+        json.dump(status, tmp_fp)
+    os.replace(tmp_path, status_path)  # readers never see a partially written status
+
+
+def _on_alarm(signum, frame):
+    raise JobTimeout("Job exceeded its time limit")
+
+
+@contextmanager
+def _limited(timeout, memory_limit):
+    """Run the enclosed block, in a worker process, within the time and memory limits"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if memory_limit:
+        if hard != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+    previous_handler = signal.signal(signal.SIGALRM, _on_alarm)
+    signal.alarm(int(timeout))
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def _convert(operation, src_path, work_dir, timeout, memory_limit):
+    """Runs in a worker process: convert src_path within the time and memory limits
+
+    :return: Path of the result in work_dir, a zip archive if the converter produced a directory
+    """
+    with _limited(timeout, memory_limit):
+        output_path = CONVERTERS[operation].convert(src_path, work_dir)
+        if not os.path.isdir(output_path):
+            return output_path
+        result_path = os.path.join(work_dir, 'result.zip')
+        with zipfile.ZipFile(result_path, 'w') as zf:
+            for path, arcname in output_members(output_path):
+                zf.write(path, arcname)
+        return result_path
+
+
+# token -> ParsedInput of a running fan-out, inherited by the processes forked for its operations
+_fanout_inputs = dict()
+
+
+def _run_operation(token, operation, work_dir, timeout, memory_limit):
+    """Runs in a process forked from a fan-out worker: run operation on the parsed input of the fan-out token"""
+    with _limited(timeout, memory_limit):
+        return _fanout_inputs[token].run(operation, work_dir)
+
+
+def _run_fanout(source, operations, work_dirs, max_workers, timeout, memory_limit):
+    """Runs in a worker process: parse the input, then run the operations on it in processes forked from here
+
+    Worker processes run a single thread, so forking one holds no lock another thread could have taken. Where fork is
+    not available the operations run one after another in the worker instead.
+    :param source: Tuple of (kind, src_dir, src_path, archive) of the ParsedInput
+    :return: List holding for each operation, in order, a tuple of (path of output, None) or (None, error message)
+    """
+    parsed = ParsedInput(*source)
+    with _limited(timeout, memory_limit):
+        parsed.model()
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        results = []
+        for operation, operation_dir in zip(operations, work_dirs):
+            try:
+                with _limited(timeout, memory_limit):
+                    results.append((parsed.run(operation, operation_dir), None))
+            except Exception as e:
+                results.append((None, str(e) or repr(e)))
+        return results
+    token = str(uuid.uuid4())
+    _fanout_inputs[token] = parsed
+    try:
+        with ProcessPoolExecutor(max_workers=max(min(len(operations), max_workers), 1),
+                                 mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(_run_operation, token, operation, operation_dir, timeout, memory_limit)
+                       for operation, operation_dir in zip(operations, work_dirs)]
+            results = []
+            for future in futures:
+                try:
+                    results.append((future.result(), None))
+                except BrokenProcessPool as e:
+                    results.append((None, "Worker process died: {}".format(e)))
+                except Exception as e:
+                    results.append((None, str(e) or repr(e)))
+            return results
+    finally:
+        del _fanout_inputs[token]
+
+
+def _pool_context():
+    """Context the worker pool is started with. Rather than forking the server process, from a request thread while
+    others may hold locks, workers are forked by a forkserver: a fresh single-threaded process started for the purpose
+
+    Unless SERVER_PRELOAD_CONVERTERS is off, the forkserver imports the isatools modules of the enabled endpoints
+    before forking any worker, so the workers, and the processes they fork per fan-out operation, share those pages
+    copy-on-write rather than each importing isatools on its first job.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context()
+    context = multiprocessing.get_context('forkserver')
+    preload = ['isarest_jobs']
+    if config.SERVER_PRELOAD_CONVERTERS:
+        preload.extend(isarest_converters.modules())
+    context.set_forkserver_preload(preload)
+    return context
+
+
+def _run_job(job_dir, operation, src_path, timeout, memory_limit):
+    """Runs in a worker process: convert src_path and leave the result in job_dir"""
+    _write_status(job_dir, status='running', started=time.time())
+    work_dir = os.path.join(job_dir, 'work')
+    os.mkdir(work_dir)
+    output_path = _convert(operation, src_path, work_dir, timeout, memory_limit)
+    result_path = os.path.join(job_dir, 'result' + os.path.splitext(output_path)[1])
+    shutil.move(output_path, result_path)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    _write_status(job_dir, status='finished', finished=time.time(), result=os.path.basename(result_path))
+
+
+class JobManager:
+
+    """Runs conversions and validations asynchronously on a pool of worker processes
+
+    The state of every job is kept in <jobs_dir>/<job id>/job.json so that any server process sharing jobs_dir can
+    report on it. Finished jobs are removed once they are older than retention seconds.
+    """
+
+    def __init__(self, jobs_dir, max_workers, timeout, memory_limit, retention):
+        self.jobs_dir = jobs_dir
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.retention = retention
+        self._executor = None
+        self._lock = threading.Lock()
+        if not os.path.exists(jobs_dir):
+            os.makedirs(jobs_dir)
+
+    def _get_executor(self):
+        # worker processes are only started once the first job comes in
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=_pool_context())
+            return self._executor
+
+    def _discard_executor(self, executor):
+        # a worker dying outright breaks the whole pool, so the next submission has to start a new one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def _limits(self, timeout, memory_limit):
+        timeout = min(timeout, self.timeout) if timeout else self.timeout
+        if memory_limit and self.memory_limit:
+            memory_limit = min(memory_limit, self.memory_limit)
+        else:
+            memory_limit = memory_limit or self.memory_limit
+        return timeout, memory_limit
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, os.path.basename(job_id))
+
+    def create(self, operation):
+        """
+        :param operation: Name of the conversion or validation, a key of CONVERTERS
+        :return: Tuple of (job id, directory the input for the job should be written to)
+        """
+        job_id = str(uuid.uuid4())
+        job_dir = self._job_dir(job_id)
+        os.mkdir(job_dir)
+        with open(os.path.join(job_dir, 'job.json'), 'w') as status_fp:
+            json.dump({'id': job_id, 'operation': operation, 'status': 'created', 'submitted': time.time()},
+                      status_fp)
+        return job_id, job_dir
+
+    def submit(self, job_id, src_path, timeout=None, memory_limit=None):
+        """Queue a created job. timeout (seconds) and memory_limit (bytes) may only lower the configured limits"""
+        self.purge()
+        job_dir = self._job_dir(job_id)
+        timeout, memory_limit = self._limits(timeout, memory_limit)
+        operation = self.status(job_id)['operation']
+        _write_status(job_dir, status='queued', timeout=timeout, memory_limit=memory_limit)
+        executor = self._get_executor()
+        future = executor.submit(_run_job, job_dir, operation, src_path, timeout, memory_limit)
+
+        def on_done(f):
+            # exceptions raised in the worker, and workers dying outright, only surface here
+            error = f.exception()
+            if isinstance(error, BrokenProcessPool):
+                self._discard_executor(executor)
+            if error is not None:
+                _write_status(job_dir, status='failed', finished=time.time(), error=str(error) or repr(error))
+        future.add_done_callback(on_done)
+
+    def run_batch(self, operation, items, timeout=None, memory_limit=None):
+        """Convert many inputs in parallel on the worker pool and wait for all of them
+
+        Every item runs under its own time and memory limits. Should an item take down its worker, and with it the
+        pool, the items that were caught up in that are retried one at a time on a fresh pool, so only the offending
+        item fails.
+        :param operation: Name of the conversion or validation, a key of CONVERTERS
+        :param items: List of (path of input, work directory for the item)
+        :return: List holding for each item, in order, a tuple of (path of result, None) or (None, error message)
+        """
+        timeout, memory_limit = self._limits(timeout, memory_limit)
+        results = [None] * len(items)
+        executor = self._get_executor()
+        futures = [executor.submit(_convert, operation, src_path, work_dir, timeout, memory_limit)
+                   for src_path, work_dir in items]
+        retry = []
+        for i, future in enumerate(futures):
+            try:
+                results[i] = (future.result(), None)
+            except BrokenProcessPool:
+                retry.append(i)
+            except Exception as e:
+                results[i] = (None, str(e) or repr(e))
+        if retry:
+            self._discard_executor(executor)
+        for i in retry:
+            executor = self._get_executor()
+            src_path, work_dir = items[i]
+            try:
+                results[i] = (executor.submit(_convert, operation, src_path, work_dir, timeout, memory_limit).result(),
+                              None)
+            except BrokenProcessPool as e:
+                self._discard_executor(executor)
+                results[i] = (None, "Worker process died: {}".format(e))
+            except Exception as e:
+                results[i] = (None, str(e) or repr(e))
+        return results
+
+    def run_fanout(self, parsed, operations, work_dir, timeout=None, memory_limit=None):
+        """Run several operations on one parsed input in parallel and wait for all of them
+
+        The fan-out runs in a worker of the pool, which parses the input and then forks a process per operation, so
+        they all start from the parsed model, shared copy-on-write, rather than parsing it again. Every operation runs
+        under its own time and memory limits, as does the parse.
+        :param parsed: ParsedInput, not parsed yet
+        :param operations: Operations in MODEL_OPERATIONS for the kind of parsed
+        :param work_dir: Directory to create a work directory per operation in
+        :return: List holding for each operation, in order, a tuple of (path of output, None) or (None, error message)
+        """
+        timeout, memory_limit = self._limits(timeout, memory_limit)
+        work_dirs = []
+        for operation in operations:
+            work_dirs.append(os.path.join(work_dir, operation))
+            os.mkdir(work_dirs[-1])
+        executor = self._get_executor()
+        source = (parsed.kind, parsed.src_dir, parsed.src_path, parsed.archive)
+        try:
+            return executor.submit(_run_fanout, source, operations, work_dirs, self.max_workers, timeout,
+                                   memory_limit).result()
+        except BrokenProcessPool as e:
+            self._discard_executor(executor)
+            return [(None, "Worker process died: {}".format(e))] * len(operations)
+
+    def abandon(self, job_id, error):
+        """Mark a job that could not be submitted as failed, removing everything written for it but its status"""
+        job_dir = self._job_dir(job_id)
+        for entry in os.scandir(job_dir):
+            if entry.name == 'job.json':
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+        _write_status(job_dir, status='failed', finished=time.time(), error=error)
+
+    def status(self, job_id):
+        """
+        :return: Dict describing the job, or None if there is no such job
+        """
+        try:
+            with open(os.path.join(self._job_dir(job_id), 'job.json')) as status_fp:
+                return json.load(status_fp)
+        except (OSError, ValueError):
+            return None
+
+    def result_path(self, job_id):
+        status = self.status(job_id)
+        if status is None or status['status'] != 'finished':
+            return None
+        return os.path.join(self._job_dir(job_id), status['result'])
+
+    def purge(self):
+        """Remove finished, failed and never submitted jobs older than the retention period"""
+        now = time.time()
+        for job_id in os.listdir(self.jobs_dir):
+            status = self.status(job_id)
+            if status is not None and status['status'] in ('created', 'finished', 'failed') and \
+                    now - status.get('finished', status['submitted']) > self.retention:
+                shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
@@ -0,0 +1,83 @@
+import json
+import logging
+
+import config
+
+try:
+    import orjson
+except ImportError:  # listed in requirements.txt, the standard library encoder is used if it is missing
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+if config.JSON_ENCODER == 'orjson' and orjson is None:
+    logger.warning("JSON_ENCODER is orjson but orjson is not installed, using the standard library encoder")
+
+# levels of nested objects and arrays written a member at a time by the orjson encoder, below which a value is
+# encoded whole: investigation, its studies, a study, its assays and materials
+ORJSON_CHUNK_DEPTH = 4
+
+_SCALARS = (str, int, float, bool, type(None))
+
+
+def _dump_stdlib(obj, fp, default):
+    # iterencode hands over the document a fragment at a time and the buffered file batches the writes, so the
+    # encoded document is never held in memory as a whole
+    for chunk in json.JSONEncoder(default=default).iterencode(obj):
+        fp.write(chunk.encode('utf-8'))
+
+
+def _dump_orjson(obj, fp, default, depth=ORJSON_CHUNK_DEPTH):
+    # orjson only encodes a whole value at once, so the outer objects and arrays are written a member at a time and
+    # only one member of depth ORJSON_CHUNK_DEPTH, e.g. an assay, is held encoded in memory
+    if depth > 0 and default is not None and not isinstance(obj, _SCALARS + (dict, list, tuple)):
+        try:
+            obj = default(obj)
+        except TypeError:
+            pass  # a type orjson encodes itself
+    if depth == 0 or not isinstance(obj, (dict, list, tuple)):
+        fp.write(orjson.dumps(obj, default=default))
+    elif isinstance(obj, dict):
+        fp.write(b'{')
+        for i, (key, value) in enumerate(obj.items()):
+            fp.write(b',' if i else b'')
+            fp.write(orjson.dumps(key if isinstance(key, str) else json.dumps(key).strip('"')))
+            fp.write(b':')
+            _dump_orjson(value, fp, default, depth - 1)
+        fp.write(b'}')
+    else:
+        fp.write(b'[')
+        for i, value in enumerate(obj):
+            fp.write(b',' if i else b'')
+            _dump_orjson(value, fp, default, depth - 1)
+        fp.write(b']')
+
+
+# name -> function(obj, binary file object, default) writing obj to the file object as JSON
+ENCODERS = {
+    'json': _dump_stdlib
+}
+if orjson is not None:
+    ENCODERS['orjson'] = _dump_orjson
+
+
+def dump(obj, out_path, default=None):
+    """Write obj as JSON to out_path using the encoder named by JSON_ENCODER
+
+    :param obj: Object to encode
+    :param out_path: Path of the file to write
+    :param default: Function returning a serializable version of objects the encoder cannot handle, e.g.
+        ISAJSONEncoder().default for ISA model objects
+    """
+    encoder = ENCODERS.get(config.JSON_ENCODER, _dump_stdlib)
+    with open(out_path, 'wb', buffering=config.RESPONSE_CHUNK_SIZE) as out_fp:
+        encoder(obj, out_fp, default)
+
+
+def dumps_line(obj, default=None):
+    """
+    :return: obj encoded as one line of JSON, newline included, as bytes, for line-delimited JSON (NDJSON) output
+    """
+    if config.JSON_ENCODER == 'orjson' and orjson is not None:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, default=default, separators=(',', ':')) + '\n').encode('utf-8')
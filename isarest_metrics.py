@@ -0,0 +1,385 @@
+"""
+Prometheus metrics of the ISA REST service.
+
+Every server process keeps its own metrics. When configured with a directory shared by the server processes of a node,
+each process writes its values to <dir>/<pid>.<token>.json after the requests it handles, at most every FLUSH_INTERVAL
+seconds, and a scrape of any process adds up the files of all of them. So counters and histograms cover the whole node
+whichever worker answers, and do not go backwards when a worker is recycled: the files of processes that have exited
+are folded into <dir>/archive.json.
+Gauges are summed over live processes only, except those set from node-wide state when scraped, which are reported as
+the scraped process sets them.
+"""
+import os
+import logging
+import json
+import time
+import uuid
+import fcntl
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+PHASES = ('ingest', 'unpack', 'convert', 'pack', 'serialize')
+
+# seconds, spanning quick validations to conversions of large studies
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+SIZE_BUCKETS = tuple(4 ** n * 1024 * 1024 for n in range(8))  # 1 MiB to 16 GiB
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+_changed = [False]  # set whenever a metric of this process changes, cleared when its values are written out
+
+
+class _Metric:
+
+    kind = None
+    aggregate = 'sum'  # how the values of the server processes of a node are reported, see the module docstring
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = dict()  # tuple of label values -> value
+        self._lock = threading.Lock()
+
+    def _samples(self, values):
+        raise NotImplementedError
+
+    @staticmethod
+    def merge(value, other):
+        """
+        :return: Sum of two values of the metric
+        """
+        return value + other
+
+    def dump(self):
+        """
+        :return: List of [label values, value], as JSON can hold it
+        """
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def render(self, values=None):
+        """
+        :param values: Dict of tuple of label values -> value to report, this process's values if None
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            lines.extend(self._samples(self._values if values is None else values))
+        return lines
+
+
+class Counter(_Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+            _changed[0] = True
+
+    def _samples(self, values):
+        return ['{}{} {}'.format(self.name, _format_labels(self.labels, key), _format_value(value))
+                for key, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), aggregate='live'):
+        """
+        :param aggregate: live to sum the values of the live server processes, or scraped for gauges set from
+            node-wide state when scraped, reported as the scraped process set them
+        """
+        super(Gauge, self).__init__(name, documentation, labels)
+        self.aggregate = aggregate
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+            _changed[0] = True
+
+
+class Histogram(_Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts, total = self._values.get(label_values, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[label_values] = (counts, total + value)
+            _changed[0] = True
+
+    @staticmethod
+    def merge(value, other):
+        return [a + b for a, b in zip(value[0], other[0])], value[1] + other[1]
+
+    def _samples(self, values):
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labels, key,
+                                                                              [('le', _format_value(bound))]),
+                                                     count))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.labels, key), _format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labels, key), counts[-1]))
+        return lines
+
+
+requests_total = Counter('isarest_requests_total', 'Requests handled, by resource and status code',
+                         ('resource', 'status'))
+request_duration = Histogram('isarest_request_duration_seconds', 'Time spent handling requests, by resource',
+                             ('resource',))
+phase_duration = Histogram('isarest_phase_duration_seconds',
+                           'Time spent in each phase of handling requests, by resource and phase: ' +
+                           ', '.join(PHASES), ('resource', 'phase'))
+bytes_in = Counter('isarest_request_bytes_total', 'Bytes received in request bodies, by resource', ('resource',))
+bytes_out = Counter('isarest_response_bytes_total', 'Bytes sent in response bodies, by resource', ('resource',))
+in_flight = Gauge('isarest_requests_in_flight', 'Requests currently being handled')
+workspace_bytes = Gauge('isarest_workspace_bytes', 'Bytes used by the workspaces of all server processes',
+                        aggregate='scraped')
+workspace_quota = Gauge('isarest_workspace_quota_bytes', 'Bytes the workspaces may use together', aggregate='scraped')
+workspaces = Gauge('isarest_workspaces', 'Workspaces of the scraped server process, by state', ('state',),
+                   aggregate='scraped')
+coalesced = Counter('isarest_coalesced_requests_total', 'Requests served the result of an identical request that '
+                    'was in flight when they arrived, by endpoint', ('endpoint',))
+mw_imports = Counter('isarest_mw_imports_total', 'Metabolomics Workbench study lookups, by outcome: hit, coalesced '
+                     '(served the result of a concurrent import), imported or failed', ('outcome',))
+admission_running = Gauge('isarest_admission_running', 'Conversions running on this node, by operation',
+                          ('operation',), aggregate='scraped')
+admission_waiting = Gauge('isarest_admission_queue_depth', 'Requests on this node waiting for a conversion to start, '
+                          'by operation', ('operation',), aggregate='scraped')
+admission_limit = Gauge('isarest_admission_limit', 'Conversions that may run at a time on this node, by operation',
+                        ('operation',), aggregate='scraped')
+admission_wait = Histogram('isarest_admission_wait_seconds', 'Time requests waited for a conversion to start, by '
+                           'operation', ('operation',))
+admission_rejected = Counter('isarest_admission_rejected_total', 'Requests turned away with 503 as the queue was full '
+                             'or they waited too long, by operation', ('operation',))
+request_cpu = Counter('isarest_request_cpu_seconds_total', 'CPU time spent handling requests, by resource',
+                      ('resource',))
+request_rss_growth = Histogram('isarest_request_peak_rss_growth_bytes', 'Growth of the peak resident set size of '
+                               'the server process while handling a request, by resource', ('resource',),
+                               buckets=SIZE_BUCKETS)
+
+REGISTRY = [requests_total, request_duration, phase_duration, bytes_in, bytes_out, in_flight, workspace_bytes,
+            workspace_quota, workspaces, coalesced, mw_imports, admission_running, admission_waiting, admission_limit,
+            admission_wait, admission_rejected, request_cpu, request_rss_growth]
+
+_local = threading.local()
+
+
+def begin(resource):
+    """Attribute the phases timed on this thread to resource, until end() is called"""
+    _local.resource = resource
+    _local.phases = []
+
+
+def end():
+    _local.resource = None
+    _local.phases = []
+
+
+def current_resource():
+    return getattr(_local, 'resource', None)
+
+
+@contextmanager
+def phase(name):
+    """Time the enclosed block as phase name of the current request
+
+    Phases may nest, the time of an inner phase only counts towards the inner one. Outside of a request, e.g. in a
+    job worker process, nothing is recorded.
+    """
+    resource = current_resource()
+    if resource is None:
+        yield
+        return
+    frame = [0.0]  # time spent in nested phases
+    _local.phases.append(frame)
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        _local.phases.pop()
+        if _local.phases:
+            _local.phases[-1][0] += elapsed
+        phase_duration.observe(max(elapsed - frame[0], 0.0), resource, name)
+
+
+def observe_phase(resource, name, seconds):
+    if resource is not None:
+        phase_duration.observe(seconds, resource, name)
+
+
+FLUSH_INTERVAL = 1.0  # seconds, at most one write of the values of a process per interval
+
+_store = {'dir': None, 'path': None, 'pid': None, 'flushed': 0.0, 'timer': None}
+_flush_lock = threading.Lock()
+
+
+def configure(metrics_dir):
+    """Share metrics with the other server processes through metrics_dir, or keep them to this process if None"""
+    if metrics_dir is not None and not os.path.exists(metrics_dir):
+        os.makedirs(metrics_dir)
+    _store['dir'] = metrics_dir
+
+
+def clear():
+    """Remove the metrics of earlier runs from the configured directory, before the server processes start"""
+    if _store['dir'] is None:
+        return
+    for entry in os.scandir(_store['dir']):
+        if entry.name.endswith('.json'):
+            os.remove(entry.path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read(path):
+    try:
+        with open(path) as values_fp:
+            return json.load(values_fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, data):
+    tmp_path = path + '.' + str(uuid.uuid4())
+    with open(tmp_path, 'w') as values_fp:
+        json.dump(data, values_fp)
+    os.replace(tmp_path, path)  # readers never see partially written values
+
+
+def flush(force=False):
+    """Write the values of this process to the configured directory, if they changed since they were last written
+
+    Unless forced, values written less than FLUSH_INTERVAL seconds ago are written again once the interval is over.
+    """
+    if _store['dir'] is None:
+        return
+    with _flush_lock:
+        if _store['pid'] != os.getpid():  # a forked process must not write to its parent's file, nor has its timer
+            _store.update(pid=os.getpid(), flushed=0.0, timer=None,
+                          path=os.path.join(_store['dir'], '{}.{}.json'.format(os.getpid(), uuid.uuid4().hex)))
+            _changed[0] = True
+        if not _changed[0]:
+            return
+        wait = _store['flushed'] + FLUSH_INTERVAL - time.time()
+        if wait > 0 and not force:
+            if _store['timer'] is None:
+                _store['timer'] = threading.Timer(wait, _flush_later)
+                _store['timer'].daemon = True
+                _store['timer'].start()
+            return
+        _changed[0] = False
+        _store['flushed'] = time.time()
+        try:
+            _write(_store['path'], {metric.name: metric.dump() for metric in REGISTRY
+                                    if metric.aggregate != 'scraped'})
+        except OSError as e:
+            logger.error("Could not write metrics: %s", e)
+
+
+def _flush_later():
+    with _flush_lock:
+        _store['timer'] = None
+    flush()
+
+
+def _add(merged, data, metrics, kinds):
+    for name, entries in (data or {}).items():
+        metric = metrics.get(name)
+        if metric is None or metric.kind not in kinds:
+            continue
+        values = merged.setdefault(name, dict())
+        for key, value in entries:
+            key = tuple(key)
+            values[key] = metric.merge(values[key], value) if key in values else value
+
+
+def collect():
+    """Add up the values written by the server processes sharing the configured directory
+
+    The files of processes that have exited are folded into the archive, leaving out their gauges.
+    :return: Dict of metric name -> dict of tuple of label values -> value
+    """
+    metrics = {metric.name: metric for metric in REGISTRY}
+    with open(os.path.join(_store['dir'], 'lock'), 'a') as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)  # released when closed
+        archive_path = os.path.join(_store['dir'], 'archive.json')
+        archive = dict()
+        _add(archive, _read(archive_path), metrics, ('counter', 'histogram'))
+        archived = False
+        live = dict()
+        for entry in os.scandir(_store['dir']):
+            parts = entry.name.split('.')
+            if len(parts) != 3 or parts[2] != 'json' or not parts[0].isdigit():
+                continue
+            data = _read(entry.path)
+            if _pid_alive(int(parts[0])):
+                _add(live, data, metrics, ('counter', 'gauge', 'histogram'))
+            else:
+                _add(archive, data, metrics, ('counter', 'histogram'))
+                os.remove(entry.path)
+                archived = True
+        if archived:
+            _write(archive_path, {name: [[list(key), value] for key, value in values.items()]
+                                  for name, values in archive.items()})
+    for name, values in archive.items():
+        merged = live.setdefault(name, dict())
+        for key, value in values.items():
+            merged[key] = metrics[name].merge(merged[key], value) if key in merged else value
+    return live
+
+
+def render():
+    """
+    :return: All metrics in the Prometheus text exposition format, of all server processes of the node if a
+        directory is configured
+    """
+    shared = None
+    if _store['dir'] is not None:
+        flush(force=True)
+        shared = collect()
+    lines = []
+    for metric in REGISTRY:
+        if shared is None or metric.aggregate == 'scraped':
+            lines.extend(metric.render())
+        else:
+            lines.extend(metric.render(shared.get(metric.name, dict())))
+    return '\n'.join(lines) + '\n'
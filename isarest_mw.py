@@ -0,0 +1,205 @@
+"""
+Metabolomics Workbench import, cached per accession and deduplicated across requests and server processes.
+
+The ISA-Tab generated for a study is kept as a ZIP archive in MW_CACHE_FOLDER for MW_CACHE_TTL seconds. An import holds
+a lock file for its accession, so concurrent requests for the same study, in any server process sharing the cache
+folder, wait for the one import in flight and are then served its archive. They poll for the lock rather than block on
+it, and give up after a while, so an import hanging on the remote does not hold up their workers as long as it hangs.
+The lock file is removed by the import holding it once it is done.
+"""
+import os
+import logging
+import re
+import uuid
+import time
+import fcntl
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import isarest_metrics
+from isarest_converters import load_module, output_members
+
+logger = logging.getLogger(__name__)
+
+
+ACCESSION = re.compile(r'^ST\d{6}$')
+
+
+class MWImportError(Exception):
+    pass
+
+
+class InvalidAccession(MWImportError):
+    pass
+
+
+class UnknownStudy(MWImportError):
+    pass
+
+
+class ImportInProgress(MWImportError):
+
+    def __init__(self, message, retry_after):
+        super(ImportInProgress, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def mw2isa_import(studyid, out_dir):
+    """Import a study from the Metabolomics Workbench with isatools' mw2isa
+
+    :return: Directory holding the ISA-Tab of the study
+    """
+    success, _, _ = load_module('isatools.net.mw2isa').mw2isa_convert(studyid=studyid, outputdir=out_dir,
+                                                                       dl_option="no", validate_option="no")
+    output_dir = os.path.join(out_dir, studyid)
+    if not success or not os.path.isdir(output_dir):
+        raise MWImportError("Could not import {} from the Metabolomics Workbench".format(studyid))
+    return output_dir
+
+
+def stub_import(stub_dir):
+    """
+    :param stub_dir: Directory holding the ISA-Tab of every study in a directory named after its accession
+    :return: Import function serving studies from stub_dir instead of the Metabolomics Workbench, to run offline
+    """
+    def import_study(studyid, out_dir):
+        src_dir = os.path.join(stub_dir, studyid)
+        if not os.path.isdir(src_dir):
+            raise UnknownStudy("No study {} in {}".format(studyid, stub_dir))
+        output_dir = os.path.join(out_dir, studyid)
+        shutil.copytree(src_dir, output_dir)
+        return output_dir
+    return import_study
+
+
+class MWImporter:
+
+    """Imports studies with import_study, a function(accession, work directory) returning the directory the ISA-Tab
+    was written to, and keeps their archives in cache_dir for ttl seconds. A request waits up to wait_timeout seconds
+    for an import of the same study in flight"""
+
+    def __init__(self, cache_dir, ttl, import_study, max_workers, wait_timeout=None, poll_interval=0.05):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.import_study = import_study
+        self.max_workers = max_workers
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.work_dir = os.path.join(cache_dir, 'work')
+        if not os.path.exists(self.work_dir):
+            os.makedirs(self.work_dir)
+
+    def _archive_path(self, studyid):
+        return os.path.join(self.cache_dir, studyid + '.zip')
+
+    def _fresh(self, archive_path):
+        try:
+            return time.time() - os.stat(archive_path).st_mtime < self.ttl
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _try_lock(lock_path):
+        """
+        :return: File object of the lock file at lock_path, locked until closed, or None if another process holds it
+        """
+        lock_fp = open(lock_path, 'w')
+        try:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.path.samestat(os.fstat(lock_fp.fileno()), os.stat(lock_path)):
+                return lock_fp
+        except (BlockingIOError, FileNotFoundError):
+            pass
+        # held, or locked a file its holder removed when done
+        lock_fp.close()
+        return None
+
+    def _lock(self, studyid, lock_path):
+        started = time.time()
+        while True:
+            lock_fp = self._try_lock(lock_path)
+            if lock_fp is not None:
+                return lock_fp
+            if self.wait_timeout is not None and time.time() - started >= self.wait_timeout:
+                raise ImportInProgress("Import of {} still in progress after {} seconds".format(
+                    studyid, self.wait_timeout), config.ADMISSION_RETRY_AFTER)
+            time.sleep(self.poll_interval)
+
+    def archive(self, studyid):
+        """Import studyid unless a fresh archive of it is cached, waiting on an import of it already in flight
+
+        :return: Tuple of (path of the ZIP archive of the study's ISA-Tab, whether it was served from the cache)
+        :raises ImportInProgress: If an import of studyid in flight did not finish within wait_timeout seconds
+        """
+        if not ACCESSION.match(studyid):
+            raise InvalidAccession("{} is not a Metabolomics Workbench accession".format(studyid))
+        archive_path = self._archive_path(studyid)
+        if self._fresh(archive_path):
+            isarest_metrics.mw_imports.inc(1, 'hit')
+            return archive_path, True
+        lock_path = archive_path + '.lock'
+        with self._lock(studyid, lock_path):  # released when closed
+            try:
+                return self._import(studyid, archive_path)
+            finally:
+                os.remove(lock_path)  # whoever waits on it locks the file in place from now on
+
+    def _import(self, studyid, archive_path):
+        # called with the lock of studyid held
+        if self._fresh(archive_path):
+            isarest_metrics.mw_imports.inc(1, 'coalesced')
+            return archive_path, True
+        self.purge()
+        import_dir = os.path.join(self.work_dir, 'mw-{}-{}'.format(studyid, uuid.uuid4()))
+        os.makedirs(import_dir)
+        tmp_path = archive_path + '.' + str(uuid.uuid4())
+        try:
+            output_dir = self.import_study(studyid, import_dir)
+            with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for path, arcname in output_members(output_dir):
+                    zf.write(path, arcname)
+            os.replace(tmp_path, archive_path)  # readers never see a partially written archive
+        except Exception:
+            isarest_metrics.mw_imports.inc(1, 'failed')
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        finally:
+            shutil.rmtree(import_dir, ignore_errors=True)
+        isarest_metrics.mw_imports.inc(1, 'imported')
+        return archive_path, False
+
+    def prefetch(self, studyids):
+        """Import the studies that are not cached yet, max_workers at a time
+
+        :return: List holding for each accession a dict of its status: cached, imported or failed, with the error
+        """
+        def fetch(studyid):
+            try:
+                _, cached = self.archive(studyid)
+                return {'studyid': studyid, 'status': 'cached' if cached else 'imported'}
+            except Exception as e:
+                logger.exception("Could not import %s: %s", studyid, e)
+                return {'studyid': studyid, 'status': 'failed', 'error': str(e) or repr(e)}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(fetch, studyids))
+
+    def purge(self):
+        """Remove expired archives, and the lock files of imports that did not get to remove them"""
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.zip') and not self._fresh(path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            elif name.endswith('.zip.lock'):
+                lock_fp = self._try_lock(path)  # never one in use
+                if lock_fp is not None:
+                    with lock_fp:
+                        os.remove(path)
+
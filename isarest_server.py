@@ -0,0 +1,91 @@
+import gc
+import json
+import logging
+import time
+import resource
+
+from gunicorn.app.base import BaseApplication
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def _rss():
+    """Current resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm_fp:
+            return int(statm_fp.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # no procfs, fall back to the peak resident set size, reported in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _recycle_if_bloated(worker, req, environ, resp):
+    """Gunicorn post_request hook retiring a worker whose memory has grown beyond SERVER_MAX_WORKER_RSS"""
+    rss = _rss()
+    if rss > config.SERVER_MAX_WORKER_RSS:
+        worker.log.info("Worker %s uses %s bytes RSS, above the limit of %s, recycling it", worker.pid, rss,
+                        config.SERVER_MAX_WORKER_RSS)
+        worker.alive = False  # finishes the current request, then the master forks a fresh worker
+
+
+def _preload():
+    """Import the app and, unless SERVER_PRELOAD_CONVERTERS is off, the enabled converters and the ISA configuration
+    registry in the master, then log how long each import took"""
+    # what the server, the app and its modules log goes to gunicorn's error log, set up before the app is loaded
+    error_log = logging.getLogger('gunicorn.error')
+    logging.root.handlers = error_log.handlers
+    logging.root.setLevel(error_log.level)
+    started = time.time()
+    from isarest import app
+    import isarest_configs
+    import isarest_converters
+    import isarest_metrics
+    isarest_metrics.clear()  # the counters of the node start from zero with the server
+    app_seconds = time.time() - started
+    if config.SERVER_PRELOAD_CONVERTERS:
+        isarest_converters.load()
+        isarest_configs.registry().configs()
+    report = isarest_converters.startup_report()
+    report.update(app_seconds=app_seconds, total_seconds=time.time() - started)
+    logger.info("Startup: %s", json.dumps(report))
+    # keep the collector from touching, and so copying, the preloaded objects in every forked worker
+    gc.freeze()
+    return app
+
+
+class IsaRestServer(BaseApplication):
+
+    """Pre-forking production server for the ISA REST service
+
+    The master process imports isatools and parses the ISA configurations once, then forks SERVER_WORKERS workers
+    that share those pages copy-on-write. Workers are recycled after about SERVER_MAX_REQUESTS requests or once
+    their RSS exceeds SERVER_MAX_WORKER_RSS, to contain memory growth from long running conversions. With
+    SERVER_PRELOAD_CONVERTERS off the master starts without isatools and workers import converters on first use.
+    """
+
+    def __init__(self, options=None):
+        self.options = options or dict()
+        super(IsaRestServer, self).__init__()
+
+    def load_config(self):
+        settings = {
+            'bind': config.SERVER_BIND,
+            'workers': config.SERVER_WORKERS,
+            'timeout': config.SERVER_TIMEOUT,
+            'max_requests': config.SERVER_MAX_REQUESTS,
+            'max_requests_jitter': config.SERVER_MAX_REQUESTS_JITTER,
+            'preload_app': True,
+            'post_request': _recycle_if_bloated
+        }
+        settings.update(self.options)
+        for key, value in settings.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return _preload()
+
+
+if __name__ == "__main__":
+    IsaRestServer().run()
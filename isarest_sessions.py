@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+from collections import OrderedDict
+
+from isarest_converters import MODEL_OPERATIONS, ParsedInput, parse_input
+
+
+class TooManySessions(Exception):
+    pass
+
+
+def _write_session(session_dir, session):
+    session_path = os.path.join(session_dir, 'session.json')
+    tmp_path = session_path + '.' + str(uuid.uuid4())
+    with open(tmp_path, 'w') as tmp_fp:
+        json.dump(session, tmp_fp)
+    os.replace(tmp_path, session_path)  # readers never see a partially written session
+
+
+class SessionManager:
+
+    """Keeps uploads unpacked between requests, so several operations can be run on one upload
+
+    Every session lives in <sessions_dir>/<session id>, holding the unpacked input and session.json, so any server
+    process sharing sessions_dir can run operations on it. The ISA model parsed from the input is kept in the memory
+    of the process that parsed it, for up to max_parsed sessions at a time, and reused by the operations it runs
+    later. A session expires ttl seconds after it was last used.
+    """
+
+    def __init__(self, sessions_dir, ttl, max_sessions, max_parsed):
+        self.sessions_dir = sessions_dir
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_parsed = max_parsed
+        self._parsed = OrderedDict()  # session id -> ParsedInput, least recently used first
+        self._lock = threading.Lock()
+        if not os.path.exists(sessions_dir):
+            os.makedirs(sessions_dir)
+
+    def _session_dir(self, session_id):
+        return os.path.join(self.sessions_dir, os.path.basename(session_id))
+
+    def _read(self, session_id):
+        try:
+            with open(os.path.join(self._session_dir(session_id), 'session.json')) as session_fp:
+                return json.load(session_fp)
+        except (OSError, ValueError):
+            return None
+
+    def _remember(self, session_id, parsed):
+        with self._lock:
+            self._parsed[session_id] = parsed
+            self._parsed.move_to_end(session_id)
+            while len(self._parsed) > self.max_parsed:
+                self._parsed.popitem(last=False)  # the unpacked input stays on disk, only the model is dropped
+
+    def _describe(self, session, parsed):
+        return dict(session, parsed=parsed is not None and parsed.parsed,
+                    operations=sorted(MODEL_OPERATIONS[session['kind']]))
+
+    def create(self, kind, upload_path):
+        """Unpack the upload at upload_path into a new session
+
+        :param kind: isatab or json, see parse_input
+        :return: Dict describing the session
+        """
+        self.purge()
+        if len(os.listdir(self.sessions_dir)) >= self.max_sessions:
+            raise TooManySessions("No more than {} sessions can be open".format(self.max_sessions))
+        session_id = str(uuid.uuid4())
+        session_dir = self._session_dir(session_id)
+        os.mkdir(session_dir)
+        try:
+            parsed = parse_input(kind, upload_path, session_dir)
+        except Exception:
+            shutil.rmtree(session_dir, ignore_errors=True)
+            raise
+        now = time.time()
+        session = {'id': session_id, 'kind': kind, 'created': now, 'expires': now + self.ttl,
+                   'src_dir': os.path.relpath(parsed.src_dir, session_dir),
+                   'src_path': os.path.relpath(parsed.src_path, session_dir),
+                   'archive': parsed.archive and os.path.relpath(parsed.archive, session_dir)}
+        _write_session(session_dir, session)
+        self._remember(session_id, parsed)
+        return self._describe(session, parsed)
+
+    def status(self, session_id):
+        """
+        :return: Dict describing the session, or None if there is no such session or it expired
+        """
+        session = self._read(session_id)
+        if session is None or session['expires'] < time.time():
+            return None
+        with self._lock:
+            parsed = self._parsed.get(session_id)
+        return self._describe(session, parsed)
+
+    def get(self, session_id):
+        """Look up a session to run an operation on, extending its lifetime by ttl seconds
+
+        :return: ParsedInput of the session, or None if there is no such session or it expired
+        """
+        session = self._read(session_id)
+        if session is None or session['expires'] < time.time():
+            return None
+        session_dir = self._session_dir(session_id)
+        session['expires'] = time.time() + self.ttl
+        _write_session(session_dir, session)
+        with self._lock:
+            parsed = self._parsed.get(session_id)
+        if parsed is None:
+            # opened by another server process, or its model was dropped, so it is parsed again here
+            archive = session.get('archive')
+            parsed = ParsedInput(session['kind'], os.path.join(session_dir, session['src_dir']),
+                                 os.path.join(session_dir, session['src_path']),
+                                 archive and os.path.join(session_dir, archive))
+        self._remember(session_id, parsed)
+        return parsed
+
+    def delete(self, session_id):
+        """
+        :return: False if there was no such session
+        """
+        with self._lock:
+            self._parsed.pop(session_id, None)
+        if self._read(session_id) is None:
+            return False
+        shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+        return True
+
+    def purge(self):
+        """Remove expired sessions"""
+        now = time.time()
+        for session_id in os.listdir(self.sessions_dir):
+            session = self._read(session_id)
+            if session is not None and session['expires'] < now:
+                self.delete(session_id)
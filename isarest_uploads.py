@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+
+import config
+from isarest_workspace import WorkspaceQuotaExceeded
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadTooLarge(UploadError):
+    pass
+
+
+class ChunkChecksumMismatch(UploadError):
+    pass
+
+
+class UploadIncomplete(UploadError):
+    pass
+
+
+class TooManyUploads(UploadError):
+    pass
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _write_upload(upload_dir, upload):
+    upload_path = os.path.join(upload_dir, 'upload.json')
+    tmp_path = upload_path + '.' + str(uuid.uuid4())
+    with open(tmp_path, 'w') as tmp_fp:
+        json.dump(upload, tmp_fp)
+    os.replace(tmp_path, upload_path)  # readers never see a partially written upload
+
+
+class UploadManager:
+
+    """Resumable uploads, sent as numbered chunks that are each verified by their SHA-256 digest
+
+    Every upload lives in <uploads_dir>/<upload id>, holding upload.json and a file per chunk received, so chunks can
+    be sent to any server process sharing uploads_dir, in any order, and sent again after a failure. Completing the
+    upload joins the chunks into one file, which requests to the other resources then name instead of sending a body.
+    An upload expires ttl seconds after it was last used.
+
+    Chunk indexes are limited to those an upload of max_size bytes sent in chunks of max_chunk_size needs, and to the
+    declared size of the upload, and every upload records the bytes stored for it, so chunks beyond max_size are
+    refused as they are sent. The bytes stored by all uploads are kept in <uploads_dir>/.stored, updated under the lock
+    of <uploads_dir>/.lock, for the workspace quota to count them.
+    """
+
+    def __init__(self, uploads_dir, ttl, max_uploads, max_size, max_chunk_size, bytes_free=None):
+        """
+        :param bytes_free: Callable returning the bytes of the disk quota still free, if chunks are to be refused
+            once it is used up
+        """
+        self.uploads_dir = uploads_dir
+        self.ttl = ttl
+        self.max_uploads = max_uploads
+        self.max_size = max_size
+        self.max_chunk_size = max_chunk_size
+        self.bytes_free = bytes_free
+        if not os.path.exists(uploads_dir):
+            os.makedirs(uploads_dir)
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.uploads_dir, '.lock'), 'a') as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)  # released when closed
+            yield
+
+    def _upload_ids(self):
+        return [name for name in os.listdir(self.uploads_dir) if not name.startswith('.')]
+
+    def _add_stored(self, nbytes):
+        # called with the lock held
+        stored_path = os.path.join(self.uploads_dir, '.stored')
+        tmp_path = stored_path + '.' + str(uuid.uuid4())
+        with open(tmp_path, 'w') as stored_fp:
+            stored_fp.write(str(max(self.bytes_stored() + nbytes, 0)))
+        os.replace(tmp_path, stored_path)
+
+    def bytes_stored(self):
+        """
+        :return: Bytes stored by all uploads, complete or not
+        """
+        try:
+            with open(os.path.join(self.uploads_dir, '.stored')) as stored_fp:
+                return int(stored_fp.read())
+        except (OSError, ValueError):
+            return 0
+
+    def max_chunks(self, upload):
+        """
+        :return: Number of chunks upload may be sent in, None if unlimited
+        """
+        limits = []
+        if self.max_size is not None:
+            limits.append(-(-self.max_size // self.max_chunk_size))
+        if upload['size'] is not None:
+            limits.append(max(upload['size'], 1))  # chunks of at least a byte, but an empty upload has one
+        return min(limits) if limits else None
+
+    def _upload_dir(self, upload_id):
+        return os.path.join(self.uploads_dir, os.path.basename(upload_id))
+
+    def _chunk_path(self, upload_id, index):
+        return os.path.join(self._upload_dir(upload_id), 'chunks', '{:08d}'.format(index))
+
+    def _read(self, upload_id):
+        try:
+            with open(os.path.join(self._upload_dir(upload_id), 'upload.json')) as upload_fp:
+                upload = json.load(upload_fp)
+        except (OSError, ValueError):
+            return None
+        upload.setdefault('stored', 0)  # not recorded by earlier versions
+        return upload if upload['expires'] >= time.time() else None
+
+    def _touch(self, upload):
+        upload['expires'] = time.time() + self.ttl
+        _write_upload(self._upload_dir(upload['id']), upload)
+
+    def _chunks(self, upload_id):
+        chunks_dir = os.path.join(self._upload_dir(upload_id), 'chunks')
+        if not os.path.isdir(chunks_dir):
+            return []
+        return sorted(int(name) for name in os.listdir(chunks_dir) if name.isdigit())
+
+    def _describe(self, upload):
+        if upload['complete']:
+            return dict(upload, chunks=[])
+        return dict(upload, chunks=self._chunks(upload['id']), received=upload['stored'])
+
+    def create(self, size=None, sha256=None):
+        """
+        :param size: Bytes the complete upload will have, checked when it is completed if given
+        :param sha256: Hex SHA-256 digest of the complete upload, checked when it is completed if given
+        :return: Dict describing the upload
+        """
+        self.purge()
+        if size is not None and self.max_size is not None and size > self.max_size:
+            raise UploadTooLarge("Uploads are limited to {} bytes".format(self.max_size))
+        if len(self._upload_ids()) >= self.max_uploads:
+            raise TooManyUploads("No more than {} uploads can be open".format(self.max_uploads))
+        upload_id = str(uuid.uuid4())
+        os.makedirs(os.path.join(self._upload_dir(upload_id), 'chunks'))
+        now = time.time()
+        upload = {'id': upload_id, 'created': now, 'expires': now + self.ttl, 'size': size,
+                  'sha256': sha256.lower() if sha256 else None, 'complete': False,
+                  'max_chunk_size': self.max_chunk_size, 'stored': 0}
+        upload['max_chunks'] = self.max_chunks(upload)
+        _write_upload(self._upload_dir(upload_id), upload)
+        return self._describe(upload)
+
+    def status(self, upload_id):
+        """
+        :return: Dict describing the upload, with the indexes of the chunks received so far, or None if there is no
+            such upload or it expired
+        """
+        upload = self._read(upload_id)
+        return self._describe(upload) if upload is not None else None
+
+    def put_chunk(self, upload_id, index, fileobj, sha256):
+        """Store chunk index of an upload, replacing any chunk sent with that index before
+
+        :param fileobj: Binary file object to read the chunk from
+        :param sha256: Hex SHA-256 digest the client computed for the chunk
+        :return: Dict describing the upload, None if there is no such upload or it expired
+        :raises UploadTooLarge: If index is beyond the chunks the upload may have, the chunk is larger than
+            max_chunk_size, or the upload would then store more than max_size bytes
+        :raises WorkspaceQuotaExceeded: If the chunk does not fit in the disk quota
+        """
+        upload = self._read(upload_id)
+        if upload is None:
+            return None
+        if upload['complete']:
+            raise UploadError("Upload {} is complete".format(upload_id))
+        max_chunks = self.max_chunks(upload)
+        if max_chunks is not None and index >= max_chunks:
+            raise UploadTooLarge("Upload {} is limited to {} chunks".format(upload_id, max_chunks))
+        chunk_path = self._chunk_path(upload_id, index)
+        tmp_path = chunk_path + '.' + str(uuid.uuid4())
+        stored = upload['stored'] - _file_size(chunk_path)  # by the other chunks
+        free = self.bytes_free() if self.bytes_free is not None else None
+        h = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as chunk_fp:
+                while True:
+                    data = fileobj.read(config.UPLOAD_CHUNK_SIZE)
+                    if not data:
+                        break
+                    size += len(data)
+                    if size > self.max_chunk_size:
+                        raise UploadTooLarge("Chunks are limited to {} bytes".format(self.max_chunk_size))
+                    if self.max_size is not None and stored + size > self.max_size:
+                        raise UploadTooLarge("Uploads are limited to {} bytes".format(self.max_size))
+                    if free is not None and size > free:
+                        raise WorkspaceQuotaExceeded("Chunk {} of upload {} does not fit in the quota".format(
+                            index, upload_id))
+                    h.update(data)
+                    chunk_fp.write(data)
+            if h.hexdigest() != sha256.lower():
+                raise ChunkChecksumMismatch("Chunk {} of upload {} does not match its checksum".format(index,
+                                                                                                    upload_id))
+            with self._locked():
+                upload = self._read(upload_id)  # as other chunks may have been stored meanwhile
+                if upload is None:
+                    return None
+                if upload['complete']:
+                    raise UploadError("Upload {} is complete".format(upload_id))
+                replaced = _file_size(chunk_path)
+                if self.max_size is not None and upload['stored'] - replaced + size > self.max_size:
+                    raise UploadTooLarge("Uploads are limited to {} bytes".format(self.max_size))
+                os.replace(tmp_path, chunk_path)  # a chunk is only ever seen whole
+                upload['stored'] += size - replaced
+                self._add_stored(size - replaced)
+                self._touch(upload)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return self._describe(upload)
+
+    def complete(self, upload_id):
+        """Join the chunks, numbered from 0 without gaps, into the file of the upload
+
+        :return: Dict describing the upload, None if there is no such upload or it expired
+        """
+        upload = self._read(upload_id)
+        if upload is None or upload['complete']:
+            return upload and self._describe(upload)
+        chunks = self._chunks(upload_id)
+        if chunks != list(range(len(chunks))) or not chunks:
+            raise UploadIncomplete("Upload {} is missing chunks".format(upload_id))
+        upload_dir = self._upload_dir(upload_id)
+        data_path = os.path.join(upload_dir, 'data')
+        tmp_path = data_path + '.' + str(uuid.uuid4())
+        h = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as data_fp:
+                for index in chunks:
+                    with open(self._chunk_path(upload_id, index), 'rb') as chunk_fp:
+                        while True:
+                            data = chunk_fp.read(config.UPLOAD_CHUNK_SIZE)
+                            if not data:
+                                break
+                            size += len(data)
+                            if self.max_size is not None and size > self.max_size:
+                                raise UploadTooLarge("Uploads are limited to {} bytes".format(self.max_size))
+                            h.update(data)
+                            data_fp.write(data)
+            if upload['size'] is not None and size != upload['size']:
+                raise UploadIncomplete("Upload {} has {} of {} bytes".format(upload_id, size, upload['size']))
+            if upload['sha256'] is not None and h.hexdigest() != upload['sha256']:
+                raise UploadIncomplete("Upload {} does not match its checksum".format(upload_id))
+            os.replace(tmp_path, data_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._locked():
+            shutil.rmtree(os.path.join(upload_dir, 'chunks'), ignore_errors=True)
+            current = self._read(upload_id)
+            stored = current['stored'] if current is not None else upload['stored']
+            upload.update(complete=True, size=size, sha256=h.hexdigest(), stored=size)
+            self._add_stored(size - stored)
+            self._touch(upload)
+        return self._describe(upload)
+
+    def claim(self, upload_id, dst_path):
+        """Link the file of a complete upload to dst_path, copying it only if dst_path is on another filesystem
+
+        The upload is kept, so it can be handed to several requests until it is deleted or expires.
+        :return: Tuple of (size, hex SHA-256 digest) of the upload, None if there is no such complete upload
+        """
+        upload = self._read(upload_id)
+        if upload is None or not upload['complete']:
+            return None
+        data_path = os.path.join(self._upload_dir(upload_id), 'data')
+        try:
+            os.link(data_path, dst_path)
+        except OSError:
+            shutil.copyfile(data_path, dst_path)
+        self._touch(upload)
+        return upload['size'], upload['sha256']
+
+    def delete(self, upload_id):
+        """
+        :return: False if there was no such upload
+        """
+        with self._locked():
+            upload = self._read(upload_id)
+            if upload is None:
+                return False
+            shutil.rmtree(self._upload_dir(upload_id), ignore_errors=True)
+            self._add_stored(-upload['stored'])
+        return True
+
+    def purge(self):
+        """Remove expired uploads, and recount the bytes stored by the others"""
+        now = time.time()
+        with self._locked():
+            stored = 0
+            for upload_id in self._upload_ids():
+                try:
+                    with open(os.path.join(self._upload_dir(upload_id), 'upload.json')) as upload_fp:
+                        upload = json.load(upload_fp)
+                except (OSError, ValueError):
+                    continue
+                if upload['expires'] < now:
+                    shutil.rmtree(self._upload_dir(upload_id), ignore_errors=True)
+                else:
+                    stored += upload.get('stored', 0)
+            self._add_stored(stored - self.bytes_stored())
@@ -0,0 +1,299 @@
+"""
+ISA-Tab and ISA-JSON validation with results cached by content hash.
+
+ISA-Tab validation runs the checks of isatools.isatab.validate as separate units, each cached under a hash of the
+files it reads: the investigation level checks under the investigation file, the checks on a study or assay table under
+that table and the investigation file, and the checks across files under all the files they cross. Resubmitting an
+investigation after editing one assay file only reruns the units reading that file. An ISA-JSON document is a single
+file, so its validation report is cached as a whole.
+"""
+import os
+import json
+import hashlib
+import threading
+
+import config
+import isarest_configs
+import isarest_converters
+from isarest_cache import ResultCache, make_key
+
+try:
+    from importlib.metadata import version as _package_version
+except ImportError:  # Python < 3.8
+    _package_version = None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+# the isatools validators collect their findings in module globals, so only one validation runs at a time
+_validate_lock = threading.Lock()
+
+
+def cache():
+    """
+    :return: The ResultCache holding validation results, None if VALIDATION_CACHE_MAX_BYTES is 0
+    """
+    global _cache
+    if not config.VALIDATION_CACHE_MAX_BYTES:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(config.VALIDATION_CACHE_FOLDER, config.VALIDATION_CACHE_MAX_BYTES)
+        return _cache
+
+
+def _digest(path):
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fp:
+            while True:
+                chunk = fp.read(config.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+    except (FileNotFoundError, IsADirectoryError):
+        return 'missing'
+    return h.hexdigest()
+
+
+def _config_fingerprint(config_dir, stamp=None):
+    """Identifies the validator and its configuration, so results are not reused across upgrades or config edits
+
+    :param stamp: Identifies the files in config_dir, they are looked up if not given
+    """
+    h = hashlib.sha256()
+    try:
+        h.update(_package_version('isatools').encode('utf-8') if _package_version else b'')
+    except Exception:
+        pass
+    h.update(config_dir.encode('utf-8'))
+    if stamp is not None:
+        h.update(stamp.encode('utf-8'))
+        return h.hexdigest()
+    for name in sorted(os.listdir(config_dir)):
+        st = os.stat(os.path.join(config_dir, name))
+        h.update('{}:{}:{}'.format(name, st.st_size, st.st_mtime).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _cached_unit(kind, unit, digests, fingerprint, compute):
+    """Run compute, or reuse its earlier result for the same inputs
+
+    :param kind: Kind of unit, cache statistics are kept per kind
+    :param unit: Name of the unit within the validation, e.g. the table file it checks
+    :param digests: Digests of every file the unit reads
+    :param fingerprint: Fingerprint of the validator and its configuration, see _config_fingerprint
+    :param compute: Function returning a JSON serializable result
+    """
+    result_cache = cache()
+    if result_cache is None:
+        return compute()
+    key = make_key(kind, {'unit': unit, 'config': fingerprint}, ':'.join(digests))
+    hit = result_cache.get(kind, key)
+    if hit is not None:
+        try:
+            with open(hit[0], 'rb') as hit_fp:
+                return json.loads(hit_fp.read().decode('utf-8'))
+        except (OSError, ValueError):
+            pass  # evicted or replaced meanwhile
+    result = compute()
+    result_cache.put(key, 'application/json', json.dumps(result).encode('utf-8'))
+    return result
+
+
+class _IsaTabValidation:
+
+    def __init__(self, isatab, i_path, registry):
+        self.isatab = isatab
+        self.i_path = i_path
+        self.dir = os.path.dirname(i_path)
+        self.registry = registry
+        self._digests = dict()
+        # the configurations stay the same for the whole validation, even if the registry reloads meanwhile
+        self._configs = registry.configs()
+        self.fingerprint = _config_fingerprint(registry.config_dir, registry.fingerprint)
+        self.errors = []
+        self.warnings = []
+        self.info = []
+
+    def digest(self, filename):
+        if filename not in self._digests:
+            self._digests[filename] = _digest(os.path.join(self.dir, filename))
+        return self._digests[filename]
+
+    def configs(self):
+        if not self._configs:  # Rule 4001
+            self.isatab.validator_errors.append({
+                "message": "Configurations could not be loaded",
+                "supplemental": "On loading {}".format(self.registry.config_dir),
+                "code": 4001
+            })
+            raise SystemError("No configuration to load so cannot proceed with validation!")
+        return self._configs
+
+    def collect(self, check):
+        # run check with empty finding lists, so only its own findings are returned with its result
+        isatab = self.isatab
+        isatab.validator_errors, isatab.validator_warnings, isatab.validator_info = [], [], []
+        value = check()
+        return {'errors': isatab.validator_errors, 'warnings': isatab.validator_warnings,
+                'info': isatab.validator_info, 'value': value}
+
+    def unit(self, kind, unit, filenames, check):
+        digests = [self.digest(os.path.basename(self.i_path))] + [self.digest(f) for f in filenames]
+        result = _cached_unit('validate-isatab/' + kind, unit, digests, self.fingerprint,
+                              lambda: self.collect(check))
+        self.errors.extend(result['errors'])
+        self.warnings.extend(result['warnings'])
+        self.info.extend(result['info'])
+        return result['value']
+
+    def load_table(self, filename):
+        with open(os.path.join(self.dir, filename), encoding='utf-8') as fp:
+            table = self.isatab.load_table(fp)
+        table.filename = filename
+        return table
+
+    def check_table(self, table, config_, protocols, term_source_refs, group_size):
+        isatab = self.isatab
+        isatab.check_factor_value_presence(table)  # Rule 4007
+        isatab.check_required_fields(table, config_)  # Rule 4003-8, 4010
+        isatab.check_field_values(table, config_)  # Rule 4011
+        isatab.check_unit_field(table, config_)
+        isatab.check_protocol_fields(table, config_, protocols)  # Rule 4009
+        isatab.check_ontology_fields(table, config_, term_source_refs)  # Rule 3010
+        isatab.check_study_groups(table, table.filename, group_size)
+
+    def run(self, i_df):
+        isatab = self.isatab
+        table_files = []
+        for i, study_df in enumerate(i_df['studies']):
+            table_files.append(study_df.iloc[0]['Study File Name'])
+            table_files.extend(i_df['s_assays'][i]['Study Assay File Name'].tolist())
+        table_files = [f for f in table_files if f != '']
+
+        def check_files():
+            isatab.check_filenames_present(i_df)  # Rule 3005
+            isatab.check_table_files_read(i_df, self.dir)  # Rules 0006 and 0008
+            isatab.check_samples_not_declared_in_study_used_in_assay(i_df, self.dir)  # Rule 1003
+            isatab.check_study_factor_usage(i_df, self.dir)  # Rules 1008 and 1021
+            isatab.check_protocol_usage(i_df, self.dir)  # Rules 1007 and 1019
+            isatab.check_protocol_parameter_usage(i_df, self.dir)  # Rules 1009 and 1020
+        self.unit('files', 'files', table_files, check_files)
+
+        def check_investigation():
+            isatab.check_date_formats(i_df)  # Rule 3001
+            isatab.check_dois(i_df)  # Rule 3002
+            isatab.check_pubmed_ids_format(i_df)  # Rule 3003
+            isatab.check_protocol_names(i_df)  # Rule 1010
+            isatab.check_protocol_parameter_names(i_df)  # Rule 1011
+            isatab.check_study_factor_names(i_df)  # Rule 1012
+            isatab.check_ontology_sources(i_df)  # Rule 3008
+            isatab.check_measurement_technology_types(i_df, self.configs())  # Rule 4002
+            isatab.check_investigation_against_config(i_df, self.configs())  # Rule 4003 for investigation file only
+        self.unit('investigation', 'investigation', [], check_investigation)
+
+        term_source_refs = None
+        for i, study_df in enumerate(i_df['studies']):
+            group_size = None
+            if isatab.NUMBER_OF_STUDY_GROUPS in study_df.columns:
+                group_size = next(iter(study_df[isatab.NUMBER_OF_STUDY_GROUPS]))
+            study_filename = study_df.iloc[0]['Study File Name']
+            if study_filename == '':
+                continue
+            if term_source_refs is None:
+                term_source_refs = self.collect(lambda: isatab.check_ontology_sources(i_df))['value']
+            protocols = dict(zip(i_df['s_protocols'][i]['Study Protocol Name'].tolist(),
+                                 i_df['s_protocols'][i]['Study Protocol Type'].tolist()))
+
+            def check_study():
+                try:
+                    table = self.load_table(study_filename)
+                except FileNotFoundError:
+                    return False
+                self.check_table(table, self.configs()[('[sample]', '')], protocols, term_source_refs, group_size)
+                return True
+            study_loaded = self.unit('study', study_filename, [study_filename], check_study)
+
+            assay_df = i_df['s_assays'][i]
+            assay_group_size = None
+            if isatab.NUMBER_OF_STUDY_GROUPS in assay_df.columns:
+                assay_group_size = next(iter(study_df[isatab.NUMBER_OF_STUDY_GROUPS]))
+            assay_files = []
+            for x, assay_filename in enumerate(assay_df['Study Assay File Name'].tolist()):
+                if assay_filename == '':
+                    continue
+                measurement_type = assay_df['Study Assay Measurement Type'].tolist()[x]
+                technology_type = assay_df['Study Assay Technology Type'].tolist()[x]
+                assay_config = self.configs().get((measurement_type.lower(), technology_type.lower()))
+                if assay_config is None:
+                    continue  # configuration validation is skipped for assays without a configuration
+
+                def check_assay(assay_filename=assay_filename, assay_config=assay_config):
+                    try:
+                        table = self.load_table(assay_filename)
+                    except FileNotFoundError:
+                        return False
+                    self.check_table(table, assay_config, protocols, term_source_refs, assay_group_size)
+                    return True
+                if self.unit('assay', assay_filename, [assay_filename], check_assay):
+                    assay_files.append(assay_filename)
+
+            if study_loaded:
+                def check_sample_names():
+                    isatab.check_sample_names(self.load_table(study_filename),
+                                              [self.load_table(f) for f in assay_files])
+                self.unit('samples', study_filename, [study_filename] + assay_files, check_sample_names)
+
+
+def validate_isatab(i_path, registry=None):
+    """Validate the ISA-Tab investigation at i_path, reusing the results of checks on files that did not change
+
+    Gives the same report as isatools.isatab.validate. The process pooling detection it runs last is skipped, as
+    its outcome does not make it into the report.
+    :param i_path: Path of the investigation file, the study and assay files are looked up next to it
+    :param registry: ConfigRegistry of the ISA configurations to validate against, by default that of
+        ISA_CONFIG_FOLDER
+    :return: Dict of errors, warnings, info and validation_finished
+    """
+    isatab = isarest_converters.load_module('isatools.isatab')
+    registry = registry or isarest_configs.registry()
+    with _validate_lock:
+        validation = _IsaTabValidation(isatab, i_path, registry)
+        finished = False
+        try:
+            with open(i_path, encoding='utf-8') as i_fp:
+                # the investigation file is parsed on every run, as all the checks need it, and so are its labels
+                loaded = validation.collect(lambda: isatab.load_investigation(fp=i_fp))
+            validation.errors.extend(loaded['errors'])
+            validation.warnings.extend(loaded['warnings'])
+            validation.info.extend(loaded['info'])
+            validation.run(loaded['value'])
+            finished = True
+        except Exception as e:
+            validation.errors.append({
+                "message": "Unknown/System Error",
+                "supplemental": "The validator could not identify what the error is: {}".format(str(e)),
+                "code": 0
+            })
+        return {
+            "errors": validation.errors,
+            "warnings": validation.warnings,
+            "info": validation.info,
+            "validation_finished": finished
+        }
+
+
+def validate_json(json_path):
+    """Validate the ISA-JSON document at json_path with isatools.isajson.validate, reusing the report of an
+    identical earlier document
+
+    :return: Validation report
+    """
+    isajson = isarest_converters.load_module('isatools.isajson')
+
+    def compute():
+        with _validate_lock, open(json_path) as json_fp:
+            return isajson.validate(json_fp)
+    return _cached_unit('validate-json', 'document', [_digest(json_path)],
+                        _config_fingerprint(isajson.default_config_dir), compute)
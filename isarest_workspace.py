@@ -0,0 +1,225 @@
+import os
+import logging
+import time
+import uuid
+import shutil
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class WorkspaceQuotaExceeded(IOError):
+    pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass  # removed while walking
+    return size
+
+
+class WorkspaceManager:
+
+    """Hands out scratch directories from a pool of pre-created, recycled workspaces
+
+    Workspaces live under root, which may be a tmpfs mount such as /dev/shm to keep scratch data off disk. Up to
+    pool_size idle workspaces are kept around and emptied on release rather than removed. A workspace is refused once
+    the workspaces under root together use quota bytes or more. A background thread reclaims workspaces that were
+    never released within max_age seconds, and those left behind by server processes that have exited.
+
+    Bytes used are counted per workspace as they are charged, by the request ingesting its body, and reset when the
+    workspace is released, so enforcing the quota never walks the workspaces. Each server process publishes the total
+    of its workspaces in <root>/usage-<pid>, which the other processes sharing root add to their own. Other scratch
+    data kept on the node, such as resumable uploads, is counted against the quota through count_usage().
+    """
+
+    def __init__(self, root, pool_size, quota, max_age, reap_interval):
+        self.root = root
+        self.pool_size = pool_size
+        self.quota = quota
+        self.max_age = max_age
+        self.reap_interval = reap_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = []
+        self._busy = dict()  # path -> time acquired
+        self._bytes = dict()  # path -> bytes charged to the busy workspace
+        self._usage_sources = []  # callables returning bytes used outside the workspaces
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _check_process(self):
+        # a forked server process must not share the parent's workspaces, so it starts a pool and reaper of its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._busy = dict()
+            self._bytes = dict()
+            for _ in range(self.pool_size):
+                self._idle.append(self._create())
+            reaper = threading.Thread(target=self._reap_forever, name='workspace-reaper')
+            reaper.daemon = True
+            reaper.start()
+
+    def _create(self):
+        path = os.path.join(self.root, 'ws-{}-{}'.format(os.getpid(), uuid.uuid4()))
+        os.mkdir(path)
+        return path
+
+    def acquire(self):
+        """
+        :return: Path of an empty workspace directory, to be handed back with release()
+        """
+        if self.bytes_used() >= self.quota:
+            raise WorkspaceQuotaExceeded("Workspace quota of {} bytes is used up".format(self.quota))
+        with self._lock:
+            self._check_process()
+            path = self._idle.pop() if self._idle else self._create()
+            self._busy[path] = time.time()
+            return path
+
+    def _usage_path(self, pid):
+        return os.path.join(self.root, 'usage-{}'.format(pid))
+
+    def _publish(self):
+        # called with the lock held, so the file always ends up with the latest total
+        usage_path = self._usage_path(os.getpid())
+        tmp_path = usage_path + '.' + str(uuid.uuid4())
+        try:
+            with open(tmp_path, 'w') as usage_fp:
+                usage_fp.write(str(sum(self._bytes.values())))
+            os.replace(tmp_path, usage_path)
+        except OSError as e:
+            logger.error("Could not publish workspace usage: %s", e)
+
+    def charge(self, path, nbytes):
+        """Count nbytes more as used by the busy workspace at path"""
+        with self._lock:
+            if path not in self._busy:
+                return
+            self._bytes[path] = self._bytes.get(path, 0) + nbytes
+            self._publish()
+
+    def release(self, path):
+        with self._lock:
+            if self._busy.pop(path, None) is None:
+                return  # already released, or reclaimed by the reaper
+            if self._bytes.pop(path, None) is not None:
+                self._publish()
+            recycle = len(self._idle) < self.pool_size
+        if not recycle:
+            shutil.rmtree(path, ignore_errors=True)
+            return
+        try:
+            for entry in os.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+        except OSError:
+            shutil.rmtree(path, ignore_errors=True)
+            return
+        with self._lock:
+            self._idle.append(path)
+
+    @contextmanager
+    def workspace(self):
+        path = self.acquire()
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def usage(self, path):
+        """
+        :return: Bytes used by the files in the workspace at path
+        """
+        return _tree_size(path)
+
+    def count_usage(self, source):
+        """Count the bytes returned by source, called whenever the quota is checked, against the quota too"""
+        self._usage_sources.append(source)
+
+    def bytes_used(self):
+        """
+        :return: Bytes charged to all workspaces under root, including those of other server processes, and the
+            bytes of the sources given to count_usage()
+        """
+        with self._lock:
+            used = sum(self._bytes.values())
+        used += sum(source() for source in self._usage_sources)
+        own = 'usage-{}'.format(os.getpid())
+        for entry in os.scandir(self.root):
+            if entry.name.startswith('usage-') and entry.name != own and entry.name[len('usage-'):].isdigit():
+                try:
+                    with open(entry.path) as usage_fp:
+                        used += int(usage_fp.read())
+                except (OSError, ValueError):
+                    pass  # removed, or its process exited
+        return used
+
+    def bytes_free(self):
+        return max(self.quota - self.bytes_used(), 0)
+
+    def reap(self):
+        """Reclaim workspaces held longer than max_age, and those of server processes that no longer exist"""
+        now = time.time()
+        with self._lock:
+            leaked = [path for path, acquired in self._busy.items() if now - acquired > self.max_age]
+            for path in leaked:
+                del self._busy[path]
+                self._bytes.pop(path, None)
+            if leaked:
+                self._publish()
+        for path in leaked:
+            shutil.rmtree(path, ignore_errors=True)
+        for entry in os.scandir(self.root):
+            try:
+                pid = int(entry.name.split('-')[1])
+            except (IndexError, ValueError):
+                continue
+            if _pid_alive(pid):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry.path)  # usage file
+                except OSError:
+                    pass
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                self.reap()
+            except Exception as e:
+                logger.exception("Could not reap workspaces: %s", e)
+
+    def stats(self):
+        with self._lock:
+            busy = {os.path.basename(path): self._bytes.get(path, 0) for path in self._busy}
+            idle = len(self._idle)
+        return {
+            'busy': len(busy),
+            'idle': idle,
+            'busy_bytes': busy,
+            'bytes_used': self.bytes_used(),
+            'quota': self.quota
+        }
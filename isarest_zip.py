@@ -0,0 +1,92 @@
+"""
+Access to uploaded ZIP archives that extracts only the members a converter reads.
+
+The central directory is checked before anything is extracted, and archives declaring more members, more uncompressed
+bytes or higher compression ratios than the ZIP_* settings allow are rejected as zip bombs. The declared sizes can be
+trusted from then on, as zipfile stops reading a member at its declared size and fails on a CRC mismatch.
+"""
+import shutil
+import zipfile
+
+import config
+
+
+class UnsafeArchive(zipfile.BadZipFile):
+    pass
+
+
+def check(zf):
+    """Reject zf, an open ZipFile, if its central directory declares it to expand too far
+
+    :raises UnsafeArchive: If it does
+    """
+    members = zf.infolist()
+    if len(members) > config.ZIP_MAX_MEMBERS:
+        raise UnsafeArchive("Archive has {} members, more than {}".format(len(members), config.ZIP_MAX_MEMBERS))
+    total = 0
+    for member in members:
+        total += member.file_size
+        if total > config.ZIP_MAX_SIZE:
+            raise UnsafeArchive("Archive expands to more than {} bytes".format(config.ZIP_MAX_SIZE))
+        if member.file_size > config.ZIP_RATIO_MIN_SIZE and \
+                member.file_size > config.ZIP_MAX_RATIO * max(member.compress_size, 1):
+            raise UnsafeArchive("Member {} expands {} bytes to {}".format(member.filename, member.compress_size,
+                                                                         member.file_size))
+
+
+class Archive:
+
+    """A ZIP upload, opened once with its central directory checked, and extracted a member at a time on demand"""
+
+    def __init__(self, path):
+        self.path = path
+        self.zf = zipfile.ZipFile(path, 'r')
+        try:
+            check(self.zf)
+        except Exception:
+            self.zf.close()
+            raise
+
+    def close(self):
+        self.zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def names(self):
+        """
+        :return: Names of the members, as namelist returns them
+        """
+        return self.zf.namelist()
+
+    def open(self, name):
+        """
+        :return: Binary file object reading member name straight from the archive
+        """
+        return self.zf.open(name)
+
+    def extract(self, names, dest_dir):
+        """Extract the members named, and only those, below dest_dir
+
+        :return: Number of bytes written
+        """
+        written = 0
+        for name in names:
+            info = self.zf.getinfo(name)
+            self.zf.extract(info, dest_dir)  # sanitizes absolute paths and .. the way extractall does
+            written += info.file_size
+        return written
+
+    def copy(self, name, dst_path):
+        """Write member name to dst_path"""
+        with self.zf.open(name) as src_fp, open(dst_path, 'wb') as dst_fp:
+            shutil.copyfileobj(src_fp, dst_fp, config.UPLOAD_CHUNK_SIZE)
+
+    def files(self):
+        """
+        :return: Names of the members that are files, not directories
+        """
+        return [name for name in self.zf.namelist() if not name.endswith('/')]
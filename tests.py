@@ -1,6 +1,37 @@
 import unittest
 import os
-from isarest import app
+import json
+import time
+import io
+import gzip
+import hashlib
+import fcntl
+import zipfile
+import tempfile
+import logging
+import subprocess
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+import isarest
+import isarest_accounting
+import isarest_admission
+import isarest_bench
+import isarest_cache
+import isarest_configs
+import isarest_converters
+import isarest_json
+import isarest_metrics
+import isarest_mw
+import isarest_server
+import isarest_validation
+import isarest_workspace
+from werkzeug.serving import make_server
+from isarest import app, mw_importer, session_manager, upload_manager, workspace_manager
+import isarest_client
+from isarest_client import IsaRestClient
 
 
 class BaseConverterTestCase(unittest.TestCase):
@@ -127,6 +158,90 @@ class ImportMWTests(BaseConverterTestCase):
         self.assertEqual(response.status_code, 405)
 
 
+class MWImportCacheTests(BaseConverterTestCase):
+
+    def setUp(self):
+        super(MWImportCacheTests, self).setUp()
+        self.stub_dir = tempfile.mkdtemp()
+        with zipfile.ZipFile(io.BytesIO(self.test_data_zip)) as zf:
+            zf.extractall(os.path.join(self.stub_dir, 'ST000001'))
+        self.imported = []
+        stub = isarest_mw.stub_import(self.stub_dir)
+
+        def import_study(studyid, out_dir):
+            self.imported.append(studyid)
+            time.sleep(0.2)
+            return stub(studyid, out_dir)
+        self.saved = mw_importer.cache_dir, mw_importer.ttl, mw_importer.import_study
+        mw_importer.cache_dir = tempfile.mkdtemp()
+        mw_importer.import_study = import_study
+
+    def tearDown(self):
+        mw_importer.cache_dir, mw_importer.ttl, mw_importer.import_study = self.saved
+
+    def test_import_cached(self):
+        for _ in range(2):
+            response = self.app.get(path='/api/v1/import/mw/ST000001')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as zf:
+            self.assertTrue(any(os.path.basename(name).startswith('i_') for name in zf.namelist()))
+        self.assertEqual(self.imported, ['ST000001'])
+        mw_importer.ttl = -1
+        self.assertEqual(self.app.get(path='/api/v1/import/mw/ST000001').status_code, 200)
+        self.assertEqual(self.imported, ['ST000001', 'ST000001'])
+
+    def test_concurrent_imports_coalesce(self):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            statuses = list(executor.map(lambda _: app.test_client().get(path='/api/v1/import/mw/ST000001').status_code,
+                                         range(4)))
+        self.assertEqual(statuses, [200] * 4)
+        self.assertEqual(self.imported, ['ST000001'])
+
+    def test_prefetch(self):
+        response = self.app.post(path='/api/v1/import/mw', data=json.dumps({'studyids': ['ST000001', 'ST000002']}),
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 200)
+        statuses = json.loads(response.get_data().decode('utf-8'))
+        self.assertEqual([status['status'] for status in statuses], ['imported', 'failed'])
+        self.assertEqual(self.app.get(path='/api/v1/import/mw/ST000001').status_code, 200)
+        self.assertEqual(self.imported, ['ST000001', 'ST000002'])
+        response = self.app.post(path='/api/v1/import/mw', data=json.dumps({'studyids': 'ST000001'}),
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bad_accessions(self):
+        self.assertEqual(self.app.get(path='/api/v1/import/mw/ST0001').status_code, 400)
+        self.assertEqual(self.app.get(path='/api/v1/import/mw/ST000002').status_code, 404)
+        self.assertEqual(self.imported, ['ST000002'])
+
+    def test_partial_archive_removed(self):
+        def write(*args, **kwargs):
+            raise OSError("No space left on device")
+        zip_write = zipfile.ZipFile.write
+        zipfile.ZipFile.write = write
+        try:
+            self.assertEqual(self.app.get(path='/api/v1/import/mw/ST000001').status_code, 500)
+        finally:
+            zipfile.ZipFile.write = zip_write
+        self.assertEqual([name for name in os.listdir(mw_importer.cache_dir) if name.startswith('ST000001')], [])
+
+    def test_wait_for_import_times_out(self):
+        wait_timeout = mw_importer.wait_timeout
+        with open(os.path.join(mw_importer.cache_dir, 'ST000001.zip.lock'), 'w') as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)  # an import hanging in another process
+            mw_importer.wait_timeout = 0.2
+            try:
+                response = self.app.get(path='/api/v1/import/mw/ST000001')
+            finally:
+                mw_importer.wait_timeout = wait_timeout
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(self.imported, [])
+        mw_importer.purge()  # the lock file left behind is no longer held
+        self.assertEqual(os.listdir(mw_importer.cache_dir), [])
+
+
 class SampleTabTests(BaseConverterTestCase):
 
     def test_convert_sampletab2isatab(self):
@@ -135,6 +250,14 @@ class SampleTabTests(BaseConverterTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.mimetype, 'application/zip')
 
+    def test_convert_sampletab2isatab_streams_valid_zip(self):
+        response = self.app.post(path='/api/v1/convert/sampletab-to-isatab', data=self.test_sampletab,
+                                 headers={'Content-Type': 'text/tab-separated-values'})
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertTrue(any(name.startswith('i_') for name in zf.namelist()))
+
     def test_convert_sampletab2json(self):
         response = self.app.post(path='/api/v1/convert/sampletab-to-json', data=self.test_sampletab,
                                  headers={'Content-Type': 'text/tab-separated-values'})
@@ -185,5 +308,1000 @@ class MageTabTests(BaseConverterTestCase):
     #     self.assertEqual(response.mimetype, 'application/zip')
 
 
+class ConfigRegistryTests(BaseConverterTestCase):
+
+    def test_list_and_fetch(self):
+        response = self.app.get(path='/api/v1/configs')
+        self.assertEqual(response.status_code, 200)
+        names = [entry['name'] for entry in json.loads(response.get_data().decode('utf-8'))]
+        self.assertEqual(len(names), len(os.listdir(config.ISA_CONFIG_FOLDER)))
+        response = self.app.get(path='/api/v1/configs?measurement=Transcription Profiling&technology=DNA microarray')
+        entries = json.loads(response.get_data().decode('utf-8'))
+        self.assertEqual([entry['name'] for entry in entries], ['transcription_micro'])
+        response = self.app.get(path=entries[0]['href'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/xml')
+        with open(os.path.join(config.ISA_CONFIG_FOLDER, 'transcription_micro.xml'), 'rb') as xml_fp:
+            self.assertEqual(response.get_data(), xml_fp.read())
+        self.assertEqual(self.app.get(path='/api/v1/configs/nothing').status_code, 404)
+
+    def test_reload(self):
+        config_dir = tempfile.mkdtemp()
+        for name in ('studySample.xml', 'genome_seq.xml'):
+            with open(os.path.join(config.ISA_CONFIG_FOLDER, name), 'rb') as src_fp, \
+                    open(os.path.join(config_dir, name), 'wb') as dst_fp:
+                dst_fp.write(src_fp.read())
+        registry = isarest_configs.ConfigRegistry(config_dir, 0)
+        configs = registry.configs()
+        self.assertEqual(set(configs), {('[sample]', ''), ('genome sequencing', 'nucleotide sequencing')})
+        self.assertIs(registry.configs(), configs)
+        os.remove(os.path.join(config_dir, 'genome_seq.xml'))
+        self.assertEqual(set(registry.configs()), {('[sample]', '')})
+
+
+class ResultCacheTests(BaseConverterTestCase):
+
+    def test_stats(self):
+        response = self.app.get(path='/api/v1/cache/stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+
+    def test_repeated_conversion_is_a_hit(self):
+        response = self.app.post(path='/api/v1/convert/sampletab-to-isatab', data=self.test_sampletab,
+                                 headers={'Content-Type': 'text/tab-separated-values'})
+        self.assertEqual(response.status_code, 200)
+        data = response.get_data()  # the result is committed to the cache once the response has been consumed
+        hits = json.loads(self.app.get(path='/api/v1/cache/stats').get_data(as_text=True))['hits']
+        cached_response = self.app.post(path='/api/v1/convert/sampletab-to-isatab', data=self.test_sampletab,
+                                        headers={'Content-Type': 'text/tab-separated-values'})
+        self.assertEqual(cached_response.status_code, 200)
+        self.assertEqual(cached_response.mimetype, 'application/zip')
+        self.assertEqual(cached_response.get_data(), data)
+        stats = json.loads(self.app.get(path='/api/v1/cache/stats').get_data(as_text=True))
+        self.assertEqual(stats['hits'], hits + 1)
+
+    def test_refused_before_ingest(self):
+        ingested = []
+        ingest_request = isarest._ingest_request
+        max_content_length = config.MAX_CONTENT_LENGTH
+        isarest._ingest_request = lambda request_: ingested.append(request_)
+        try:
+            response = self.app.post(path='/api/v1/convert/json-to-sampletab', data=self.test_data_json,
+                                     headers={'Content-Type': 'text/plain'})
+            self.assertEqual(response.status_code, 415)
+            config.MAX_CONTENT_LENGTH = 1024
+            response = self.app.post(path='/api/v1/convert/json-to-sampletab', data=self.test_data_json,
+                                     headers={'Content-Type': 'application/json'})
+            self.assertEqual(response.status_code, 413)
+        finally:
+            isarest._ingest_request = ingest_request
+            config.MAX_CONTENT_LENGTH = max_content_length
+        self.assertEqual(ingested, [])
+
+    def test_identical_requests_coalesced(self):
+        converter = isarest_converters.CONVERTERS['json-to-sampletab']
+        calls = []
+
+        def slow_convert(src_path, work_dir):
+            calls.append(src_path)
+            time.sleep(0.5)
+            return converter.convert(src_path, work_dir)
+        # whitespace makes the body unlike any converted before, so it is not in the cache yet
+        data = self.test_data_json + b' ' * (int(time.time() * 1000) % 100000)
+
+        def post(_):
+            response = app.test_client().post(path='/api/v1/convert/json-to-sampletab', data=data,
+                                              headers={'Content-Type': 'application/json'})
+            return response.status_code, response.get_data()
+        coalesced = json.loads(self.app.get(path='/api/v1/cache/stats').get_data(as_text=True))['coalesced']
+        isarest_converters.CONVERTERS['json-to-sampletab'] = converter._replace(convert=slow_convert)
+        try:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                responses = list(executor.map(post, range(3)))
+        finally:
+            isarest_converters.CONVERTERS['json-to-sampletab'] = converter
+        self.assertEqual([status for status, _ in responses], [200] * 3)
+        self.assertEqual(len(set(body for _, body in responses)), 1)
+        self.assertEqual(len(calls), 1)
+        stats = json.loads(self.app.get(path='/api/v1/cache/stats').get_data(as_text=True))
+        self.assertEqual(stats['coalesced'], coalesced + 2)
+
+    def test_wait_for_flight_times_out(self):
+        in_flight = isarest_cache.InFlight(tempfile.mkdtemp())
+        leader = in_flight.acquire('key')
+        self.assertFalse(leader.waited)
+        started = time.time()
+        follower = in_flight.acquire('key', timeout=0.2)
+        self.assertGreaterEqual(time.time() - started, 0.2)
+        self.assertTrue(follower.waited)
+        self.assertFalse(follower.held)
+        follower.release()
+        self.assertTrue(os.path.exists(leader.lock_path))  # still the leader's
+        leader.release()
+        self.assertTrue(in_flight.acquire('key', timeout=0.2).held)
+
+
+class AdmissionTests(BaseConverterTestCase):
+
+    def setUp(self):
+        super(AdmissionTests, self).setUp()
+        self.admission = isarest.admission
+        self.converter = isarest_converters.CONVERTERS['json-to-sampletab']
+
+        def slow_convert(src_path, work_dir):
+            time.sleep(0.5)
+            return self.converter.convert(src_path, work_dir)
+        isarest_converters.CONVERTERS['json-to-sampletab'] = self.converter._replace(convert=slow_convert)
+
+    def tearDown(self):
+        isarest.admission = self.admission
+        isarest_converters.CONVERTERS['json-to-sampletab'] = self.converter
+
+    def _post_concurrently(self, count):
+        # bodies unlike any converted before, so none is served from the cache or coalesced with another
+        salt = int(time.time() * 1000) % 100000
+
+        def post(i):
+            data = self.test_data_json + b' ' * (salt + i * 100000)
+            response = app.test_client().post(path='/api/v1/convert/json-to-sampletab', data=data,
+                                              headers={'Content-Type': 'application/json'})
+            return response.status_code, response.headers.get('Retry-After')
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            return sorted(executor.map(post, range(count)), key=lambda r: r[0])
+
+    def test_queue_full(self):
+        isarest.admission = isarest_admission.AdmissionController(tempfile.mkdtemp(), {'json-to-sampletab': 1}, 1, 30)
+        responses = self._post_concurrently(3)
+        self.assertEqual([status for status, _ in responses], [200, 200, 503])
+        self.assertGreaterEqual(int(responses[-1][1]), 1)
+        metrics = self.app.get(path='/metrics').get_data(as_text=True)
+        self.assertIn('isarest_admission_wait_seconds_count{operation="json-to-sampletab"}', metrics)
+        self.assertIn('isarest_admission_queue_depth{operation="json-to-sampletab"} 0', metrics)
+        self.assertIn('isarest_admission_limit{operation="json-to-sampletab"} 1', metrics)
+
+    def test_queue_timeout(self):
+        isarest.admission = isarest_admission.AdmissionController(tempfile.mkdtemp(), {'json-to-sampletab': 1}, 4, 0.1)
+        responses = self._post_concurrently(2)
+        self.assertEqual([status for status, _ in responses], [200, 503])
+
+    def test_slots_counted_without_locking(self):
+        lock_dir = tempfile.mkdtemp()
+        controller = isarest_admission.AdmissionController(lock_dir, {'json-to-sampletab': 2}, 1, 30)
+        with controller.admit('json-to-sampletab'):
+            self.assertEqual(controller.stats()['json-to-sampletab']['running'], 1)
+        self.assertEqual(controller.stats()['json-to-sampletab']['running'], 0)
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        with open(os.path.join(lock_dir, 'json-to-sampletab.run.1'), 'w') as slot_fp:
+            slot_fp.write(str(dead.pid))  # left behind by a process that died holding the slot
+            slot_fp.flush()
+            self.assertEqual(controller.stats()['json-to-sampletab']['running'], 0)
+
+
+class AccountingTests(BaseConverterTestCase):
+
+    def _convert(self, query='', headers=None):
+        response = self.app.post(path='/api/v1/convert/json-to-sampletab' + query, data=self.test_data_json,
+                                 headers=dict(headers or {}, **{'Content-Type': 'application/json'}))
+        response.close()  # the request is accounted once its response is closed
+        return response
+
+    def test_request_accounted(self):
+        client_request_id = 'accounting-test-{}'.format(time.time())
+        response = self._convert(headers={'X-Request-Id': client_request_id})
+        self.assertEqual(response.status_code, 200)
+        request_id = response.headers['X-Request-Id']
+        self.assertNotEqual(request_id, client_request_id)
+        self.assertEqual(self.app.get('/api/v1/accounting/' + client_request_id).status_code, 404)
+        entry = json.loads(self.app.get('/api/v1/accounting/' + request_id).get_data(as_text=True))
+        self.assertEqual(entry['client_request_id'], client_request_id)
+        self.assertEqual(entry['resource'], '/api/v1/convert/json-to-sampletab')
+        self.assertEqual(entry['status'], 200)
+        self.assertGreater(entry['wall_seconds'], 0)
+        self.assertGreater(entry['cpu_seconds'], 0)
+        self.assertGreaterEqual(entry['peak_rss_growth'], 0)
+        self.assertGreater(entry['workspace_bytes'], 0)
+        recent_path = '/api/v1/accounting?resource=/api/v1/convert/json-to-sampletab&limit=5'
+        admin_token = config.ADMIN_TOKEN
+        config.ADMIN_TOKEN = 'secret'
+        try:
+            self.assertEqual(self.app.get(recent_path).status_code, 403)
+            self.assertEqual(self.app.get(recent_path, headers={'X-Admin-Token': 'guess'}).status_code, 403)
+            recent = json.loads(self.app.get(recent_path, headers={'X-Admin-Token': 'secret'}).get_data(as_text=True))
+        finally:
+            config.ADMIN_TOKEN = admin_token
+        self.assertEqual(recent[0]['request_id'], request_id)
+        self.assertEqual(self.app.get('/api/v1/accounting/no-such-request').status_code, 404)
+        self.assertNotEqual(self._convert(headers={'X-Request-Id': '../bad id'}).headers['X-Request-Id'],
+                            '../bad id')
+
+    def test_log_rotated(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'accounting.jsonl')
+            log = isarest_accounting.Accounting(1, log_path, 300)
+            for n in range(10):
+                log.record({'request_id': 'request-{}'.format(n), 'resource': '/', 'padding': 'x' * 50})
+            self.assertLessEqual(os.path.getsize(log_path), 300)
+            self.assertLessEqual(os.path.getsize(log_path + '.1'), 300)
+            self.assertEqual(log.get('request-9')['request_id'], 'request-9')
+            with open(log_path + '.1') as rotated_fp:
+                rotated_id = json.loads(rotated_fp.readline())['request_id']
+            self.assertEqual(log.get(rotated_id)['request_id'], rotated_id)
+            self.assertIsNone(log.get('request-0'))
+
+    def test_profile_needs_admin_token(self):
+        admin_token = config.ADMIN_TOKEN
+        config.ADMIN_TOKEN = None
+        try:
+            self.assertEqual(self._convert('?profile=return', {'X-Admin-Token': 'secret'}).status_code, 403)
+            config.ADMIN_TOKEN = 'secret'
+            self.assertEqual(self._convert('?profile=return', {'X-Admin-Token': 'guess'}).status_code, 403)
+            self.assertEqual(self._convert('?profile=sample', {'X-Admin-Token': 'secret'}).status_code, 400)
+            report = self._convert('?profile=return', {'X-Admin-Token': 'secret'})
+            self.assertEqual(report.status_code, 200)
+            self.assertEqual(report.mimetype, 'text/plain')
+            self.assertIn('function calls', report.get_data(as_text=True))
+            stored = self._convert('?profile=store', {'X-Admin-Token': 'secret'})
+            self.assertEqual(stored.status_code, 200)
+            self.assertEqual(stored.mimetype, 'text/tab-separated-values')
+            profile_path = stored.headers['X-Profile']
+            self.assertEqual(self.app.get(profile_path).status_code, 403)
+            profile = self.app.get(profile_path, headers={'X-Admin-Token': 'secret'})
+            self.assertEqual(profile.status_code, 200)
+            self.assertIn('json2sampletab', profile.get_data(as_text=True))
+            self.assertEqual(self.app.get(profile_path + '?format=pstats',
+                                          headers={'X-Admin-Token': 'secret'}).status_code, 200)
+        finally:
+            config.ADMIN_TOKEN = admin_token
+
+
+class ValidationCacheTests(BaseConverterTestCase):
+
+    def _hits(self, kind):
+        response = self.app.get('/api/v1/cache/stats')
+        endpoints = json.loads(response.get_data(as_text=True))['validation']['endpoints']
+        return endpoints.get(kind, {'hits': 0, 'misses': 0})
+
+    def _validate_isatab(self, data):
+        response = self.app.post(path='/api/v1/validate/isatab', data=data, headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.get_data(as_text=True))
+
+    def test_isatab_unchanged_files_reused(self):
+        report = self._validate_isatab(self.test_data_zip)
+        edited = io.BytesIO()
+        with zipfile.ZipFile(io.BytesIO(self.test_data_zip)) as src, zipfile.ZipFile(edited, 'w') as dst:
+            for info in src.infolist():
+                data = src.read(info)
+                if info.filename == 'a_gilbert-assay-Tx.txt':
+                    data = data.replace(b'454 GS-FLX', '454 GS-FLX {}'.format(time.time()).encode('utf-8'))
+                dst.writestr(info, data)
+        study, assay = self._hits('validate-isatab/study'), self._hits('validate-isatab/assay')
+        self.assertEqual(self._validate_isatab(self.test_data_zip), report)
+        self._validate_isatab(edited.getvalue())
+        self.assertEqual(self._hits('validate-isatab/study')['hits'], study['hits'] + 2)
+        # both assays are reused on resubmission, only the edited one is checked again after the edit
+        self.assertEqual(self._hits('validate-isatab/assay')['hits'], assay['hits'] + 3)
+        self.assertEqual(self._hits('validate-isatab/assay')['misses'], assay['misses'] + 1)
+
+    def test_json_reused(self):
+        reports = []
+        for _ in range(2):
+            response = self.app.post(path='/api/v1/validate/json', data=self.test_data_json,
+                                     headers={'Content-Type': 'application/json'})
+            self.assertEqual(response.status_code, 200)
+            reports.append(json.loads(response.get_data(as_text=True)))
+        self.assertEqual(reports[0], reports[1])
+        self.assertGreater(self._hits('validate-json')['hits'], 0)
+
+
+class JobTests(BaseConverterTestCase):
+
+    def _wait_for(self, job_id):
+        for _ in range(3000):
+            status = json.loads(self.app.get(path='/api/v2/jobs/' + job_id).get_data(as_text=True))
+            if status['status'] in ('finished', 'failed'):
+                return status
+            time.sleep(0.1)
+        self.fail("Job {} did not complete".format(job_id))
+
+    def test_submit_and_fetch_result(self):
+        response = self.app.post(path='/api/v2/jobs?operation=sampletab-to-isatab', data=self.test_sampletab,
+                                 headers={'Content-Type': 'text/tab-separated-values'})
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.get_data(as_text=True))['id']
+        self.assertEqual(self._wait_for(job_id)['status'], 'finished')
+        response = self.app.get(path='/api/v2/jobs/' + job_id + '/result')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/zip')
+
+    def test_unknown_operation(self):
+        response = self.app.post(path='/api/v2/jobs?operation=tab-to-nowhere', data=self.test_data_zip,
+                                 headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unsupported_content(self):
+        response = self.app.post(path='/api/v2/jobs?operation=tab-to-json', data=self.test_data_json,
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 415)
+
+    def test_unknown_job(self):
+        response = self.app.get(path='/api/v2/jobs/no-such-job')
+        self.assertEqual(response.status_code, 404)
+
+    def test_failed_submission_cleaned_up(self):
+        jobs = set(os.listdir(config.JOB_FOLDER))
+
+        def submit(*args, **kwargs):
+            raise OSError("No space left on device")
+        isarest.job_manager.submit = submit
+        try:
+            response = self.app.post(path='/api/v2/jobs?operation=sampletab-to-isatab', data=self.test_sampletab,
+                                     headers={'Content-Type': 'text/tab-separated-values'})
+        finally:
+            del isarest.job_manager.submit
+        self.assertEqual(response.status_code, 500)
+        job_id, = set(os.listdir(config.JOB_FOLDER)) - jobs
+        self.assertEqual(os.listdir(os.path.join(config.JOB_FOLDER, job_id)), ['job.json'])
+        status = json.loads(self.app.get(path='/api/v2/jobs/' + job_id).get_data(as_text=True))
+        self.assertEqual(status['status'], 'failed')
+        self.assertIn('No space left', status['error'])
+
+
+class BatchTests(BaseConverterTestCase):
+
+    def test_batch_reports_failed_items(self):
+        response = self.app.post(path='/api/v1/batch/json-to-sampletab',
+                                 data={'file': [(io.BytesIO(self.test_data_json), 'BII-S-3.json'),
+                                                (io.BytesIO(b'not json'), 'broken.json')]},
+                                 content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as zf:
+            manifest = json.loads(zf.read('manifest.json').decode('utf-8'))
+            self.assertEqual([entry['status'] for entry in manifest], ['finished', 'failed'])
+            self.assertIn(manifest[0]['result'], zf.namelist())
+
+    def test_batch_from_zip(self):
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w') as zf:
+            zf.writestr('a/BII-S-3.json', self.test_data_json)
+            zf.writestr('b/BII-S-3.json', self.test_data_json)
+        response = self.app.post(path='/api/v1/batch/json-to-sampletab', data=data.getvalue(),
+                                 headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as zf:
+            manifest = json.loads(zf.read('manifest.json').decode('utf-8'))
+        self.assertEqual([entry['status'] for entry in manifest], ['finished', 'finished'])
+        self.assertEqual(len(set(entry['result'] for entry in manifest)), 2)
+
+    def test_unknown_operation(self):
+        response = self.app.post(path='/api/v1/batch/tab-to-nothing', data=self.test_data_zip,
+                                 headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_unsupported_content(self):
+        response = self.app.post(path='/api/v1/batch/json-to-sampletab', data=self.test_data_json,
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 415)
+
+
+class FanoutTests(BaseConverterTestCase):
+
+    def test_json_to_all(self):
+        response = self.app.post(path='/api/v1/convert/json-to-all?targets=sra,sampletab', data=self.test_data_json_zip,
+                                 headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as zf:
+            manifest = json.loads(zf.read('manifest.json').decode('utf-8'))
+            names = zf.namelist()
+        self.assertEqual([(entry['target'], entry['status']) for entry in manifest],
+                         [('sra', 'finished'), ('sampletab', 'finished')])
+        self.assertIn('sampletab/out.txt', names)
+        self.assertTrue(any(name.startswith('sra/') and name.endswith('.xml') for name in names))
+
+    def test_unknown_target(self):
+        response = self.app.post(path='/api/v1/convert/json-to-all?targets=sra,cedar', data=self.test_data_json,
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unsupported_content(self):
+        response = self.app.post(path='/api/v1/convert/tab-to-all', data=self.test_data_json,
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 415)
+
+
+class SessionTests(BaseConverterTestCase):
+
+    def _create(self):
+        response = self.app.post(path='/api/v1/sessions', data=self.test_data_json,
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.get_data().decode('utf-8'))
+
+    def test_operations_reuse_parsed_input(self):
+        session = self._create()
+        self.assertEqual(session['kind'], 'json')
+        self.assertFalse(session['parsed'])
+        self.assertIn('json-to-sampletab', session['operations'])
+        path = '/api/v1/sessions/' + session['id']
+        response = self.app.post(path=path + '/json-to-sampletab')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/tab-separated-values')
+        parsed = session_manager.get(session['id'])
+        model = parsed.model()
+        response = self.app.post(path=path + '/validate-json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('errors', json.loads(response.get_data().decode('utf-8')))
+        self.assertIs(session_manager.get(session['id']).model(), model)
+        self.assertTrue(json.loads(self.app.get(path=path).get_data().decode('utf-8'))['parsed'])
+
+    def test_operation_not_for_kind(self):
+        session = self._create()
+        response = self.app.post(path='/api/v1/sessions/' + session['id'] + '/tab-to-json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_delete_and_expiry(self):
+        session = self._create()
+        path = '/api/v1/sessions/' + session['id']
+        self.assertEqual(self.app.delete(path=path).status_code, 204)
+        self.assertEqual(self.app.get(path=path).status_code, 404)
+        self.assertEqual(self.app.post(path=path + '/validate-json').status_code, 404)
+        ttl = session_manager.ttl
+        session_manager.ttl = -1
+        try:
+            session = self._create()
+        finally:
+            session_manager.ttl = ttl
+        self.assertEqual(self.app.get(path='/api/v1/sessions/' + session['id']).status_code, 404)
+
+
+class MetricsTests(BaseConverterTestCase):
+
+    def _sample(self, name):
+        for line in self.app.get('/metrics').get_data(as_text=True).splitlines():
+            if line.startswith(name + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return 0.0
+
+    def test_phases_recorded(self):
+        bytes_in = 'isarest_request_bytes_total{resource="/api/v1/validate/isatab"}'
+        received = self._sample(bytes_in)
+        response = self.app.post(path='/api/v1/validate/isatab', data=self.test_data_zip,
+                                 headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._sample(bytes_in) - received, len(self.test_data_zip))
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        metrics = response.get_data(as_text=True)
+        for phase in ('ingest', 'unpack', 'convert', 'serialize'):
+            self.assertIn('isarest_phase_duration_seconds_count{resource="/api/v1/validate/isatab",phase="%s"}'
+                          % phase, metrics)
+        self.assertIn('isarest_requests_total{resource="/api/v1/validate/isatab",status="200"}', metrics)
+        self.assertIn('isarest_requests_in_flight 1.0', metrics)
+        self.assertIn('isarest_workspace_bytes ', metrics)
+
+    def test_flush_throttled(self):
+        def written():
+            with open(isarest_metrics._store['path']) as values_fp:
+                return dict((tuple(key), value) for key, value in json.load(values_fp)['isarest_request_bytes_total'])
+        key = ('/api/v1/flush-test',)
+        flush_interval = isarest_metrics.FLUSH_INTERVAL
+        isarest_metrics.FLUSH_INTERVAL = 0.5
+        try:
+            isarest_metrics.bytes_in.inc(1, *key)
+            isarest_metrics.flush(force=True)
+            isarest_metrics.bytes_in.inc(1, *key)
+            isarest_metrics.flush()
+            self.assertEqual(written()[key], 1)  # written again once the interval is over
+            time.sleep(1)
+            self.assertEqual(written()[key], 2)
+        finally:
+            isarest_metrics.FLUSH_INTERVAL = flush_interval
+
+    def test_processes_aggregated(self):
+        metrics_dir = isarest_metrics._store['dir']
+        requests = 'isarest_requests_total{resource="/api/v1/validate/isatab",status="200"}'
+        dead_pid = 2 ** 22 + 1  # above the largest pid Linux hands out
+        counted = self._sample(requests)
+        in_flight = self._sample('isarest_requests_in_flight')
+        other_path = os.path.join(metrics_dir, '{}.other.json'.format(os.getppid()))
+        exited_path = os.path.join(metrics_dir, '{}.exited.json'.format(dead_pid))
+        for path in (other_path, exited_path):
+            with open(path, 'w') as values_fp:
+                json.dump({'isarest_requests_total': [[['/api/v1/validate/isatab', '200'], 3]],
+                           'isarest_requests_in_flight': [[[], 2]]}, values_fp)
+        try:
+            self.assertEqual(self._sample(requests) - counted, 6)
+            self.assertEqual(self._sample('isarest_requests_in_flight') - in_flight, 2)  # of the live process only
+            self.assertFalse(os.path.exists(exited_path))
+            os.remove(other_path)
+            self.assertEqual(self._sample(requests) - counted, 3)  # the exited process stays counted
+        finally:
+            if os.path.exists(other_path):
+                os.remove(other_path)
+
+
+class UploadLimitTests(BaseConverterTestCase):
+
+    def setUp(self):
+        super(UploadLimitTests, self).setUp()
+        self.max_content_length = config.MAX_CONTENT_LENGTH
+        config.MAX_CONTENT_LENGTH = 1024
+
+    def tearDown(self):
+        config.MAX_CONTENT_LENGTH = self.max_content_length
+
+    def test_too_large_conversion(self):
+        response = self.app.post(path='/api/v1/convert/tab-to-json', data=self.test_data_zip,
+                                 headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 413)
+
+    def test_too_large_validation(self):
+        response = self.app.post(path='/api/v1/validate/json', data=self.test_data_json,
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 413)
+
+
+class WorkspaceTests(BaseConverterTestCase):
+
+    def test_workspace_released_on_error(self):
+        busy = workspace_manager.stats()['busy']
+        response = self.app.post(path='/api/v1/convert/tab-to-json', data=b'not a zip',
+                                 headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 500)
+        stats = workspace_manager.stats()
+        self.assertEqual(stats['busy'], busy)
+        self.assertGreater(stats['idle'], 0)
+
+    def test_error_logged(self):
+        with self.assertLogs(app.logger, level='ERROR') as logs:
+            response = self.app.post(path='/api/v1/convert/tab-to-json', data=b'not a zip',
+                                     headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('POST /api/v1/convert/tab-to-json (request ', logs.output[0])
+
+    def test_quota_exceeded(self):
+        quota = workspace_manager.quota
+        workspace_manager.quota = 0
+        try:
+            response = self.app.post(path='/api/v1/validate/json', data=self.test_data_json,
+                                     headers={'Content-Type': 'application/json'})
+            self.assertEqual(response.status_code, 503)
+        finally:
+            workspace_manager.quota = quota
+
+    def test_charged_bytes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manager = isarest_workspace.WorkspaceManager(tmp_dir, 1, 100, 60, 60)
+            other_usage = os.path.join(tmp_dir, 'usage-{}'.format(os.getppid()))
+            with open(other_usage, 'w') as usage_fp:
+                usage_fp.write('10')
+            with manager.workspace() as path:
+                manager.charge(path, 60)
+                self.assertEqual(manager.bytes_used(), 70)
+                self.assertEqual(manager.bytes_free(), 30)
+                manager.charge(path, 40)
+                with self.assertRaises(isarest_workspace.WorkspaceQuotaExceeded):
+                    manager.acquire()
+            self.assertEqual(manager.bytes_used(), 10)
+
+
+class BenchTests(unittest.TestCase):
+
+    def test_generate_study(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_path = os.path.join(tmp_dir, 'study.zip')
+            counts = isarest_bench.generate_study(10, out_path)
+            self.assertEqual(counts['s_BII-S-3.txt'], 10)
+            with zipfile.ZipFile(out_path) as zf:
+                header, rows = isarest_bench._read_table(zf, 's_BII-S-3.txt')
+                samples = [row[header.index('Sample Name')] for row in rows]
+                self.assertEqual(len(set(samples)), 10)
+                header, rows = isarest_bench._read_table(zf, 'a_gilbert-assay-Tx.txt')
+                self.assertTrue(set(row[header.index('Sample Name')] for row in rows) <= set(samples))
+                self.assertIn('i_gilbert.txt', zf.namelist())
+
+    def test_run(self):
+        report = isarest_bench.run(operations=['validate-json'], concurrency=[2], requests=4)
+        result = report['results'][0]
+        self.assertEqual(result['statuses'], {'200': 4})
+        self.assertLessEqual(result['latency']['p50'], result['latency']['p99'])
+        self.assertGreater(result['throughput'], 0)
+        json.dumps(report)
+
+    def test_run_without_requests(self):
+        report = isarest_bench.run(operations=['validate-json'], requests=0)
+        self.assertIsNone(report['results'][0]['latency']['p50'])
+        self.assertEqual(isarest_bench._format(None, '.2f'), 'n/a')
+
+    def test_resources_registered(self):
+        resources = isarest_bench.resources()
+        registered = set(isarest_converters.CONVERTERS) | set(isarest_converters.FANOUT_TARGETS)
+        self.assertEqual(set(resources), set(filter(isarest_converters.enabled, registered)))
+        rules = set(rule.rule for rule in app.url_map.iter_rules())
+        for path, fixture in resources.values():
+            self.assertIn(path, rules)
+            self.assertTrue(os.path.exists(os.path.join(isarest_bench.TESTDATA, fixture)))
+
+    def test_run_without_caches(self):
+        isarest_bench.run(operations=['validate-json'], requests=1, use_cache=True)
+        hits = isarest_validation.cache().stats()['hits']
+        report = isarest_bench.run(operations=['validate-json'], requests=2)
+        self.assertEqual(report['results'][0]['statuses'], {'200': 2})
+        self.assertEqual(isarest_validation.cache().stats()['hits'], hits)
+        self.assertTrue(config.VALIDATION_CACHE_MAX_BYTES)
+
+
+class StartupTests(unittest.TestCase):
+
+    def _run(self, code):
+        return subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').split()
+
+    def test_converters_not_imported_at_startup(self):
+        self.assertEqual(self._run("import sys, isarest; print('isatools' in sys.modules)"), ['False'])
+
+    def test_enabled_endpoints(self):
+        status_codes = self._run(
+            "import config; config.ENABLED_ENDPOINTS = ['validate-json']\n"
+            "from isarest import app\n"
+            "client = app.test_client()\n"
+            "print(client.post('/api/v1/convert/tab-to-json', data=b'{}',\n"
+            "                  headers={'Content-Type': 'application/zip'}).status_code)\n"
+            "print(client.post('/api/v2/jobs?operation=tab-to-json', data=b'{}',\n"
+            "                  headers={'Content-Type': 'application/zip'}).status_code)\n"
+            "print(client.post('/api/v1/validate/json', data=b'{}',\n"
+            "                  headers={'Content-Type': 'application/json'}).status_code)")
+        self.assertEqual(status_codes, ['404', '400', '200'])
+
+    def test_startup_report(self):
+        response = app.test_client().get('/api/v1/startup')
+        self.assertEqual(response.status_code, 200)
+        report = json.loads(response.get_data(as_text=True))
+        self.assertIn('validate-json', report['enabled'])
+        for entry in report['imports']:
+            self.assertGreaterEqual(entry['seconds'], 0)
+
+
+class ClientTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def test_streams_from_and_to_disk(self):
+        json_path = os.path.join(os.path.dirname(__file__), 'testdata/BII-S-3.json')
+        with IsaRestClient(baseurl='http://127.0.0.1:{}'.format(self.server.port),
+                           dl_folder=tempfile.mkdtemp()) as client:
+            from_path = client.convert_json_to_sampletab(json_path)
+            with open(json_path, 'rb') as json_fp:
+                from_bytes = client.convert_json_to_sampletab(json_fp.read())
+            self.assertNotEqual(from_path, from_bytes)
+            with open(from_path, 'rb') as first_fp, open(from_bytes, 'rb') as second_fp:
+                self.assertEqual(first_fp.read(), second_fp.read())
+            self.assertIsNone(client.convert_tab_to_json(b'not a zip'))
+
+    def test_resumable_upload(self):
+        json_path = os.path.join(os.path.dirname(__file__), 'testdata/BII-S-3.json')
+        with IsaRestClient(baseurl='http://127.0.0.1:{}'.format(self.server.port),
+                           dl_folder=tempfile.mkdtemp()) as client:
+            upload_id = client.upload(json_path, chunk_size=4096)
+            self.assertIsNotNone(upload_id)
+            self.assertEqual(client.upload(json_path, upload_id=upload_id), upload_id)
+            status, from_upload = client.convert('json-to-sampletab', upload_id=upload_id)
+            self.assertEqual(status, 200)
+            _, from_path = client.convert('json-to-sampletab', json_path)
+            with open(from_upload, 'rb') as first_fp, open(from_path, 'rb') as second_fp:
+                self.assertEqual(first_fp.read(), second_fp.read())
+
+    def test_bulk_convert(self):
+        input_dir = tempfile.mkdtemp()
+        for name in ('a.json', 'b.json', 'c.json'):
+            with open(os.path.join(input_dir, name), 'wb') as input_fp:
+                input_fp.write(b'not json' if name == 'c.json' else self._json())
+        out_dir = tempfile.mkdtemp()
+        report_path = os.path.join(out_dir, 'report.json')
+        status = isarest_client.main(['json-to-sampletab', input_dir,
+                                      '--url', 'http://127.0.0.1:{}'.format(self.server.port), '--output-dir', out_dir,
+                                      '--concurrency', '2', '--report', report_path])
+        self.assertEqual(status, 1)
+        with open(report_path) as report_fp:
+            summary = json.load(report_fp)
+        self.assertEqual((summary['inputs'], summary['finished'], summary['failed']), (3, 2, 1))
+        self.assertEqual([os.path.basename(result['input']) for result in summary['results']],
+                         ['a.json', 'b.json', 'c.json'])
+        self.assertTrue(all(os.path.exists(result['output']) for result in summary['results'][:2]))
+        self.assertIsNotNone(summary['latency']['p95'])
+
+    def test_async_import_mw(self):
+        async def run():
+            async with isarest_client.AsyncIsaRestClient(baseurl='http://127.0.0.1:{}'.format(self.server.port),
+                                                         dl_folder=tempfile.mkdtemp(), retries=0) as client:
+                return await client.convert('import-mw', 'ST0001')
+        self.assertEqual(asyncio.run(run()), (400, None))
+
+    def _json(self):
+        with open(os.path.join(os.path.dirname(__file__), 'testdata/BII-S-3.json'), 'rb') as json_fp:
+            return json_fp.read()
+
+
+class ResumableUploadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        with open(os.path.join(os.path.dirname(__file__), 'testdata/BII-S-3.json'), 'rb') as json_fp:
+            self.json = json_fp.read()
+
+    def _put(self, upload_id, index, data, sha256=None):
+        return self.app.put('/api/v1/uploads/{}/chunks/{}'.format(upload_id, index), data=data,
+                            headers={'X-Chunk-Sha256': sha256 or hashlib.sha256(data).hexdigest()})
+
+    def test_upload_in_chunks(self):
+        created = self.app.post('/api/v1/uploads', data=json.dumps({'size': len(self.json),
+                                                                    'sha256': hashlib.sha256(self.json).hexdigest()}),
+                                content_type='application/json')
+        self.assertEqual(created.status_code, 201)
+        upload_id = json.loads(created.data)['id']
+        self.assertTrue(created.headers['Location'].endswith('/api/v1/uploads/' + upload_id))
+        chunk_size = len(self.json) // 3 + 1
+        chunks = [self.json[i:i + chunk_size] for i in range(0, len(self.json), chunk_size)]
+        self.assertEqual(self._put(upload_id, 2, chunks[2]).status_code, 200)
+        self.assertEqual(self._put(upload_id, 0, chunks[0], hashlib.sha256(b'other').hexdigest()).status_code, 400)
+        self.assertEqual(self._put(upload_id, 0, chunks[0]).status_code, 200)
+        self.assertEqual(json.loads(self.app.get('/api/v1/uploads/' + upload_id).data)['chunks'], [0, 2])
+        self.assertEqual(self.app.post('/api/v1/uploads/{}/complete'.format(upload_id)).status_code, 409)
+        self.assertEqual(self._put(upload_id, 1, chunks[1]).status_code, 200)
+        completed = self.app.post('/api/v1/uploads/{}/complete'.format(upload_id))
+        self.assertEqual(completed.status_code, 200)
+        self.assertTrue(json.loads(completed.data)['complete'])
+
+        plain = self.app.post('/api/v1/convert/json-to-sampletab', data=self.json, content_type='application/json')
+        for _ in range(2):  # the upload is kept for further requests
+            from_upload = self.app.post('/api/v1/convert/json-to-sampletab', content_type='application/json',
+                                        headers={'X-Upload-Id': upload_id})
+            self.assertEqual(from_upload.status_code, 200)
+            self.assertEqual(from_upload.data, plain.data)
+        self.assertEqual(self.app.delete('/api/v1/uploads/' + upload_id).status_code, 204)
+        self.assertEqual(self.app.post('/api/v1/convert/json-to-sampletab', content_type='application/json',
+                                       headers={'X-Upload-Id': upload_id}).status_code, 404)
+
+    def test_upload_checked_on_completion(self):
+        upload_id = json.loads(self.app.post('/api/v1/uploads', data=json.dumps({'size': len(self.json) + 1}),
+                                             content_type='application/json').data)['id']
+        self.assertEqual(self._put(upload_id, 0, self.json).status_code, 200)
+        self.assertEqual(self.app.post('/api/v1/uploads/{}/complete'.format(upload_id)).status_code, 409)
+        self.assertEqual(self.app.post('/api/v1/uploads/{}/complete'.format('no-such-upload')).status_code, 404)
+
+    def test_chunks_limited(self):
+        max_size, max_chunk_size = upload_manager.max_size, upload_manager.max_chunk_size
+        upload_manager.max_size, upload_manager.max_chunk_size = 100, 60
+        try:
+            upload = json.loads(self.app.post('/api/v1/uploads').data)
+            self.assertEqual(upload['max_chunks'], 2)
+            self.assertEqual(self._put(upload['id'], 2, b'x').status_code, 413)
+            used = workspace_manager.bytes_used()
+            self.assertEqual(self._put(upload['id'], 0, bytes(60)).status_code, 200)
+            self.assertEqual(workspace_manager.bytes_used() - used, 60)  # chunks count against the disk quota
+            self.assertEqual(self._put(upload['id'], 1, bytes(60)).status_code, 413)
+            self.assertEqual(self._put(upload['id'], 1, bytes(40)).status_code, 200)
+            self.assertEqual(self._put(upload['id'], 0, bytes(50)).status_code, 200)  # replaces the first chunk
+            self.assertEqual(json.loads(self.app.get('/api/v1/uploads/' + upload['id']).data)['received'], 90)
+            self.assertEqual(self.app.delete('/api/v1/uploads/' + upload['id']).status_code, 204)
+            self.assertEqual(workspace_manager.bytes_used(), used)
+
+            upload_id = json.loads(self.app.post('/api/v1/uploads', data=json.dumps({'size': 1}),
+                                                 content_type='application/json').data)['id']
+            self.assertEqual(self._put(upload_id, 1, b'x').status_code, 413)  # beyond the declared size
+        finally:
+            upload_manager.max_size, upload_manager.max_chunk_size = max_size, max_chunk_size
+
+    def test_chunk_over_quota(self):
+        bytes_free = upload_manager.bytes_free
+        upload_id = json.loads(self.app.post('/api/v1/uploads').data)['id']
+        upload_manager.bytes_free = lambda: 10
+        try:
+            self.assertEqual(self._put(upload_id, 0, bytes(11)).status_code, 503)
+            self.assertEqual(self._put(upload_id, 0, bytes(10)).status_code, 200)
+        finally:
+            upload_manager.bytes_free = bytes_free
+
+
+class ZipArchiveTests(BaseConverterTestCase):
+
+    def _zip(self, extra):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(io.BytesIO(self.test_data_zip)) as src, \
+                zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for info in src.infolist():
+                dst.writestr(info, src.read(info))
+            for name, data in extra:
+                dst.writestr(name, data)
+        return buf.getvalue()
+
+    def test_only_tables_extracted(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            zip_path = os.path.join(work_dir, 'isatab.zip')
+            with open(zip_path, 'wb') as zip_fp:
+                zip_fp.write(self._zip([('raw/EVHINN999.sff', os.urandom(1024))]))
+            src_dir, names = isarest_converters._extract(zip_path, work_dir, isarest_converters._isatab_members)
+            self.assertIn('raw/EVHINN999.sff', names)
+            self.assertEqual(sorted(os.listdir(src_dir)),
+                             ['a_gilbert-assay-Gx.txt', 'a_gilbert-assay-Tx.txt', 'i_gilbert.txt', 's_BII-S-3.txt'])
+
+    def test_validation_without_data_files(self):
+        response = self.app.post(path='/api/v1/validate/isatab', data=self.test_data_zip,
+                                 headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 200)
+        with tempfile.TemporaryDirectory() as src_dir:
+            with zipfile.ZipFile(io.BytesIO(self.test_data_zip)) as zf:
+                zf.extractall(src_dir)
+            report = isarest_validation.validate_isatab(os.path.join(src_dir, 'i_gilbert.txt'))
+        self.assertEqual(json.loads(response.data), json.loads(json.dumps(report)))
+
+    def test_zip_bomb_rejected(self):
+        bomb = self._zip([('EVHINN999.sff', bytes(16 * 1024 * 1024))])
+        for path in ('/api/v1/convert/tab-to-json', '/api/v1/validate/isatab', '/api/v1/convert/tab-to-all'):
+            response = self.app.post(path=path, data=bomb, headers={'Content-Type': 'application/zip'})
+            self.assertEqual(response.status_code, 413)
+        max_members = config.ZIP_MAX_MEMBERS
+        config.ZIP_MAX_MEMBERS = 10
+        try:
+            response = self.app.post(path='/api/v1/validate/isatab', data=self.test_data_zip,
+                                     headers={'Content-Type': 'application/zip'})
+        finally:
+            config.ZIP_MAX_MEMBERS = max_members
+        self.assertEqual(response.status_code, 413)
+
+
+class CompressionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        with open(os.path.join(os.path.dirname(__file__), 'testdata/BII-S-3.json'), 'rb') as json_fp:
+            self.json = json_fp.read()
+
+    def test_compressed_request_body(self):
+        plain = self.app.post('/api/v1/convert/json-to-sampletab', data=self.json, content_type='application/json')
+        gzipped = self.app.post('/api/v1/convert/json-to-sampletab', data=gzip.compress(self.json),
+                                content_type='application/json', headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(gzipped.status_code, 200)
+        self.assertEqual(gzipped.data, plain.data)
+        self.assertEqual(self.app.post('/api/v1/convert/json-to-sampletab', data=self.json,
+                                       content_type='application/json',
+                                       headers={'Content-Encoding': 'br'}).status_code, 415)
+        self.assertEqual(self.app.post('/api/v1/convert/json-to-sampletab', data=gzip.compress(self.json)[:-100],
+                                       content_type='application/json',
+                                       headers={'Content-Encoding': 'gzip'}).status_code, 400)
+
+    def test_compressed_body_over_quota(self):
+        lookups = []
+
+        def bytes_free():
+            lookups.append(1)
+            return len(self.json) - 1
+        workspace_manager.bytes_free = bytes_free
+        try:
+            response = self.app.post('/api/v1/convert/json-to-sampletab', data=gzip.compress(self.json),
+                                     content_type='application/json', headers={'Content-Encoding': 'gzip'})
+        finally:
+            del workspace_manager.bytes_free
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(lookups), 1)
+
+    def test_response_compression(self):
+        plain = self.app.get('/api/v1/configs')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        gzipped = self.app.get('/api/v1/configs', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', gzipped.headers['Vary'])
+        self.assertEqual(gzip.decompress(gzipped.data), plain.data)
+        sampletab = self.app.post('/api/v1/convert/json-to-sampletab', data=self.json,
+                                  content_type='application/json', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(sampletab.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(gzip.decompress(sampletab.data).startswith(b'[MSI]'))
+        min_size = config.COMPRESSION_MIN_SIZE
+        config.COMPRESSION_MIN_SIZE = len(plain.data) + 1
+        try:
+            small = self.app.get('/api/v1/configs', headers={'Accept-Encoding': 'gzip'})
+        finally:
+            config.COMPRESSION_MIN_SIZE = min_size
+        self.assertNotIn('Content-Encoding', small.headers)
+        self.assertEqual(small.data, plain.data)
+
+
+class JsonEncoderTests(unittest.TestCase):
+
+    def test_encoders_agree(self):
+        obj = {'studies': [{'identifier': 'S-1', 'samples': list(range(100))}], 'title': 'caf\u00e9', 'when': {1, 2}}
+        outputs = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in isarest_json.ENCODERS:
+                out_path = os.path.join(tmp_dir, name + '.json')
+                with open(out_path, 'wb') as out_fp:
+                    isarest_json.ENCODERS[name](obj, out_fp, sorted)
+                with open(out_path, encoding='utf-8') as out_fp:
+                    outputs.append(json.load(out_fp))
+        self.assertTrue(all(output == outputs[0] for output in outputs))
+        self.assertEqual(outputs[0]['when'], [1, 2])
+
+    class Recorder(io.BytesIO):
+
+        def __init__(self):
+            super().__init__()
+            self.writes = []
+
+        def write(self, data):
+            self.writes.append(len(data))
+            return super().write(data)
+
+    def test_orjson_written_in_parts(self):
+        studies = [{'identifier': 'S-{}'.format(i), 'assays': [{'samples': list(range(1000))}] * 3} for i in range(3)]
+        out_fp = self.Recorder()
+        isarest_json._dump_orjson({'studies': studies}, out_fp, None)
+        self.assertEqual(json.loads(out_fp.getvalue()), {'studies': studies})
+        self.assertLess(max(out_fp.writes), len(out_fp.getvalue()) // 3)  # never a whole study at once
+
+
+class NdjsonTests(BaseConverterTestCase):
+
+    def test_records(self):
+        isajson = isarest_converters.load_module('isatools.isajson')
+        with open(os.path.join(os.path.dirname(__file__), 'testdata/BII-S-3.json')) as json_fp:
+            ISA = isajson.load(json_fp)
+        lines = [isarest_json.dumps_line(record) for record in isarest_converters.isa_records(ISA)]
+        self.assertTrue(all(line.endswith(b'\n') and line.count(b'\n') == 1 for line in lines))
+        records = [json.loads(line) for line in lines]
+        self.assertEqual(records[0]['type'], 'investigation')
+        self.assertNotIn('studies', records[0]['data'])
+        self.assertEqual(len(ISA.studies), 1)
+        study = ISA.studies[0]
+        types = [record['type'] for record in records]
+        self.assertEqual(types.count('study'), 1)
+        self.assertEqual(types.count('assay'), len(study.assays))
+        self.assertEqual(len([r for r in records if r['type'] == 'sample' and 'assay' not in r]), len(study.samples))
+        self.assertEqual(types.count('process'),
+                         len(study.process_sequence) + sum(len(a.process_sequence) for a in study.assays))
+        self.assertTrue(all(record['study'] == study.filename for record in records[1:]))
+
+    def test_unknown_format(self):
+        response = self.app.post(path='/api/v1/convert/tab-to-json?format=xml', data=self.test_data_zip,
+                                 headers={'Content-Type': 'application/zip'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unsupported_content(self):
+        response = self.app.post(path='/api/v1/convert/tab-to-json?format=ndjson', data=self.test_data_json,
+                                 headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 415)
+
+
+class ServerTests(unittest.TestCase):
+
+    class Worker:
+        pid = os.getpid()
+        alive = True
+        log = logging.getLogger(__name__)
+
+    def test_worker_recycled_above_rss_limit(self):
+        max_worker_rss = config.SERVER_MAX_WORKER_RSS
+        worker = self.Worker()
+        try:
+            config.SERVER_MAX_WORKER_RSS = 1024 * 1024 * 1024 * 1024
+            isarest_server._recycle_if_bloated(worker, None, None, None)
+            self.assertTrue(worker.alive)
+            config.SERVER_MAX_WORKER_RSS = 1024
+            isarest_server._recycle_if_bloated(worker, None, None, None)
+            self.assertFalse(worker.alive)
+        finally:
+            config.SERVER_MAX_WORKER_RSS = max_worker_rss
+
+
 if __name__ == '__main__':
     unittest.main()